@@ -0,0 +1,177 @@
+import logging
+import re
+import unicodedata
+from fuzzywuzzy import fuzz
+
+log = logging.getLogger(__name__)
+
+
+P_YEAR = re.compile('\\b((?:19|20)\\d\\d)([a-z])?\\b')
+P_ETAL = re.compile('\\s+et\\.?\\s+al\\.?,?', re.IGNORECASE)
+P_AUTH_SPLIT = re.compile('\\s*(?:,|;|&|\\band\\b)\\s*')
+# only initials after the comma: "Johnson, T." but not "Teresa Johnson, Kate Smith"
+P_SURNAME_FIRST = re.compile("^([^\\W\\d_][\\w'\\- ]*?),\\s*[A-Z]\\.(?:\\s*-?[A-Z]\\.)*")
+P_INITIALS = re.compile('^(?:-?[A-Z]\\.?\\s*)+$')
+
+def normName(name):
+    """
+    lowercase, strip accents and everything that is not a letter
+    'O’Connor' -> 'oconnor', 'Müller' -> 'muller'
+    """
+    name = unicodedata.normalize('NFKD', name)
+    name = "".join(c for c in name if not unicodedata.combining(c))
+    return re.sub('[\\W\\d_]+', '', name.lower())
+
+def parseCiteKey(citekey):
+    """
+    parse an author-year key as produced by getAnnotRefKeys2
+    e.g.: "Smith et al. 2019a", "Smith and Jones, 2019", "Smith 2019"
+    returns (surnames, etal, year, suffix) or None
+    """
+    m = None
+    for m in P_YEAR.finditer(citekey):
+        pass
+    if m is None:
+        return None
+    year = int(m.group(1))
+    suffix = m.group(2) or ''
+    auth = citekey[:m.start()].rstrip(' ,.(')
+    etal = P_ETAL.search(auth) is not None
+    auth = P_ETAL.sub('', auth)
+    surnames = [normName(a) for a in P_AUTH_SPLIT.split(auth)]
+    surnames = [s for s in surnames if s]
+    if not surnames:
+        return None
+    return surnames, etal, year, suffix
+
+def parseRefEntry(ref):
+    """
+    parse a reference list entry in author-year style
+    e.g.: "Teresa Johnson. 2016. ThinLTO: Scalable and Incremental LTO. ..."
+          "Johnson, T., and Smith, K. (2016). ThinLTO ..."
+    returns (surnames, year, suffix) or None
+    surnames holds the (normalized) family names of all detected authors
+    """
+    m = P_YEAR.search(ref)
+    if m is None:
+        return None
+    year = int(m.group(1))
+    suffix = m.group(2) or ''
+    auth = ref[:m.start()].rstrip(' ,.(')
+    auth = P_ETAL.sub('', auth)
+    if not auth:
+        return None
+    surnames = []
+    if P_SURNAME_FIRST.match(auth):
+        # Surname, I., Surname2, I. J. and Surname3, I.
+        for part in P_AUTH_SPLIT.split(auth):
+            part = part.strip()
+            if not part or P_INITIALS.match(part):
+                continue
+            surnames.append(normName(part))
+    else:
+        # Firstname Surname, Firstname2 Surname2, and Firstname3 Surname3
+        for part in P_AUTH_SPLIT.split(auth):
+            part = part.strip().rstrip('.')
+            if not part:
+                continue
+            surnames.append(normName(part.split(' ')[-1]))
+    surnames = [s for s in surnames if s]
+    if not surnames:
+        return None
+    return surnames, year, suffix
+
+
+class AuthorYearIndex:
+    """
+    maps normalized (first author surname, year, suffix) keys to reference ids
+    built once per pdf, resolves most author-year citations with one lookup
+    """
+    MIN_FUZZ_RATIO = 80
+
+    def __init__(self):
+        self.entries = {}
+        self.keys = {}
+        self.by_year = {}
+
+    def add(self, rid, surnames, year, suffix=''):
+        self.entries[rid] = (surnames, year, suffix)
+        self.by_year.setdefault(year, []).append(rid)
+
+    def build(self):
+        """
+        assign the implicit a, b, c suffixes to entries which share authors
+        and year (in reference list order) and fill the key index
+        """
+        self.keys = {}
+        groups = {}
+        for rid, (surnames, year, suffix) in self.entries.items():
+            groups.setdefault((tuple(surnames), year), []).append(rid)
+        for (surnames, year), rids in groups.items():
+            surname = surnames[0]
+            implicit = [rid for rid in rids if not self.entries[rid][2]]
+            for i, rid in enumerate(implicit):
+                self.keys.setdefault((surname, year, ''), []).append(rid)
+                if len(implicit) > 1 and i < 26:
+                    self.keys.setdefault((surname, year, chr(ord('a') + i)), []).append(rid)
+            for rid in rids:
+                suffix = self.entries[rid][2]
+                if suffix:
+                    self.keys.setdefault((surname, year, suffix), []).append(rid)
+                    self.keys.setdefault((surname, year, ''), []).append(rid)
+        log.debug("Author-year index: %d entries, %d keys", len(self.entries), len(self.keys))
+        return self
+
+    @staticmethod
+    def fromRefs(refs):
+        """
+        refs: dict [rid] -> reference text
+        """
+        index = AuthorYearIndex()
+        for rid, ref in refs.items():
+            parsed = parseRefEntry(ref)
+            if parsed is None:
+                log.debug("Failed to parse author-year ref: %s", ref)
+                continue
+            index.add(rid, *parsed)
+        return index.build()
+
+    def __score(self, rid, surnames, etal):
+        esurnames = self.entries[rid][0]
+        r = fuzz.ratio(surnames[0], esurnames[0])
+        # author count must be compatible with the citation form
+        if etal and len(esurnames) < 3:
+            r -= 20
+        elif not etal and len(surnames) != len(esurnames):
+            r -= 20
+        for s in surnames[1:]:
+            if s not in esurnames:
+                r -= 10
+        return r
+
+    def __fuzzy(self, rids, surnames, etal):
+        scored = sorted(((self.__score(rid, surnames, etal), rid) for rid in rids), reverse=True)
+        log.debug("Author-year candidates: %s", scored)
+        if not scored or scored[0][0] < AuthorYearIndex.MIN_FUZZ_RATIO:
+            return None
+        if len(scored) > 1 and scored[1][0] == scored[0][0]:
+            return None
+        return scored[0][1]
+
+    def lookup(self, citekey):
+        """
+        returns the reference id for a citation key like "Smith et al. 2019"
+        or None if it can not be resolved unambiguously
+        """
+        parsed = parseCiteKey(citekey)
+        if parsed is None:
+            log.error("Invalid author-year key: %s", citekey)
+            return None
+        surnames, etal, year, suffix = parsed
+        rids = self.keys.get((surnames[0], year, suffix), [])
+        if len(rids) == 1:
+            return rids[0]
+        if not rids:
+            # ocr / transliteration issues, try all entries of that year
+            rids = self.by_year.get(year, [])
+        return self.__fuzzy(rids, surnames, etal)
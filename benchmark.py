@@ -0,0 +1,462 @@
+"""
+offline benchmarks of the parsing, matching and cache hot paths
+
+    python benchmark.py                          # run all, print a table
+    python benchmark.py -n 2000 --only annot     # benchmarks matching 'annot'
+    python benchmark.py --save baseline.json     # store the results
+    python benchmark.py --baseline baseline.json # fail on regressions
+    python benchmark.py --only import --check-imports # fail on slow start up
+
+every benchmark builds its synthetic input (annotations, reference
+sections, library csv exports, cache directories) with N items, then
+reports the best time of --repeat runs, the throughput (items/s) and the
+peak memory (tracemalloc) of one run. benchmarks whose dependencies are
+not installed are skipped, benchmarks which check their results (e.g.
+the reference formats of authoryear_formats) fail the run
+
+--check-imports imports getDoi in a fresh interpreter and fails if that
+takes longer than --import-budget or loads one of HEAVY_MODULES, which
+are only needed once a note has to be resolved
+"""
+import logging
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+WORDS = ("efficient software based fault isolation memory safety control flow "
+        "integrity kernel hypervisor fuzzing symbolic execution compiler sandbox "
+        "attack defense analysis scalable incremental link time optimization "
+        "learning neural network secure enclave binary rewriting protection").split()
+SURNAMES = ["Smith", "Jones", "Müller", "Wahbe", "Lucco", "Anderson", "Graham",
+        "Johnson", "O'Connor", "Nguyen", "Zhang", "Garcia", "Kim", "Novak"]
+
+BENCHMARKS = []
+
+# loaded by the resolver only, not by --help or up to date notes
+HEAVY_MODULES = ['pandas', 'numpy', 'pyzotero', 'bs4', 'lxml', 'crossref',
+        'pdfminer', 'requests', 'tenacity', 'rapidfuzz', 'fuzzywuzzy', 'sqlite3',
+        'refextract', 'zotapi', 'semanticscholar']
+# milliseconds `import getDoi` may take, without the interpreter start up
+IMPORT_BUDGET_MS = 100
+IMPORT_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import %s
+print(json.dumps([time.perf_counter() - t0, sorted(set(m.split('.')[0] for m in sys.modules))]))
+"""
+
+def bench(name, size=1000):
+    """
+    register setup(n, tmpdir) -> fn, fn() is timed
+    size: default number of items
+    """
+    def register(setup):
+        BENCHMARKS.append((name, size, setup))
+        return setup
+    return register
+
+# generators
+
+def genTitle(rnd):
+    return " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(4, 10))).capitalize()
+
+def genAuthors(rnd):
+    return [rnd.choice(SURNAMES) for _ in range(rnd.randint(1, 4))]
+
+def genAnnot(rnd, n, nrefs=200):
+    """
+    annotation with n numeric citations like [3], [4, 7], [10-12]
+    """
+    out = []
+    for i in range(n):
+        r = rnd.randint(1, nrefs - 5)
+        cite = rnd.choice(["[%d]" % r, "[%d, %d]" % (r, r + 3), "[%d-%d]" % (r, r + 2)])
+        out.append("%s %s." % (genTitle(rnd), cite))
+    return "\n".join(out)
+
+def genAnnotAuthorYear(rnd, n):
+    """
+    annotation with n author-year citations like [Smith et al. 2019a]
+    """
+    out = []
+    for i in range(n):
+        auth = rnd.choice(SURNAMES)
+        year = rnd.randint(1990, 2023)
+        cite = rnd.choice(["[%s %d]" % (auth, year), "[%s et al. %d]" % (auth, year), "[%s and %s, %d]" % (auth, rnd.choice(SURNAMES), year)])
+        out.append("%s %s." % (genTitle(rnd), cite))
+    return "\n".join(out)
+
+def genRefSection(rnd, n):
+    """
+    pdf text with a numeric reference section of n entries
+    """
+    lines = ["Some paper", "", "Introduction"] + [genTitle(rnd) for _ in range(50)] + ["References"]
+    for i in range(1, n + 1):
+        lines.append("[%d] %s. %s. In Proceedings of the %s, %d." % (i, ", ".join(genAuthors(rnd)), genTitle(rnd), genTitle(rnd), rnd.randint(1990, 2023)))
+    lines.extend(["Appendix", genTitle(rnd)])
+    return "\n".join(lines)
+
+def genRefSectionAuthorYear(rnd, n):
+    """
+    pdf text with an author-year reference section of n entries
+    """
+    lines = ["Introduction"] + [genTitle(rnd) for _ in range(50)] + ["References"]
+    for i in range(n):
+        lines.append("%s. %d. %s." % (", ".join(genAuthors(rnd)), rnd.randint(1990, 2023), genTitle(rnd)))
+        lines.append("In Proceedings of the %s." % genTitle(rnd))
+    lines.extend(["Appendix", genTitle(rnd)])
+    return "\n".join(lines)
+
+def genCite(rnd, i):
+    """
+    reference text of work i, the titles of different works share most but
+    not all of their words
+    """
+    title = "%s %s" % (genTitle(rnd), "".join(rnd.choice("bcdfghklmnprstvz") for _ in range(8)))
+    return "%s. %s. In Proceedings of the %s, %d." % (", ".join(genAuthors(rnd)), title, genTitle(rnd), rnd.randint(1990, 2023))
+
+def genLibraryCsv(rnd, path, n):
+    """
+    zotero csv export with n rows, returns the titles
+    """
+    import csv
+    titles = []
+    with open(path, "w", newline='') as fd:
+        w = csv.writer(fd)
+        w.writerow(["Key", "Item Type", "Publication Year", "Author", "Title", "DOI", "Url", "Date Added", "File Attachments", "Link Attachments", "Notes"])
+        for i in range(n):
+            key = "K%07d" % i
+            title = "%s %d" % (genTitle(rnd), i)
+            titles.append(title)
+            w.writerow([key, "conferencePaper", rnd.randint(1990, 2023), "; ".join(genAuthors(rnd)), title,
+                "10.%d/%d" % (1000 + i % 9000, i), "https://example.org/%d" % i, "2022-01-01 00:00:00",
+                "/papers/%s.pdf" % key, "", "<p>%s</p>" % genTitle(rnd)])
+    return titles
+
+# benchmarks
+
+@bench('annot_refkeys', 2000)
+def benchAnnotRefKeys(n, tmpdir):
+    from getDoi import getAnnotRefKeys
+    annot = genAnnot(random.Random(1), n)
+    return lambda: getAnnotRefKeys(annot)
+
+@bench('annot_refkeys_authoryear', 2000)
+def benchAnnotRefKeys2(n, tmpdir):
+    from getDoi import getAnnotRefKeys2
+    annot = genAnnotAuthorYear(random.Random(1), n)
+    return lambda: getAnnotRefKeys2(annot)
+
+@bench('splitref_komma', 20000)
+def benchSplitrefKomma(n, tmpdir):
+    from getDoi import splitrefKomma
+    rnd = random.Random(1)
+    refstrs = []
+    for i in range(n):
+        r = rnd.randint(1, 300)
+        refstrs.append(rnd.choice(["%d" % r, "%d,%d" % (r, r + 4), "%d-%d,%d" % (r, r + 3, r + 9)]))
+    return lambda: [splitrefKomma(r) for r in refstrs]
+
+def makeRefExtract():
+    """
+    RefExtract without remote clients, enough for the parsing and matching helpers
+    """
+    from refextract import RefExtract
+    refex = RefExtract.__new__(RefExtract)
+    refex.refstart = "References"
+    refex.refstop = "Appendix"
+    refex.refstop2 = "additional results"
+    return refex
+
+@bench('parse_references', 2000)
+def benchParseReferences(n, tmpdir):
+    refex = makeRefExtract()
+    text = genRefSection(random.Random(1), n)
+    return lambda: refex._RefExtract__parseReferences(text)
+
+@bench('parse_references_authoryear', 2000)
+def benchParseReferencesAuthorYear(n, tmpdir):
+    refex = makeRefExtract()
+    text = genRefSectionAuthorYear(random.Random(1), n)
+    return lambda: refex._RefExtract__parseReferencesAuthorYear(text)
+
+@bench('authoryear_lookup', 1000)
+def benchAuthorYearLookup(n, tmpdir):
+    from authoryear import AuthorYearIndex
+    rnd = random.Random(1)
+    refs = dict((i, "%s. %d. %s." % (", ".join(genAuthors(rnd)), rnd.randint(1990, 2023), genTitle(rnd))) for i in range(n))
+    index = AuthorYearIndex.fromRefs(refs)
+    keys = [rnd.choice(["%s %d", "%s et al. %d"]) % (rnd.choice(SURNAMES), rnd.randint(1990, 2023)) for _ in range(n)]
+    return lambda: [index.lookup(k) for k in keys]
+
+# reference entries of both author list styles and the keys citing them
+AUTHORYEAR_CASES = [
+    ("Sidney Amani, Alex Hixon, Zilin Chen, Christine Rizkallah, Peter Chubb, Liam O'Connor, Joel Beeren, "
+        "Yutaka Nagashima, Japheth Lim, Thomas Sewell, Joseph Tuong, Gabriele Keller, Toby Murray, Gerwin Klein, "
+        "and Gernot Heiser. 2016. Cogent: Verifying High-Assurance File System Implementations. In ASPLOS.",
+        ['amani', 'hixon', 'chen'], "Amani et al. 2016"),
+    ("Konstantin Serebryany, Derek Bruening, Alexander Potapenko, and Dmitriy Vyukov. 2012. AddressSanitizer: "
+        "A Fast Address Sanity Checker. In USENIX ATC.", ['serebryany', 'bruening'], "Serebryany et al. 2012"),
+    ("Jane Smith, Bob Doe, and Carl Roe. 2019. Other thing.", ['smith', 'doe', 'roe'], "Smith et al. 2019"),
+    ("Smith, J. and Doe, A. 2019. Something.", ['smith', 'doe'], "Smith and Doe, 2019"),
+    ("Johnson, T. K., Smith, J.-P., and Müller, K. (2016). ThinLTO: Scalable and Incremental LTO.",
+        ['johnson', 'smith', 'muller'], "Johnson et al. 2016"),
+    ]
+
+@bench('authoryear_formats', 1000)
+def benchAuthorYearFormats(n, tmpdir):
+    """
+    fails if a case of AUTHORYEAR_CASES does not parse or resolve
+    """
+    from authoryear import AuthorYearIndex, parseRefEntry
+    refs = dict((i, ref) for i, (ref, surnames, key) in enumerate(AUTHORYEAR_CASES))
+    index = AuthorYearIndex.fromRefs(refs)
+    for i, (ref, surnames, key) in enumerate(AUTHORYEAR_CASES):
+        parsed = parseRefEntry(ref)
+        assert parsed and parsed[0][:len(surnames)] == surnames, "%s parsed as %s" % (key, parsed)
+        assert index.lookup(key) == i, "%s resolved to %s" % (key, index.lookup(key))
+    entries = [ref for ref, surnames, key in AUTHORYEAR_CASES] * (n // len(AUTHORYEAR_CASES) + 1)
+    return lambda: [parseRefEntry(ref) for ref in entries[:n]]
+
+# reference sections as pdfminer breaks them and the identifiers of their entries
+IDENTIFIER_CASES = [
+    ("[1] A. Wahbe and S. Lucco. Efficient Software-based Fault Iso-\nlation. In SOSP, 1993. doi:10.1145/168619.168635\n"
+        "In Proceedings of the 14th Symposium.\n", [('doi', '10.1145/168619.168635')]),
+    ("[2] A. Vaswani. Attention Is All You Need. arXiv:1706.03762\nCurran Associates, 2017.\n", [('arxiv', '1706.03762')]),
+    ("[3] K. Serebryany. AddressSanitizer. CoRR abs/1606.06954\nUSENIX ATC, 2012.\n", [('arxiv', '1606.06954')]),
+    ]
+
+@bench('identifiers', 2000)
+def benchIdentifiers(n, tmpdir):
+    """
+    fails if an entry of IDENTIFIER_CASES does not yield its identifiers
+    """
+    from identifiers import findIdentifiers
+    refex = makeRefExtract()
+    refs = refex._RefExtract__parseReferences("".join(text for text, ids in IDENTIFIER_CASES) + "Appendix\n")
+    for i, (text, ids) in enumerate(IDENTIFIER_CASES):
+        assert findIdentifiers(refs[i + 1]) == ids, "[%d] %s: %s" % (i + 1, refs[i + 1], findIdentifiers(refs[i + 1]))
+    cites = [refs[i % len(refs) + 1] for i in range(n)]
+    return lambda: [findIdentifiers(cite) for cite in cites]
+
+def uncached(fn):
+    """
+    fn with empty textnorm caches, every round measures the normalization
+    and scoring instead of cache hits of the rounds before
+    """
+    import textnorm
+    def run():
+        for cached in [textnorm.score, textnorm.fold, textnorm.citeKey, textnorm.titleKey]:
+            cached.cache_clear()
+        return fn()
+    return run
+
+@bench('match_title', 5000)
+def benchMatchTitle(n, tmpdir):
+    refex = makeRefExtract()
+    rnd = random.Random(1)
+    pairs = [(genTitle(rnd), genTitle(rnd)) for _ in range(n)]
+    return uncached(lambda: [refex._RefExtract__matchTitle(a, b) for a, b in pairs])
+
+@bench('match_cite', 5000)
+def benchMatchCite(n, tmpdir):
+    refex = makeRefExtract()
+    rnd = random.Random(1)
+    pairs = []
+    for _ in range(n):
+        title = genTitle(rnd)
+        cite = "%s. %s. In Proceedings of the %s." % (", ".join(genAuthors(rnd)), rnd.choice([title, genTitle(rnd)]), genTitle(rnd))
+        pairs.append((title, cite))
+    return uncached(lambda: [refex._RefExtract__matchCite(title=t, cite=c) for t, c in pairs])
+
+@bench('zotero_fuzzy_title', 5000)
+def benchFuzzyTitle(n, tmpdir):
+    from zotapi import ZotApi
+    rnd = random.Random(1)
+    csvpath = os.path.join(tmpdir, "library.csv")
+    titles = genLibraryCsv(rnd, csvpath, n)
+    za = ZotApi(csvpath, "0", "user", "offline")
+    queries = [rnd.choice(titles).lower() for _ in range(20)]
+    return uncached(lambda: [za.getItemIdByFuzzyTitle(q) for q in queries])
+
+@bench('zotero_load_csv', 20000)
+def benchLoadCsv(n, tmpdir):
+    from zotapi import ZotApi
+    csvpath = os.path.join(tmpdir, "library.csv")
+    genLibraryCsv(random.Random(1), csvpath, n)
+    return lambda: ZotApi(csvpath, "0", "user", "offline")
+
+@bench('file_cache', 2000)
+def benchFileCache(n, tmpdir):
+    from filecache import ShardedCache
+    rnd = random.Random(1)
+    titles = ["%s %d" % (genTitle(rnd), i) for i in range(n)]
+    root = os.path.join(tmpdir, "cache_by_title")
+    cache = ShardedCache(root, ['zaitem', 'smitem', 'critem', 'ckey'])
+    for t in titles:
+        cache.update(t, 'smitem', {'title': t, 'paperId': 'x' * 40})
+    def run():
+        for t in titles:
+            cache.read(t, 'smitem')
+        for t in titles[:n // 10]:
+            cache.update(t, 'zaitem', {'key': 'K'})
+    return run
+
+@bench('cite_index', 2000)
+def benchCiteIndex(n, tmpdir):
+    from citeindex import CiteIndex
+    rnd = random.Random(1)
+    index = CiteIndex(tmpdir)
+    cites = []
+    for i in range(n):
+        cite = "%s. %s. In Proceedings of the %s, %d." % (", ".join(genAuthors(rnd)), genTitle(rnd), genTitle(rnd), rnd.randint(1990, 2023))
+        cites.append(cite)
+        index.add(cite, "10.1000/%d" % i, 'crossref', {'DOI': "10.1000/%d" % i})
+    queries = [c.replace("Proceedings of the", "Proc.") for c in cites]
+    return lambda: [index.find(q, 'crossref') for q in queries]
+
+@bench('cite_index_candidates', 4000)
+def benchCiteIndexCandidates(n, tmpdir):
+    """
+    fails unless the share of the index a lookup compares against falls as
+    the index grows (sub-linear lookups) and near-duplicates are still found
+    """
+    from citeindex import CiteIndex, citeTokens
+    fractions = []
+    for size in [max(n // 8, 100), n]:
+        rnd = random.Random(1)
+        index = CiteIndex(tmpdir)
+        cites = [genCite(rnd, i) for i in range(size)]
+        for i, cite in enumerate(cites):
+            index.add(cite, "10.1000/%d" % i, 'crossref', {'DOI': "10.1000/%d" % i})
+        queries = [c.replace("Proceedings of the", "Proc.") for c in cites[:100]]
+        found = [index.find(q, 'crossref').get('DOI') for q in queries]
+        assert found == ["10.1000/%d" % i for i in range(len(queries))], "near-duplicates missed"
+        tokens = [citeTokens(q) for q in queries]
+        fractions.append(sum(len(index._CiteIndex__candidates(t)) for t in tokens) / len(tokens) / size)
+    assert fractions[-1] < fractions[0] * 0.75, "candidate share does not fall: %s" % fractions
+    return lambda: [index._CiteIndex__candidates(t) for t in tokens]
+
+@bench('import_getdoi', 1)
+def benchImport(n, tmpdir):
+    return lambda: importCost('getDoi', 1)
+
+# runner
+
+def importCost(module, repeat=5):
+    """
+    (best seconds, top level modules loaded) of importing module in a fresh
+    interpreter, the interpreter start up is not counted
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', IMPORT_PROBE % module], cwd=here)
+        seconds, modules = json.loads(out.decode('utf-8').splitlines()[-1])
+        best = seconds if best is None else min(best, seconds)
+    return best, modules
+
+def checkImports(budget_ms, module='getDoi'):
+    """
+    returns the violations of the start up budget of module
+    """
+    seconds, modules = importCost(module)
+    print("%-30s %10.1fms (budget %gms)" % ("import " + module, seconds * 1000, budget_ms))
+    violations = []
+    if seconds * 1000 > budget_ms:
+        violations.append("import %s took %.1fms, budget %gms" % (module, seconds * 1000, budget_ms))
+    heavy = [m for m in HEAVY_MODULES if m in modules]
+    if heavy:
+        violations.append("import %s loads %s" % (module, ", ".join(heavy)))
+    return violations
+
+def runBench(name, n, setup, repeat):
+    tmpdir = tempfile.mkdtemp(prefix='zotgraph_bench_')
+    try:
+        fn = setup(n, tmpdir)
+        fn()
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - t0)
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    best = min(times)
+    return {'n': n, 'seconds': best, 'per_second': n / best if best > 0 else 0, 'peak_kib': peak / 1024}
+
+def compare(results, baseline, tolerance):
+    """
+    returns the names of benchmarks slower or bigger than baseline * (1 + tolerance)
+    """
+    regressions = []
+    for name, res in results.items():
+        base = baseline.get(name)
+        if base is None or base['n'] != res['n']:
+            continue
+        for metric in ['seconds', 'peak_kib']:
+            if base[metric] > 0 and res[metric] > base[metric] * (1 + tolerance):
+                regressions.append("%s: %s %.4g -> %.4g (%+.0f%%)" % (name, metric, base[metric], res[metric], 100 * (res[metric] / base[metric] - 1)))
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the hot paths')
+    parser.add_argument('-n', help='Number of items (default: per benchmark)', type=int)
+    parser.add_argument('--only', help='Run benchmarks whose name contains ONLY', action='append')
+    parser.add_argument('--repeat', help='Timed runs per benchmark', type=int, default=5)
+    parser.add_argument('--save', help='Write the results to a json file')
+    parser.add_argument('--baseline', help='Compare against results written by --save')
+    parser.add_argument('--tolerance', help='Allowed slowdown / memory growth against the baseline', type=float, default=0.25)
+    parser.add_argument('--check-imports', help='Fail if importing getDoi exceeds the budget or loads heavy dependencies', action='store_true')
+    parser.add_argument('--import-budget', help='Milliseconds importing getDoi may take', type=float, default=IMPORT_BUDGET_MS)
+    args = parser.parse_args(argv)
+
+    results = {}
+    failed = False
+    for name, size, setup in BENCHMARKS:
+        if args.only and not any(o in name for o in args.only):
+            continue
+        n = args.n or size
+        try:
+            res = runBench(name, n, setup, args.repeat)
+        except ImportError as e:
+            print("%-30s skipped (%s)" % (name, e))
+            continue
+        except AssertionError as e:
+            print("%-30s FAILED %s" % (name, e))
+            failed = True
+            continue
+        results[name] = res
+        print("%-30s n=%-6d %10.4fs %12.0f/s %10.0f KiB" % (name, n, res['seconds'], res['per_second'], res['peak_kib']))
+
+    if args.check_imports:
+        violations = checkImports(args.import_budget)
+        for v in violations:
+            print("BUDGET %s" % v)
+        failed = failed or bool(violations)
+
+    if args.save:
+        with open(args.save, "w") as fd:
+            fd.write(json.dumps(results, indent=2, sort_keys=True))
+    if args.baseline:
+        regressions = compare(results, json.loads(open(args.baseline, "r").read()), args.tolerance)
+        for r in regressions:
+            print("REGRESSION %s" % r)
+        failed = failed or bool(regressions)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main(sys.argv[1:])
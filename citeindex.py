@@ -0,0 +1,204 @@
+import logging
+import json
+import gzip
+import os
+import re
+import random
+import hashlib
+import tempfile
+import threading
+import zlib
+
+import metrics
+from filecache import FileLock
+
+log = logging.getLogger(__name__)
+
+P_TOKEN = re.compile('[^\\W_]+')
+P_YEAR = re.compile('^(19|20)\\d\\d$')
+# tokens which vary between citation styles of the same work
+STOPWORDS = set([
+    'and', 'the', 'for', 'with', 'from', 'etal', 'proc', 'proceedings',
+    'conference', 'conf', 'international', 'intl', 'annual', 'symposium',
+    'symp', 'journal', 'trans', 'transactions', 'vol', 'volume', 'pages',
+    'page', 'acm', 'ieee', 'usenix', 'press', 'pp', 'no', 'in', 'of', 'on',
+    ])
+
+def fingerprint(cite):
+    """
+    same normalization as the cite cache file names
+    """
+    cite = re.sub('[\\W_]+', '', cite.lower())
+    return hashlib.md5(cite.encode()).hexdigest()
+
+def citeTokens(cite):
+    """
+    set of tokens which identify the cited work
+    drops initials, page numbers and venue boilerplate
+    """
+    cite = cite.lower().replace('-', '').replace('\xad', '').replace('et al', 'etal')
+    tokens = set()
+    for t in P_TOKEN.findall(cite):
+        if t in STOPWORDS:
+            continue
+        if t.isdigit() and not P_YEAR.match(t):
+            continue
+        if len(t) < 3 and not t.isdigit():
+            continue
+        tokens.add(t)
+    return tokens
+
+
+class CiteIndex:
+    """
+    work level index of resolved citations
+    every work (doi or semantic scholar paperId) is stored once,
+    cite fingerprints point to it. near-duplicate cites are found with
+    minhash signatures and locality sensitive hashing over the signature bands,
+    only the band hashes and the token set of a cite are stored
+    """
+    NUM_PERM = 120
+    # 20 bands of 6 rows: cites with a jaccard similarity of 0.6 are
+    # candidates with 50% probability, unrelated cites (< 0.3) hardly ever
+    BANDS = 20
+    # author lists and venues differ a lot between citation styles,
+    # candidates are verified against the work title by the caller
+    MIN_JACCARD = 0.4
+    PRIME = (1 << 61) - 1
+
+    def __init__(self, cache_dir):
+        self.path = os.path.join(cache_dir, 'citeindex.json.gz')
+        rnd = random.Random(0x5eed)
+        self.perms = [(rnd.randrange(1, CiteIndex.PRIME), rnd.randrange(0, CiteIndex.PRIME)) for _ in range(CiteIndex.NUM_PERM)]
+        self.works = {}
+        self.cites = {}
+        self.buckets = {}
+        self.dirty = False
+        # hedged lookups add from their worker threads
+        self.lock = threading.Lock()
+        self.__merge(self.__read())
+        log.debug("Loaded cite index: %d works, %d cites", len(self.works), len(self.cites))
+
+    def __read(self):
+        try:
+            with gzip.open(self.path, 'rt') as fd:
+                return json.load(fd)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            log.warning("Broken cite index %s: %s", self.path, e)
+            return {}
+
+    def __merge(self, data):
+        """
+        add the works and cites of data we do not know yet
+        """
+        for work_id, work in data.get('works', {}).items():
+            known = self.works.setdefault(work_id, {})
+            for key, value in work.items():
+                known.setdefault(key, value)
+        for fp, entry in data.get('cites', {}).items():
+            if fp in self.cites:
+                continue
+            if len(entry['bands']) != CiteIndex.BANDS:
+                # saved with other band settings
+                entry['bands'] = self.__bands(entry['tokens'])
+                self.dirty = True
+            self.cites[fp] = entry
+            self.__addBuckets(fp, entry['bands'])
+
+    def save(self):
+        """
+        merges the index on disk before replacing it, so concurrent runs
+        sharing the cache (watch, daemon, prefetch) keep each other's entries
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            with FileLock(self.path + '.lock'):
+                self.__merge(self.__read())
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt') as f:
+                        json.dump({'works': self.works, 'cites': self.cites}, f, separators=(',', ':'))
+                    os.replace(tmp, self.path)
+                except:
+                    os.remove(tmp)
+                    raise
+            self.dirty = False
+
+    def __bands(self, tokens):
+        """
+        minhash signature, hashed per band
+        """
+        hashes = [zlib.crc32(t.encode()) for t in tokens]
+        sig = [min((a * h + b) % CiteIndex.PRIME for h in hashes) for a, b in self.perms]
+        rows = CiteIndex.NUM_PERM // CiteIndex.BANDS
+        return [zlib.crc32(("%d:%s" % (i, sig[i * rows:(i + 1) * rows])).encode()) for i in range(CiteIndex.BANDS)]
+
+    def __addBuckets(self, fp, bands):
+        for i, band in enumerate(bands):
+            self.buckets.setdefault((i, band), set()).add(fp)
+
+    def __candidates(self, tokens):
+        """
+        fingerprints of the cites sharing a band with tokens
+        """
+        candidates = set()
+        for i, band in enumerate(self.__bands(tokens)):
+            candidates.update(self.buckets.get((i, band), ()))
+        return candidates
+
+    def find(self, cite, key):
+        """
+        returns the `key` data (crossref, smitem) of the work most similar
+        to cite, or {} if there is no near-duplicate
+        callers still have to verify the match
+        """
+        with self.lock:
+            return self.__find(cite, key)
+
+    def __find(self, cite, key):
+        fp = fingerprint(cite)
+        if fp in self.cites:
+            data = self.works.get(self.cites[fp]['work'], {}).get(key, {})
+            metrics.cache('citeindex', bool(data))
+            return data
+        tokens = citeTokens(cite)
+        if not tokens:
+            metrics.cache('citeindex', False)
+            return {}
+        candidates = self.__candidates(tokens)
+        best = None
+        best_sim = CiteIndex.MIN_JACCARD
+        for cfp in candidates:
+            ctokens = self.cites[cfp]['tokens']
+            sim = len(tokens.intersection(ctokens)) / len(tokens.union(ctokens))
+            work = self.works.get(self.cites[cfp]['work'], {})
+            if sim >= best_sim and key in work:
+                best = work
+                best_sim = sim
+        metrics.cache('citeindex', best is not None)
+        if best is None:
+            return {}
+        log.debug("Near-duplicate cite (jaccard %.2f): %s", best_sim, cite)
+        return best[key]
+
+    def add(self, cite, work_id, key, data):
+        """
+        store data of a resolved work and point the cite fingerprint to it
+        """
+        if not work_id:
+            return
+        work_id = work_id.lower()
+        with self.lock:
+            self.works.setdefault(work_id, {})[key] = data
+            fp = fingerprint(cite)
+            if fp not in self.cites:
+                tokens = citeTokens(cite)
+                if not tokens:
+                    return
+                bands = self.__bands(tokens)
+                self.cites[fp] = {'work': work_id, 'tokens': sorted(tokens), 'bands': bands}
+                self.__addBuckets(fp, bands)
+            self.dirty = True
@@ -0,0 +1,138 @@
+import logging
+import argparse
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from getDoi import addLibArgs, makeResolver, resolveAnnot
+import metrics
+import logconf
+
+log = logging.getLogger(__name__)
+
+
+class ResolverDaemon:
+    """
+    keeps the zotero library, semantic scholar client and reference
+    extractor warm between requests
+    """
+    def __init__(self, args):
+        self.args = args
+        self.za, self.sm, self.refex = makeResolver(args)
+        self.csv_mtime = self.__csvMtime()
+        # RefExtract is not re-entrant (shared partial results, caches)
+        self.lock = threading.Lock()
+
+    def __csvMtime(self):
+        try:
+            return os.stat(self.args.libcsv).st_mtime
+        except OSError:
+            return None
+
+    def __reloadCsv(self):
+        mtime = self.__csvMtime()
+        if mtime is None or mtime == self.csv_mtime:
+            return
+        log.info("Library csv changed, reloading %s", self.args.libcsv)
+        self.za.reloadCsv()
+        self.csv_mtime = mtime
+
+    def resolve(self, title, annot, fmt=None):
+        """
+        returns (output, refs) for an annotation of the paper with title
+        """
+        with self.lock:
+            self.__reloadCsv()
+            output, refkeys, refs = resolveAnnot(self.za, self.refex, title, annot, fmt)
+            return output, refs
+
+    def refs(self, zakey, refids):
+        """
+        resolve refids of an item which is already in the library
+        """
+        with self.lock:
+            self.__reloadCsv()
+            pdfpath = self.za.getPdfPath(zakey)
+            return self.refex.extractRefs(pdfpath, zakey, None, set(refids))
+
+    def close(self):
+        self.refex.close()
+
+
+class ResolverHandler(BaseHTTPRequestHandler):
+    resolver = None
+
+    def __reply(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __request(self, fields):
+        length = int(self.headers.get('Content-Length', 0))
+        req = json.loads(self.rfile.read(length).decode('utf-8'))
+        missing = [f for f in fields if f not in req.keys()]
+        if missing:
+            raise ValueError("missing %s" % ", ".join(missing))
+        return req
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.__reply(200, {'status': 'ok'})
+            return
+        if self.path == '/metrics':
+            body = metrics.METRICS.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.__reply(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        fields = {'/resolve': ['title', 'annot'], '/refs': ['zakey', 'refids']}
+        if self.path not in fields.keys():
+            self.__reply(404, {'error': 'unknown path %s' % self.path})
+            return
+        try:
+            req = self.__request(fields[self.path])
+        except ValueError as e:
+            self.__reply(400, {'error': 'invalid request: %s' % e})
+            return
+        try:
+            if self.path == '/resolve':
+                output, refs = self.resolver.resolve(req['title'], req['annot'], req.get('format'))
+                self.__reply(200, {'output': output, 'refs': dict((str(k), v) for k, v in refs.items())})
+            else:
+                refs = self.resolver.refs(req['zakey'], req['refids'])
+                self.__reply(200, {'refs': dict((str(k), v) for k, v in refs.items())})
+        except LookupError as e:
+            self.__reply(404, {'error': str(e)})
+        except Exception as e:
+            log.exception("Request failed")
+            self.__reply(500, {'error': str(e)})
+
+    def log_message(self, fmt, *args):
+        log.info("%s %s", self.address_string(), fmt % args)
+
+
+def serve(argv):
+    parser = argparse.ArgumentParser(description='Resolver daemon')
+    parser.add_argument('--host', help='Address to listen on', default="127.0.0.1")
+    parser.add_argument('--port', help='Port to listen on', type=int, default=8765)
+    args = addLibArgs(parser).parse_args(argv)
+    logconf.configure(args)
+    ResolverHandler.resolver = ResolverDaemon(args)
+    server = ThreadingHTTPServer((args.host, args.port), ResolverHandler)
+    log.info("Resolver daemon listening on http://%s:%d", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        ResolverHandler.resolver.close()
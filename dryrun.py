@@ -0,0 +1,163 @@
+"""
+cost estimate of a run: the remote calls it would make, found by walking
+every reference through the caches without going remote, and the wall
+time the rate limits of the services make these calls take
+"""
+import logging
+
+log = logging.getLogger(__name__)
+
+SERVICES = ['crossref', 'semanticscholar', 'zotero', 'bbt']
+# service of each kind of remote lookup (the job kinds of the job queue)
+KIND_SERVICE = {
+        'crossref': 'crossref',
+        'smsearch': 'semanticscholar',
+        'smpaper': 'semanticscholar',
+        'zaitem': 'zotero',
+        'zakey': 'zotero',
+        'ckey': 'bbt',
+        }
+# calls the run makes once a lookup finds something, counted along as
+# possible when the dry run does not know the result
+FOLLOWUPS = {
+        # title search of the crossref hit
+        'crossref': ['zotero', 'bbt', 'semanticscholar', 'semanticscholar'],
+        # paper of the search hit
+        'smsearch': ['semanticscholar'],
+        }
+
+
+class Estimate:
+    """
+    calls: remote calls the run makes for sure
+    possible: calls which depend on the outcome of an earlier remote call
+              (e.g. the title search for a crossref hit not known yet)
+    """
+    # seconds per call of services without a rate limit
+    LATENCY = {'crossref': 1.0, 'semanticscholar': 1.0, 'zotero': 0.5, 'bbt': 0.05}
+
+    def __init__(self, intervals, parallel=True):
+        """
+        intervals: seconds between two calls allowed by the rate limit, by service
+        parallel: the services are queried in parallel (hedged lookups)
+        """
+        self.intervals = intervals
+        self.parallel = parallel
+        self.calls = dict((s, 0) for s in SERVICES)
+        self.possible = dict((s, 0) for s in SERVICES)
+        self.refs = {}
+        self.current = None
+        self.notes = 0
+        self.uptodate = 0
+        # resolved by an earlier run (manifest)
+        self.known = 0
+        # cited, but not found in the pdf
+        self.unparsed = 0
+        self.local_seconds = 0.0
+
+    def note(self, uptodate=False, known=0):
+        self.notes += 1
+        self.uptodate += int(uptodate)
+        self.known += known
+
+    def ref(self, refid):
+        """
+        calls counted from now on belong to refid of the current note
+        """
+        if refid is None:
+            self.current = None
+            return
+        self.current = (self.notes, refid)
+        self.refs.setdefault(self.current, {'calls': 0, 'possible': 0})
+
+    def call(self, service, possible=False):
+        (self.possible if possible else self.calls)[service] += 1
+        if self.current is not None:
+            self.refs[self.current]['possible' if possible else 'calls'] += 1
+
+    def serviceSeconds(self, service, n):
+        """
+        the first call goes out at once, every further one waits for the
+        rate limit or the previous call, whichever takes longer
+        """
+        if n == 0:
+            return 0.0
+        latency = Estimate.LATENCY.get(service, 1.0)
+        return (n - 1) * max(self.intervals.get(service, 0.0), latency) + latency
+
+    def wallSeconds(self, counts):
+        seconds = [self.serviceSeconds(s, n) for s, n in counts.items()]
+        remote = max(seconds) if self.parallel else sum(seconds)
+        return self.local_seconds + remote
+
+    def report(self):
+        upper = dict((s, self.calls[s] + self.possible[s]) for s in SERVICES)
+        cached = [refid for refid, r in self.refs.items() if r['calls'] == 0 and r['possible'] == 0]
+        return {
+                'notes': self.notes,
+                'notes_up_to_date': self.uptodate,
+                'refs': len(self.refs) + self.known + self.unparsed,
+                'refs_known': self.known,
+                'refs_unparsed': self.unparsed,
+                'refs_cached': len(cached),
+                'refs_remote': len(self.refs) - len(cached),
+                'calls': dict(self.calls),
+                'calls_upper': upper,
+                'local_seconds': self.local_seconds,
+                'wall_seconds': self.wallSeconds(self.calls),
+                'wall_seconds_upper': self.wallSeconds(upper),
+                }
+
+    def log(self):
+        r = self.report()
+        log.info("Dry run: %d notes (%d up to date), %d references: %d resolved before, %d from cache, %d remote, %d not found in the pdf", r['notes'], r['notes_up_to_date'], r['refs'], r['refs_known'], r['refs_cached'], r['refs_remote'], r['refs_unparsed'])
+        for s in SERVICES:
+            log.info("  %-16s %4d calls (up to %4d), %s", s, r['calls'][s], r['calls_upper'][s], formatSeconds(self.serviceSeconds(s, r['calls'][s])))
+        log.info("Projected wall time: %s (up to %s)%s", formatSeconds(r['wall_seconds']), formatSeconds(r['wall_seconds_upper']), "" if self.parallel else ", services queried serially")
+
+
+class DryLookups:
+    """
+    remote lookups of a dry run (RefExtract.estimateRefs): answered from
+    the caches or the local library, the calls which would go out are
+    counted in est. a lookup without a known result answers with its
+    default (nothing found), calls after it in the same reference are only
+    possible
+    """
+    dry = True
+
+    def __init__(self, est, local, jobs=None):
+        """
+        local: by kind, fn(*args) -> (result or None, goes remote)
+        jobs: lookups a resumed run finished already are served by the job queue
+        """
+        self.est = est
+        self.local = local
+        self.jobs = jobs
+        self.possible = False
+
+    def ref(self, refid):
+        self.est.ref(refid)
+        self.possible = False
+
+    def remote(self, kind, key, default, fn, *args):
+        if self.jobs is not None and self.jobs.isDone(kind, key):
+            res = self.jobs.result(kind, key)
+            return default if res is None else res
+        res, remote = self.local[kind](*args) if kind in self.local.keys() else (None, True)
+        if remote:
+            self.est.call(KIND_SERVICE[kind], self.possible)
+        if res is None:
+            for service in FOLLOWUPS.get(kind, []):
+                self.est.call(service, True)
+            self.possible = True
+            return default
+        return res
+
+
+def formatSeconds(seconds):
+    if seconds < 60:
+        return "%.1fs" % seconds
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    return "%dh%02dm%02ds" % (h, m, s) if h else "%dm%02ds" % (m, s)
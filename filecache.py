@@ -0,0 +1,152 @@
+import logging
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+
+def normKey(key):
+    """
+    normalization of the (old) flat cache file names
+    """
+    return re.sub('[\\W_]+', '', key.lower())
+
+def lightKey(key):
+    """
+    keeps keys apart which only differ in punctuation
+    """
+    return " ".join(key.lower().split())
+
+
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = open(self.path, 'a')
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.fd.close()
+
+
+class ShardedCache:
+    """
+    content addressed json cache: root/ab/cd/<md5>.json
+    the md5 is taken over the normalized key (as the flat cache did), every
+    file holds one bucket per light key so keys which normalize the same
+    way do not overwrite each other. a key is only served from its own
+    bucket, or from the bucket the migration put the flat entry of its
+    file in (the flat cache served these to all such keys).
+    writes are atomic (temp file and rename), updates are serialized by one
+    lock file per shard directory
+    """
+    LOCK = ".lock"
+    MIGRATED = ".sharded"
+    # bucket of migrated entries, the flat files do not keep the original key
+    ANY = "*"
+
+    def __init__(self, root, keys, flat_hashed=False, name=None):
+        """
+        keys: sub keys every entry is initialized with
+        name: metrics namespace, default: directory name
+        flat_hashed: old flat file names are md5 hashes (cite cache),
+                     not the normalized keys (title cache)
+        """
+        self.root = root
+        self.keys = keys
+        self.name = name or os.path.basename(os.path.normpath(root))
+        os.makedirs(self.root, exist_ok=True)
+        if not os.path.exists(os.path.join(self.root, ShardedCache.MIGRATED)):
+            self.__migrate(flat_hashed)
+
+    def __hash(self, key):
+        return hashlib.md5(normKey(key).encode()).hexdigest()
+
+    def __path(self, h):
+        return os.path.join(self.root, h[0:2], h[2:4], h + '.json')
+
+    def __load(self, fn):
+        try:
+            return json.loads(open(fn, "r").read())
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            log.warning("Broken cache entry %s: %s", fn, e)
+            return {}
+
+    def __write(self, fn, data):
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fn), suffix='.tmp')
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(json.dumps(data, indent=2))
+            os.replace(tmp, fn)
+        except:
+            os.remove(tmp)
+            raise
+
+    def __update(self, h, bucket, key, data):
+        fn = self.__path(h)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with FileLock(os.path.join(os.path.dirname(fn), ShardedCache.LOCK)):
+            entry = self.__load(fn)
+            if bucket not in entry.keys():
+                entry[bucket] = dict((k, {}) for k in self.keys)
+            entry[bucket][key] = data
+            self.__write(fn, entry)
+
+    def read(self, key, sub):
+        fn = self.__path(self.__hash(key))
+        log.debug("Reading cached data for %s from %s", sub, fn)
+        entry = self.__load(fn)
+        value = entry.get(lightKey(key), {}).get(sub) or entry.get(ShardedCache.ANY, {}).get(sub)
+        metrics.cache("%s.%s" % (self.name, sub), bool(value))
+        return value or {}
+
+    def update(self, key, sub, data):
+        h = self.__hash(key)
+        log.debug("Updating cache: %s", self.__path(h))
+        self.__update(h, lightKey(key), sub, data)
+
+    def __migrate(self, flat_hashed):
+        """
+        move the entries of the old flat layout into the shards, once
+        """
+        with FileLock(os.path.join(self.root, ShardedCache.MIGRATED + '.lock')):
+            if os.path.exists(os.path.join(self.root, ShardedCache.MIGRATED)):
+                return
+            n = 0
+            for name in os.listdir(self.root):
+                fn = os.path.join(self.root, name)
+                # flat entries have no extension, skips the cite index etc.
+                if '.' in name or not os.path.isfile(fn):
+                    continue
+                try:
+                    data = json.loads(open(fn, "r").read())
+                except Exception as e:
+                    log.warning("Skipping broken cache file %s: %s", fn, e)
+                    continue
+                h = name if flat_hashed else hashlib.md5(name.encode()).hexdigest()
+                for sub, value in data.items():
+                    if value:
+                        self.__update(h, ShardedCache.ANY, sub, value)
+                os.remove(fn)
+                n += 1
+            open(os.path.join(self.root, ShardedCache.MIGRATED), "w").close()
+            log.info("Migrated %d cache entries in %s", n, self.root)
@@ -1,30 +1,35 @@
-from semanticscholar import SemanticScholar
-from refextract import RefExtract
-from zotapi import ZotApi
-from fuzzywuzzy import fuzz
-import subprocess
+# the resolver (pyzotero, pdfminer, crossref, rapidfuzz, ...) is only imported
+# once a note has to be resolved, --help and up to date notes skip it
+from pdffile import contentHash
+from dryrun import Estimate
+import metrics
 import re
 import sys
 import json
 import os
-import shlex
+import hashlib
 import logging
 import argparse
-FORMAT = "%(message)s"
-logging.basicConfig(format=FORMAT, level=logging.DEBUG)
+import threading
+from logconf import LazyJson
+import logconf
+
+# named explicitly, this module also runs as __main__
+log = logging.getLogger('getDoi')
 
 FUZZ_THRESH = 80
 refkeyMark0="RK"
 refkeyMark1="KR"
 
 def getSMItemID(sm, title):
+    import textnorm
     if title is None:
         return None
     smitems = sm.searchTitle(id=title)
     for smitem in smitems['data']:
-        ratio = fuzz.token_sort_ratio(title, smitem['title'])
-        logging.info("RATIO: %d" % ratio)
-        logging.info(json.dumps(smitem, indent=2))
+        ratio = textnorm.score(title, smitem['title'], 'sort')
+        log.debug("RATIO: %d", ratio)
+        log.debug("%s", LazyJson(smitem))
         if ratio < FUZZ_THRESH:
             continue
         return smitem['paperId']
@@ -36,18 +41,18 @@ def splitrefDash(refstr):
         ref_id = int(refstr)
         # hacky heu
         if ref_id > 500:
-            logging.error("Likely Invalid Reference String: %s" % refstr)
+            log.error("Likely Invalid Reference String: %s", refstr)
             return None
         return [ref_id]
     ref_parts = refstr.split('-')
     if len(ref_parts) != 2:
-        logging.error("Invalid Reference String: %s" % refstr)
+        log.error("Invalid Reference String: %s", refstr)
         return None
     ref_id0 = int(ref_parts[0])
     ref_id1 = int(ref_parts[1])
     # hacky heu
     if ref_id1 - ref_id0 <= 0 or ref_id1 - ref_id0 > 10:
-        logging.error("Likely Invalid Reference String: %s" % refstr)
+        log.error("Likely Invalid Reference String: %s", refstr)
         return None
     return range(ref_id0, ref_id1)
 
@@ -69,34 +74,35 @@ def splitrefKomma(refstr):
         ref_ret.extend(splitrefDash(ref))
     return ref_ret
 
-P_REFS_TEST2 = re.compile("\[((\w+\.?[\s|,|and|, and]?[\s|\.])+\d{4};?\s?)+\]")
+P_REFS_TEST2 = re.compile("\[((\w+\.?[\s|,|and|, and]?[\s|\.])+\d{4}[a-z]?;?\s?)+\]")
 def getAnnotRefKeys2(annot):
     refkeys = set()
     refkeyMarks = set()
     refkeyExpand = {}
     refs_replace = {}
     annot = " ".join(annot.splitlines())
-    refs = P_REFS_TEST2.findall(annot)
+    # findall would only return the last citation of a group
+    refs = P_REFS_TEST2.finditer(annot)
     for ref_group in refs:
-        refstr0 = ref_group[0]
-        refstr = ref_group[0]
-        logging.info("Found Reference: %s" % refstr)
+        refstr0 = ref_group.group(0)
+        refstr = ref_group.group(0)
+        log.info("Found Reference: %s", refstr)
         ref_replace = "%s" % refstr
         refstr = refstr.replace("[", "")
         refstr = refstr.replace("]", "")
         refstr_split = []
         try:
             refstr_split = list(map(lambda t: t.lstrip().rstrip(), splitrefSemicolon(refstr)))
-            logging.debug(refstr_split)
-            logging.info("Extracted References: %s" % ", ".join(map(lambda t: "%s" % t, refstr_split)))
+            log.debug(refstr_split)
+            log.info("Extracted References: %s", ", ".join(map(lambda t: "%s" % t, refstr_split)))
             for ref in refstr_split:
                 refkeys.add(ref)
                 refkeyMarks.add("%s_%s_%s" % (refkeyMark0, ref, refkeyMark1))
             refkeyExpand[refstr0] = ", ".join(map(lambda t: "%s_%s_%s" % (refkeyMark0, t, refkeyMark1), refstr_split))
-            logging.info("Expand Reference String: %s -> %s" % (refstr0, refkeyExpand[refstr0]))
+            log.info("Expand Reference String: %s -> %s", refstr0, refkeyExpand[refstr0])
         except Exception as e:
-            logging.error("Could not parse ref: '%s'" % refstr)
-            logging.error(e)
+            log.error("Could not parse ref: '%s'", refstr)
+            log.error(e)
     return refkeys, refkeyMarks, refkeyExpand
 
 
@@ -112,7 +118,7 @@ def getAnnotRefKeys(annot):
     for ref_group in refs:
         refstr0 = ref_group[0]
         refstr = ref_group[0]
-        logging.info("Found Reference: %s" % refstr)
+        log.info("Found Reference: %s", refstr)
         ref_replace = "%s" % refstr
         refstr = refstr.replace("[", "")
         refstr = refstr.replace("]", "")
@@ -120,32 +126,71 @@ def getAnnotRefKeys(annot):
         refstr_split = []
         try:
             refstr_split = splitrefKomma(refstr)
-            logging.info("Extracted References: %s" % ", ".join(map(lambda t: "%d" % t, refstr_split)))
+            log.info("Extracted References: %s", ", ".join(map(lambda t: "%d" % t, refstr_split)))
             for ref in refstr_split:
                 refkeys.add(ref)
                 refkeyMarks.add("%s_%d_%s" % (refkeyMark0, ref, refkeyMark1))
             refkeyExpand[refstr0] = ", ".join(map(lambda t: "%s_%d_%s" % (refkeyMark0, t, refkeyMark1), refstr_split))
-            logging.info("Expand Reference String: %s -> %s" % (refstr0, refkeyExpand[refstr0]))
+            log.info("Expand Reference String: %s -> %s", refstr0, refkeyExpand[refstr0])
         except Exception as e:
-            logging.error("Could not parse ref: '%s'" % refstr)
-            logging.error(e)
+            log.error("Could not parse ref: '%s'", refstr)
+            log.error(e)
     return refkeys, refkeyMarks, refkeyExpand
 
-parser = argparse.ArgumentParser(description='Update Annot Refs')
-parser.add_argument('-t','--title', help='Paper Title', required=True)
-#parser.add_argument('-ck','--ckey', help='Better Bibtex Citation Key', required=False)
-parser.add_argument('-a','--annot', help='Annotation File', required=True)
-parser.add_argument('-o','--output', help='Output file', required=True)
-parser.add_argument('-f','--format', help='Citation Format (1: normal, 2: text)', choices=["1", "2"])
-parser.add_argument('--apikey', help='Zotero api key', required=True)
-parser.add_argument('--libid', help='Zotero library id', required=True)
-parser.add_argument('--libtype', help='Zotero library type', default="user")
-parser.add_argument('--libcsv', help='Exported Zotero library (csv format)', default="./My Library.csv")
-parser.add_argument('--scache', help='Directory to cache semantic scholar data (by paperid)', default="./smcache")
-parser.add_argument('--ccache', help='Directory to cache crossref data (by citation)', default="./cache_by_cite")
-parser.add_argument('--tcache', help='Directory to cache various data (by title)', default="./cache_by_title")
-parser.add_argument('--anystyle', help='Path to anystyle', default="/home/file/.local/share/gem/ruby/3.0.0/bin/anystyle")
-args = parser.parse_args()
+def addLibArgs(parser):
+    parser.add_argument('--apikey', help='Zotero api key', required=True)
+    parser.add_argument('--libid', help='Zotero library id', required=True)
+    parser.add_argument('--libtype', help='Zotero library type', default="user")
+    parser.add_argument('--libcsv', help='Exported Zotero library (csv format)', default="./My Library.csv")
+    parser.add_argument('--scache', help='Directory to cache semantic scholar data (by paperid)', default="./smcache")
+    parser.add_argument('--smgraph', help='Use the semantic scholar graph api for paper lookups', action='store_true')
+    parser.add_argument('--search-ttl', help='Days cached semantic scholar searches are valid', type=float, default=30)
+    parser.add_argument('--search-neg-ttl', help='Days cached semantic scholar searches without results are valid', type=float, default=1)
+    parser.add_argument('--ccache', help='Directory to cache crossref data (by citation)', default="./cache_by_cite")
+    parser.add_argument('--crossref-full', help='Fetch full crossref records (slow)', action='store_true')
+    parser.add_argument('--serial', help='Query sources one after another instead of in parallel', action='store_true')
+    parser.add_argument('--tcache', help='Directory to cache various data (by title)', default="./cache_by_title")
+    parser.add_argument('--anystyle', help='Path to anystyle', default="/home/file/.local/share/gem/ruby/3.0.0/bin/anystyle")
+    parser.add_argument('--http-record', help='Record all http requests and responses to DIR', metavar='DIR')
+    parser.add_argument('--http-replay', help='Answer http requests from the recordings in DIR (no network)', metavar='DIR')
+    parser.add_argument('--replay-latency', help='Milliseconds added to every replayed response', type=float, default=0)
+    parser.add_argument('--replay-429-every', help='Answer every N-th replayed request with 429', type=int, default=0, metavar='N')
+    parser.add_argument('--metrics', help='Write a json report of stage timings, cache hits, remote calls and sleeps to FILE', metavar='FILE')
+    parser.add_argument('--metrics-prom', help='Write the metrics as prometheus textfile to FILE', metavar='FILE')
+    parser.add_argument('--profile', help='Profile the comma separated STAGES (%s) or all' % ", ".join(metrics.Profiler.STAGES), metavar='STAGES')
+    parser.add_argument('--profile-dir', help='Directory for the per stage profiles (pstats and text)', default="./profile")
+    parser.add_argument('--profile-clock', help='cpu: leave out time spent waiting, wall: include it', choices=['cpu', 'wall'], default='cpu')
+    parser.add_argument('--trace', help='Write a chrome trace of stages, lookups, remote calls and waits to FILE', metavar='FILE')
+    return logconf.addLogArgs(parser)
+
+def makeParser():
+    parser = argparse.ArgumentParser(description='Update Annot Refs', epilog="'%(prog)s resume [--queue QUEUE]' continues the last interrupted run, '%(prog)s fill OUTPUT' resolves the references left open by --deadline, '%(prog)s serve' starts the resolver daemon, '%(prog)s watch ANNOTDIR OUTDIR' keeps the notes of a directory up to date, '%(prog)s prefetch' resolves the references of all library pdfs into the caches")
+    parser.add_argument('-t','--title', help='Paper Title', required=True)
+    #parser.add_argument('-ck','--ckey', help='Better Bibtex Citation Key', required=False)
+    parser.add_argument('-a','--annot', help='Annotation File', required=True)
+    parser.add_argument('-o','--output', help='Output file', required=True)
+    parser.add_argument('-f','--format', help='Citation Format (1: normal, 2: text)', choices=["1", "2"])
+    parser.add_argument('--queue', help='Job queue of remote lookups (sqlite), used to resume interrupted runs', default="./jobqueue.sqlite")
+    parser.add_argument('--deadline', help='Write the output after SECONDS, unresolved references are filled in afterwards', type=float, metavar='SECONDS')
+    parser.add_argument('--daemon', help='Resolve through a running daemon (e.g. http://127.0.0.1:8765), falls back to local resolution')
+    parser.add_argument('--dry-run', help='Only report the remote calls the run would make and how long the rate limits make it take (no network)', action='store_true')
+    return addLibArgs(parser)
+
+def makeResolver(args, jobs=None):
+    from semanticscholar import SemanticScholar
+    from refextract import RefExtract
+    from zotapi import ZotApi
+    if args.http_record or args.http_replay:
+        import httpreplay
+        httpreplay.install(args)
+    metrics.install()
+    metrics.METRICS.setOutput(args.metrics, args.metrics_prom)
+    metrics.configure(args.profile.split(',') if args.profile else None, args.profile_dir, args.profile_clock, args.trace)
+    with metrics.stage('zotero_load'):
+        za = ZotApi(args.libcsv, args.libid, args.libtype, args.apikey)
+    sm = SemanticScholar(smcache=args.scache, graph_api=args.smgraph, search_ttl=args.search_ttl * 86400, search_neg_ttl=args.search_neg_ttl * 86400)
+    refex = RefExtract(sm, za, args.anystyle, cache_by_title=args.tcache, cache_by_cite=args.ccache, crossref_slim=not args.crossref_full, hedge=not args.serial, jobs=jobs)
+    return za, sm, refex
 
 #P_URL = re.compile('(https?):\/\/(www\.)?[a-z0-9\.:].*(?=\b)')
 #P_URL = re.compile('((https?):\/\/(www\.)?[a-z0-9\.:].*(\s|$))')
@@ -155,91 +200,479 @@ args = parser.parse_args()
 #print(m)
 #sys.exit(1)
 
-za = ZotApi(args.libcsv, args.libid, args.libtype, args.apikey)
-#TODO
-#print(args.ckey)
-#if(args.ckey):
-#    item = za.getItemByCKey(args.ckey)
-#    print("XXXXXXXXXXXXXXX")
-#    print(item)
-#sys.exit(1)
-baseZaKeys = za.getItemIdByFuzzyTitle(args.title)
-if len(baseZaKeys) == 0:
-    logging.error("Can not find title '%s'" % args.title)
-    sys.exit(1)
-if len(baseZaKeys) > 1:
-    logging.error("Multiple items for title '%s'" % args.title)
-    sys.exit(1)
-baseZaKey = baseZaKeys[0]
-pdfpath = za.getPdfPath(baseZaKey)
-logging.info("PDF : %s" % pdfpath)
-annot = open(args.annot, "r").read()
-if args.format == "2":
-    refkeys, refkeyMarks, refkeyExpand = getAnnotRefKeys2(annot)
-else:
-    refkeys, refkeyMarks, refkeyExpand = getAnnotRefKeys(annot)
-# expand refs in annotations
-for key, replacement in refkeyExpand.items():
-    annot = annot.replace(key, replacement)
-
-sm = SemanticScholar(smcache=args.scache)
-logging.info("Extracting references")
-refex = RefExtract(sm, za, args.anystyle, cache_by_title=args.tcache, cache_by_cite=args.ccache)
-refs = refex.extractRefs(pdfpath, baseZaKey, args.title, refkeys)
-
-ref2ckey = {}
-ref2alt = {}
-ref2url = {}
-ref2info = {}
-for ref_id, ref in refs.items():
-    #print(json.dumps(ref))
-    if ref_id not in refkeys:
-        logging.error("Unknown refid: %s" % ref_id)
-        continue
-    logging.info("." * 80)
-    logging.info("ID  : %s" % str(ref_id))
-    title = ref['title']
-    doi = ref['doi']
-    url = ref['url']
-    ckey = ref['ckey']
-    cite = ref['cite']
-    logging.info('TITL: "%s"' % title)
-    logging.info("DOI : %s" % doi)
-    logging.info("URL : %s" % url)
-    logging.info("CKEY: %s" % ckey)
-    logging.info("CITE: %s" % cite)
-    ref2info[ref_id] = ref
-    if ckey:
-        ref2ckey[ref_id] = "Reading notes/" + ckey + ".md"
-    logging.warning("REF2CKEY: %s\t%s" % (str(ref_id), ckey))
-    ref2url[ref_id] = url
-    ref2alt[ref_id] = "REF_%s:%s" % (str(ref_id), title)
-
-#P_REFS_TEST = re.compile("(\[(.*?)\])")
-#refs_replace = {}
-#refs = P_REFS_TEST.findall(annot)
-nrprinted = set()
-for refid in refkeys:
-    refMark = "%s_%s_%s" % (refkeyMark0, str(refid), refkeyMark1)
-    logging.info("Replacing Reference Mark: %s" % refMark)
-    if refid in ref2ckey.keys():
-        logging.info("REPLACE %s -> [[%s]]" % (refMark, ref2ckey[refid]))
-        annot = annot.replace(refMark, '[[%s]]' % ref2ckey[refid])
-    elif refid in ref2url.keys():
-        annot = annot.replace(refMark, '[%s](%s)' % (ref2alt[refid], ref2url[refid]))
-        if refid not in nrprinted:
-            logging.warning("UPDATE  %s -> \n%s" % (str(refid), json.dumps(ref2info[refid], indent=2)))
-            nrprinted.add(refid)
-    elif refid in ref2info.keys():
-        if refid not in nrprinted:
-            logging.warning("UPDATE  %s -> \n%s" % (str(refid), json.dumps(ref2info[refid], indent=2)))
-            nrprinted.add(refid)
+def getBaseItem(za, title):
+    #TODO
+    #print(args.ckey)
+    #if(args.ckey):
+    #    item = za.getItemByCKey(args.ckey)
+    #    print("XXXXXXXXXXXXXXX")
+    #    print(item)
+    #sys.exit(1)
+    baseZaKeys = za.getItemIdByFuzzyTitle(title)
+    if len(baseZaKeys) == 0:
+        raise LookupError("Can not find title '%s'" % title)
+    if len(baseZaKeys) > 1:
+        raise LookupError("Multiple items for title '%s'" % title)
+    baseZaKey = baseZaKeys[0]
+    pdfpath = za.getPdfPath(baseZaKey)
+    log.info("PDF : %s", pdfpath)
+    return baseZaKey, pdfpath
+
+def expandAnnot(annot, fmt):
+    if fmt == "2":
+        refkeys, refkeyMarks, refkeyExpand = getAnnotRefKeys2(annot)
+    else:
+        refkeys, refkeyMarks, refkeyExpand = getAnnotRefKeys(annot)
+    # expand refs in annotations
+    for key, replacement in refkeyExpand.items():
+        annot = annot.replace(key, replacement)
+    return annot, refkeys
+
+def replaceRefs(annot, refkeys, refs):
+    ref2ckey = {}
+    ref2alt = {}
+    ref2url = {}
+    ref2info = {}
+    for ref_id, ref in refs.items():
+        #print(json.dumps(ref))
+        if ref_id not in refkeys:
+            log.error("Unknown refid: %s", ref_id)
+            continue
+        log.debug("." * 80)
+        log.debug("ID  : %s", str(ref_id))
+        title = ref['title']
+        doi = ref['doi']
+        url = ref['url']
+        ckey = ref['ckey']
+        cite = ref['cite']
+        log.debug('TITL: "%s"', title)
+        log.debug("DOI : %s", doi)
+        log.debug("URL : %s", url)
+        log.debug("CKEY: %s", ckey)
+        log.debug("CITE: %s", cite)
+        ref2info[ref_id] = ref
+        if ckey:
+            ref2ckey[ref_id] = "Reading notes/" + ckey + ".md"
+        log.info("REF2CKEY: %s\t%s", str(ref_id), ckey)
+        ref2url[ref_id] = url
+        ref2alt[ref_id] = "REF_%s:%s" % (str(ref_id), title)
+
+    #P_REFS_TEST = re.compile("(\[(.*?)\])")
+    #refs_replace = {}
+    #refs = P_REFS_TEST.findall(annot)
+    nrprinted = set()
+    for refid in refkeys:
+        refMark = "%s_%s_%s" % (refkeyMark0, str(refid), refkeyMark1)
+        log.debug("Replacing Reference Mark: %s", refMark)
+        if refid in ref2ckey.keys():
+            log.info("REPLACE %s -> [[%s]]", refMark, ref2ckey[refid])
+            annot = annot.replace(refMark, '[[%s]]' % ref2ckey[refid])
+        elif refid in ref2url.keys():
+            annot = annot.replace(refMark, '[%s](%s)' % (ref2alt[refid], ref2url[refid]))
+            if refid not in nrprinted:
+                log.warning("UPDATE  %s -> \n%s", str(refid), LazyJson(ref2info[refid]))
+                nrprinted.add(refid)
+        elif refid in ref2info.keys():
+            if refid not in nrprinted:
+                log.warning("UPDATE  %s -> \n%s", str(refid), LazyJson(ref2info[refid]))
+                nrprinted.add(refid)
+        else:
+            log.error("Missed Reference: %s", str(refid))
+            annot = annot.replace(refMark, '[[TODO]](%s)' % refMark)
+            if refid in ref2info.keys():
+                log.warning("Missed  %s -> \n%s", str(refid), LazyJson(ref2info[refid]))
+                nrprinted.add(refid)
+    return annot
+
+def refLinks(refkeys, refs):
+    """
+    link each refid is replaced with, None for missed references
+    """
+    links = {}
+    for refid in refkeys:
+        ref = refs.get(refid)
+        if ref is None:
+            links[refid] = None
+        elif ref['ckey']:
+            links[refid] = '[[%s]]' % ("Reading notes/" + ref['ckey'] + ".md")
+        else:
+            links[refid] = '[%s](%s)' % ("REF_%s:%s" % (str(refid), ref['title']), ref['url'])
+    return links
+
+def resolveAnnot(za, refex, title, annot, fmt):
+    """
+    returns (output, refkeys, refs) for the annotation of the paper with title
+    """
+    zakey, pdfpath = getBaseItem(za, title)
+    with metrics.stage('annot_parse'):
+        annot, refkeys = expandAnnot(annot, fmt)
+    with metrics.stage('resolve'):
+        refs = refex.extractRefs(pdfpath, zakey, title, refkeys)
+    with metrics.stage('output'):
+        return replaceRefs(annot, refkeys, refs), refkeys, refs
+
+def isResolved(ref):
+    return ref is not None and (ref['ckey'] or ref['url'])
+
+def isLookedUp(ref):
+    """
+    a lookup found the work, a url parsed from the cite text alone does not
+    count while the lookups are still running
+    """
+    return ref is not None and bool(ref['title'] or ref['ckey'] or ref['doi'])
+
+def writeAtomic(path, text):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as fd:
+        fd.write(text)
+    os.replace(tmp, path)
+
+def fileHash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def manifestPath(output):
+    return output + ".manifest.json"
+
+def loadManifest(output):
+    try:
+        return json.loads(open(manifestPath(output), "r").read())
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        log.warning("Ignoring broken manifest %s: %s", manifestPath(output), e)
+        return {}
+
+def pdfStamp(pdfpath, old=None):
+    """
+    content hash of the pdf, only recomputed if size or mtime changed
+    """
+    st = os.stat(pdfpath)
+    stamp = {'path': pdfpath, 'size': st.st_size, 'mtime': st.st_mtime}
+    if old and all(old.get(k) == v for k, v in stamp.items()):
+        stamp['hash'] = old['hash']
+    else:
+        stamp['hash'] = contentHash(pdfpath)
+    return stamp
+
+def outputOptions(args):
+    """
+    options the output depends on besides the annotation and the pdf:
+    the citation format and the library the cite keys are taken from
+    """
+    return {'format': args.format, 'library': [args.libtype, args.libid]}
+
+def isUpToDate(manifest, output, title, annot_hash, options):
+    """
+    the output was written from the same annotation and pdf with the same
+    options, and all its references were resolved
+    """
+    if not manifest or not os.path.exists(output):
+        return False
+    if manifest['title'] != title or manifest['annot'] != annot_hash or manifest.get('options') != options:
+        return False
+    if manifest.get('pending') or any(not isResolved(ref) for refid, ref in manifest['refs']):
+        return False
+    try:
+        return pdfStamp(manifest['pdf']['path'], manifest['pdf'])['hash'] == manifest['pdf']['hash']
+    except OSError:
+        return False
+
+def knownRefs(manifest, title, pdf, options):
+    """
+    references resolved by an earlier run on the same pdf and library
+    """
+    if not manifest or manifest['title'] != title or manifest['pdf']['hash'] != pdf['hash']:
+        return {}
+    # manifests of earlier versions do not record the options
+    if manifest.get('options', options)['library'] != options['library']:
+        return {}
+    return dict((refid, ref) for refid, ref in manifest['refs'] if isResolved(ref))
+
+def saveManifest(output, title, annot_hash, options, zakey, pdf, refkeys, refs, pending=()):
+    """
+    pending: refids still to be filled, the note is not up to date
+    """
+    # refids are ints for the numeric format, keep them as pairs
+    refs = [[refid, refs[refid]] for refid in refkeys if refid in refs.keys()]
+    links = [[refid, link] for refid, link in refLinks(refkeys, dict(refs)).items()]
+    manifest = {'title': title, 'annot': annot_hash, 'options': options, 'zakey': zakey, 'pdf': pdf, 'refs': refs, 'links': links, 'pending': list(pending)}
+    writeAtomic(manifestPath(output), json.dumps(manifest, indent=2))
+
+def resolveFromManifest(args, annot, annot_hash, manifest):
+    """
+    fast path without the resolver (no library csv, no remote clients):
+    every reference of the annotation was resolved by an earlier run on the
+    same pdf. returns True if the output was written
+    """
+    if not manifest or manifest['title'] != args.title or not os.path.exists(manifest['pdf']['path']):
+        return False
+    pdf = pdfStamp(manifest['pdf']['path'], manifest['pdf'])
+    known = knownRefs(manifest, args.title, pdf, outputOptions(args))
+    with metrics.stage('annot_parse'):
+        annot, refkeys = expandAnnot(annot, args.format)
+    if any(refid not in known.keys() for refid in refkeys):
+        return False
+    with metrics.stage('output'):
+        writeAtomic(args.output, replaceRefs(annot, refkeys, known))
+        saveManifest(args.output, args.title, annot_hash, outputOptions(args), manifest['zakey'], pdf, refkeys, known)
+    log.info("All %d references of %s resolved by an earlier run", len(refkeys), args.output)
+    return True
+
+def pendingPath(output):
+    return output + ".pending.json"
+
+def savePending(output, argv, pending):
+    writeAtomic(pendingPath(output), json.dumps({'argv': argv, 'pending': list(pending)}, indent=2))
+
+def patchRefs(annot, refids, refs):
+    """
+    replace the [[TODO]] placeholders of refids in an already written output
+    """
+    for refid in refids:
+        refMark = "%s_%s_%s" % (refkeyMark0, str(refid), refkeyMark1)
+        annot = annot.replace('[[TODO]](%s)' % refMark, refMark)
+    # the other refs are already in the output
+    refs = dict((refid, refs[refid]) for refid in refids if refid in refs.keys())
+    return replaceRefs(annot, refids, refs)
+
+def extractRefsDeadline(refex, pdfpath, zakey, title, refkeys, deadline):
+    """
+    returns (refs, thread): all refs if extractRefs finished before the
+    deadline, else the refs resolved so far and the still running thread
+    raises the exception of extractRefs if it failed before the deadline
+    """
+    result = {}
+    def work():
+        try:
+            with metrics.stage('resolve'):
+                result['refs'] = refex.extractRefs(pdfpath, zakey, title, refkeys)
+        except Exception as e:
+            result['error'] = e
+    thread = threading.Thread(target=work, name="extractRefs")
+    thread.start()
+    thread.join(deadline)
+    if not thread.is_alive():
+        if 'error' in result.keys():
+            raise result['error']
+        return result['refs'], None
+    refs = refex.partialRefs()
+    log.warning("Deadline passed, %d of %d references resolved", len([r for r in refs.values() if isLookedUp(r)]), len(refkeys))
+    return refs, (thread, result)
+
+def fill(argv):
+    """
+    follow-up pass for an output written with --deadline
+    """
+    fparser = argparse.ArgumentParser(description='Fill references left open by --deadline')
+    fparser.add_argument('output', help='Output file written with --deadline')
+    fargs = fparser.parse_args(argv)
+    data = json.loads(open(pendingPath(fargs.output), "r").read())
+    args = makeParser().parse_args(data['argv'])
+    logconf.configure(args)
+    pending = data['pending']
+
+    za, sm, refex = makeResolver(args)
+    baseZaKey, pdfpath = getBaseItem(za, args.title)
+    refs = refex.extractRefs(pdfpath, baseZaKey, args.title, set(pending))
+    refex.close()
+    fillOutput(args.output, data['argv'], pending, refs)
+
+def fillOutput(output, argv, pending, refs):
+    """
+    returns the refids which are still unresolved
+    """
+    annot = patchRefs(open(output, "r").read(), pending, refs)
+    writeAtomic(output, annot)
+    missed = [refid for refid in pending if not isResolved(refs.get(refid))]
+    if missed:
+        log.warning("Still unresolved: %s", ", ".join(map(str, missed)))
+        savePending(output, argv, missed)
+    elif os.path.exists(pendingPath(output)):
+        os.remove(pendingPath(output))
+    return missed
+
+def makeEstimate(args):
+    from semanticscholar import SemanticScholar
+    from refextract import RefExtract
+    intervals = {
+            'crossref': RefExtract.CR_RATE_PERIOD / RefExtract.CR_RATE_CALLS,
+            'semanticscholar': SemanticScholar.RATE_PERIOD / SemanticScholar.RATE_CALLS,
+            }
+    return Estimate(intervals, parallel=not args.serial)
+
+def estimateNote(za, refex, est, args, annot, annot_hash, manifest):
+    """
+    count the remote calls resolving the note of args would make
+    """
+    if isUpToDate(manifest, args.output, args.title, annot_hash, outputOptions(args)):
+        est.note(uptodate=True)
+        return
+    if manifest and manifest['title'] == args.title and os.path.exists(manifest['pdf']['path']):
+        baseZaKey, pdfpath = manifest['zakey'], manifest['pdf']['path']
     else:
-        logging.error("Missed Reference: %s" % str(refid))
-        annot = annot.replace(refMark, '[[TODO]](%s)' % refMark)
-        if refid in ref2info.keys():
-            logging.warning("Missed  %s -> \n%s" % (str(refid), json.dumps(ref2info[refid], indent=2)))
-            nrprinted.add(refid)
-
-with open(args.output, "w") as fd:
-    fd.write(annot)
+        baseZaKey, pdfpath = getBaseItem(za, args.title)
+    pdf = pdfStamp(pdfpath, manifest.get('pdf'))
+    annot, refkeys = expandAnnot(annot, args.format)
+    known = knownRefs(manifest, args.title, pdf, outputOptions(args))
+    todo = set(refid for refid in refkeys if refid not in known.keys())
+    est.note(known=len(refkeys) - len(todo))
+    if todo:
+        refex.estimateRefs(pdfpath, baseZaKey, args.title, todo, est)
+
+def dryRun(args, annot, annot_hash, manifest, jobs=None):
+    za, sm, refex = makeResolver(args, jobs)
+    est = makeEstimate(args)
+    try:
+        estimateNote(za, refex, est, args, annot, annot_hash, manifest)
+    except LookupError as e:
+        log.error(e)
+        sys.exit(1)
+    finally:
+        refex.close()
+    est.log()
+    return est
+
+def resolveDaemon(url, args):
+    """
+    resolve the annotation through a running daemon
+    returns the output text or None if the daemon is not reachable
+    """
+    import urllib.request
+    import urllib.error
+    req = {'title': args.title, 'annot': open(args.annot, "r").read(), 'format': args.format}
+    try:
+        res = urllib.request.urlopen(urllib.request.Request(url.rstrip('/') + '/resolve', data=json.dumps(req).encode(), headers={'Content-Type': 'application/json'}))
+        return json.loads(res.read().decode('utf-8'))['output']
+    except urllib.error.HTTPError as e:
+        log.error("Daemon error: %s", e.read().decode('utf-8', 'replace'))
+    except (urllib.error.URLError, ConnectionError) as e:
+        log.warning("Daemon not reachable (%s), resolving locally", e)
+    return None
+
+def main(argv):
+    # until the command line is parsed
+    logconf.setup()
+    try:
+        run(argv)
+    finally:
+        metrics.finish()
+
+def run(argv):
+    if len(argv) > 0 and argv[0] == "fill":
+        fill(argv[1:])
+        return
+    if len(argv) > 0 and argv[0] == "serve":
+        from daemon import serve
+        serve(argv[1:])
+        return
+    if len(argv) > 0 and argv[0] == "watch":
+        from watch import watch
+        watch(argv[1:])
+        return
+    if len(argv) > 0 and argv[0] == "prefetch":
+        from prefetch import prefetch
+        prefetch(argv[1:])
+        return
+    jobs = None
+    dry_run = False
+    if len(argv) > 0 and argv[0] == "resume":
+        rparser = argparse.ArgumentParser(description='Resume an interrupted run')
+        rparser.add_argument('--queue', help='Job queue (sqlite)', default="./jobqueue.sqlite")
+        rparser.add_argument('--run', help='Run id (default: last unfinished run)', type=int)
+        rparser.add_argument('--dry-run', help='Only report the remote calls left to make', action='store_true')
+        rargs = rparser.parse_args(argv[1:])
+        dry_run = rargs.dry_run
+        from jobqueue import JobQueue
+        jobs = JobQueue(rargs.queue)
+        argv = jobs.resumeRun(rargs.run)
+        if argv is None:
+            log.error("Nothing to resume in %s", rargs.queue)
+            sys.exit(1)
+    args = makeParser().parse_args(argv)
+    logconf.configure(args)
+    annot = open(args.annot, "r").read()
+    annot_hash = hashlib.sha1(annot.encode('utf-8')).hexdigest()
+    manifest = loadManifest(args.output)
+    if args.dry_run or dry_run:
+        dryRun(args, annot, annot_hash, manifest, jobs)
+        return
+    if isUpToDate(manifest, args.output, args.title, annot_hash, outputOptions(args)):
+        log.info("%s is up to date", args.output)
+        if jobs is not None:
+            jobs.finishRun()
+        return
+    if resolveFromManifest(args, annot, annot_hash, manifest):
+        if jobs is not None:
+            jobs.finishRun()
+        return
+    if args.daemon:
+        output = resolveDaemon(args.daemon, args)
+        if output is not None:
+            writeAtomic(args.output, output)
+            return
+    if jobs is None:
+        from jobqueue import JobQueue
+        jobs = JobQueue(args.queue)
+        jobs.startRun(argv)
+
+    za, sm, refex = makeResolver(args, jobs)
+    if manifest and manifest['title'] == args.title and os.path.exists(manifest['pdf']['path']):
+        baseZaKey, pdfpath = manifest['zakey'], manifest['pdf']['path']
+    else:
+        try:
+            baseZaKey, pdfpath = getBaseItem(za, args.title)
+        except LookupError as e:
+            log.error(e)
+            sys.exit(1)
+    pdf = pdfStamp(pdfpath, manifest.get('pdf'))
+    with metrics.stage('annot_parse'):
+        annot, refkeys = expandAnnot(annot, args.format)
+    known = knownRefs(manifest, args.title, pdf, outputOptions(args))
+    todo = set(refid for refid in refkeys if refid not in known.keys())
+    log.info("%d references resolved by an earlier run, %d to resolve", len(refkeys) - len(todo), len(todo))
+
+    log.info("Extracting references")
+    # lookups which were pending when the last run stopped
+    jobs.drain(refex.jobFns())
+    if not todo:
+        refs = {}
+        running = None
+    elif args.deadline is None:
+        with metrics.stage('resolve'):
+            refs = refex.extractRefs(pdfpath, baseZaKey, args.title, todo)
+        running = None
+    else:
+        refs, running = extractRefsDeadline(refex, pdfpath, baseZaKey, args.title, todo, args.deadline)
+    refs.update(known)
+
+    if running is None:
+        refex.close()
+        with metrics.stage('output'):
+            writeAtomic(args.output, replaceRefs(annot, refkeys, refs))
+            saveManifest(args.output, args.title, annot_hash, outputOptions(args), baseZaKey, pdf, refkeys, refs)
+        jobs.finishRun()
+        return
+
+    # write what we have now, unresolved refs become [[TODO]] placeholders
+    refs = dict([(refid, ref) for refid, ref in refs.items() if refid in known.keys() or isLookedUp(ref)])
+    pending = [refid for refid in refkeys if refid not in refs.keys()]
+    writeAtomic(args.output, replaceRefs(annot, refkeys, refs))
+    savePending(args.output, argv, pending)
+    log.warning("Wrote %s, resolving %d references in the background", args.output, len(pending))
+    thread, result = running
+    thread.join()
+    refex.close()
+    if 'refs' not in result.keys():
+        log.error("Background resolution failed, run '%s fill %s': %s", sys.argv[0], args.output, result.get('error'), exc_info=result.get('error'))
+        return
+    missed = fillOutput(args.output, argv, pending, result['refs'])
+    refs.update(result['refs'])
+    saveManifest(args.output, args.title, annot_hash, outputOptions(args), baseZaKey, pdf, refkeys, refs, missed)
+    jobs.finishRun()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
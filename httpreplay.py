@@ -0,0 +1,207 @@
+"""
+record / replay of the http traffic of a run
+
+record: every request made through requests (semantic scholar, crossref,
+pyzotero, better bibtex) is stored with its response in a fixture
+directory.
+replay: requests are redirected to a local stand-in server which answers
+from the fixtures, with a simulated latency and 429 responses, so end to
+end runs can be timed on a machine without network
+"""
+import logging
+import base64
+import hashlib
+import inspect
+import json
+import os
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+log = logging.getLogger(__name__)
+
+ORIG_REQUEST = requests.Session.request
+# original url of a request redirected to the replay server
+URL_HEADER = 'X-Replay-Url'
+
+
+def requestBody(bound):
+    """
+    body of a Session.request call as bytes
+    """
+    args = bound.arguments
+    if args.get('json') is not None:
+        return json.dumps(args['json'], sort_keys=True).encode()
+    data = args.get('data')
+    if data is None:
+        return b''
+    if isinstance(data, dict):
+        return urllib.parse.urlencode(sorted(data.items())).encode()
+    if isinstance(data, str):
+        return data.encode()
+    return bytes(data)
+
+def requestUrl(bound):
+    """
+    full url including the query parameters
+    """
+    args = bound.arguments
+    return requests.Request(args['method'].upper(), args['url'], params=args.get('params')).prepare().url
+
+
+class FixtureStore:
+    """
+    responses by (method, url, body), one json file per request
+    a request recorded several times replays its responses in order
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.served = {}
+        os.makedirs(self.path, exist_ok=True)
+
+    def __key(self, method, url, body):
+        return hashlib.sha1(b"\0".join([method.upper().encode(), url.encode(), body])).hexdigest()
+
+    def __file(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def __load(self, key):
+        try:
+            return json.loads(open(self.__file(key), "r").read())
+        except FileNotFoundError:
+            return None
+
+    def record(self, method, url, body, response, elapsed):
+        key = self.__key(method, url, body)
+        with self.lock:
+            entry = self.__load(key) or {'method': method.upper(), 'url': url, 'body': body.decode('utf-8', 'replace'), 'responses': []}
+            entry['responses'].append({
+                'status': response.status_code,
+                'content_type': response.headers.get('Content-Type', ''),
+                'content': base64.b64encode(response.content).decode(),
+                'elapsed': elapsed,
+                })
+            tmp = self.__file(key) + '.tmp'
+            with open(tmp, "w") as fd:
+                fd.write(json.dumps(entry, indent=2))
+            os.replace(tmp, self.__file(key))
+        log.debug("Recorded %s %s (%d)", method.upper(), url, response.status_code)
+
+    def lookup(self, method, url, body):
+        """
+        returns the next recorded response or None
+        """
+        key = self.__key(method, url, body)
+        with self.lock:
+            entry = self.__load(key)
+            if entry is None:
+                return None
+            i = self.served.get(key, 0)
+            self.served[key] = i + 1
+            return entry['responses'][min(i, len(entry['responses']) - 1)]
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    store = None
+    latency = 0.0
+    throttle_every = 0
+    retry_after = 1
+    count = 0
+    lock = threading.Lock()
+
+    def __reply(self, status, content_type, content, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def __handle(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        url = self.headers.get(URL_HEADER)
+        with ReplayHandler.lock:
+            ReplayHandler.count += 1
+            n = ReplayHandler.count
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if self.throttle_every > 0 and n % self.throttle_every == 0:
+            self.__reply(429, 'application/json', b'{"message": "Too Many Requests"}', {'Retry-After': str(self.retry_after)})
+            return
+        res = self.store.lookup(self.command, url, body)
+        if res is None:
+            log.warning("No fixture for %s %s", self.command, url)
+            self.__reply(404, 'application/json', json.dumps({'error': 'no fixture', 'url': url}).encode())
+            return
+        self.__reply(res['status'], res['content_type'], base64.b64decode(res['content']))
+
+    do_GET = __handle
+    do_POST = __handle
+    do_PUT = __handle
+    do_PATCH = __handle
+    do_DELETE = __handle
+
+    def log_message(self, fmt, *args):
+        log.debug("replay %s", fmt % args)
+
+
+def record(path):
+    """
+    store every request and response in the fixture directory path
+    """
+    store = FixtureStore(path)
+    sig = inspect.signature(ORIG_REQUEST)
+    def request(self, *args, **kwargs):
+        bound = sig.bind(self, *args, **kwargs)
+        t0 = time.time()
+        r = ORIG_REQUEST(self, *args, **kwargs)
+        store.record(bound.arguments['method'], requestUrl(bound), requestBody(bound), r, time.time() - t0)
+        return r
+    requests.Session.request = request
+    log.info("Recording http traffic to %s", path)
+
+def replay(path, latency=0.0, throttle_every=0, retry_after=1):
+    """
+    serve the fixtures in path from a local server and redirect all
+    requests to it. returns the server
+    latency: seconds added to every response
+    throttle_every: answer every n-th request with 429
+    """
+    ReplayHandler.store = FixtureStore(path)
+    ReplayHandler.latency = latency
+    ReplayHandler.throttle_every = throttle_every
+    ReplayHandler.retry_after = retry_after
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ReplayHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="replay", daemon=True).start()
+    base = "http://127.0.0.1:%d/" % server.server_address[1]
+    sig = inspect.signature(ORIG_REQUEST)
+    def request(self, *args, **kwargs):
+        bound = sig.bind(self, *args, **kwargs)
+        url = requestUrl(bound)
+        bound.arguments['headers'] = dict(bound.arguments.get('headers') or {}, **{URL_HEADER: url})
+        bound.arguments['url'] = base
+        bound.arguments['params'] = None
+        # the body is sent as recorded
+        body = requestBody(bound)
+        bound.arguments['json'] = None
+        bound.arguments['data'] = body or None
+        return ORIG_REQUEST(*bound.args, **bound.kwargs)
+    requests.Session.request = request
+    log.info("Replaying http traffic from %s on %s", path, base)
+    return server
+
+def install(args):
+    """
+    set up recording or replay from the command line options
+    """
+    if args.http_record:
+        record(args.http_record)
+    elif args.http_replay:
+        replay(args.http_replay, args.replay_latency / 1000.0, args.replay_429_every)
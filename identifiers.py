@@ -0,0 +1,68 @@
+import re
+
+P_DOI = re.compile('\\b(10\\.\\d{4,9}/[^\\s"<>]+)', re.IGNORECASE)
+P_ARXIV = [
+        # arXiv:1706.03762v5, arxiv.org/abs/1706.03762, CoRR abs/1706.03762
+        re.compile('(?:arxiv\\s*:?\\s*|arxiv\\.org/(?:abs|pdf)/|corr\\s*,?\\s*abs/)(\\d{4}\\.\\d{4,5})(?:v\\d+)?', re.IGNORECASE),
+        # old style: arXiv:cs/0112017, arxiv.org/abs/hep-th/9901001
+        re.compile('(?:arxiv\\s*:?\\s*|arxiv\\.org/(?:abs|pdf)/|corr\\s*,?\\s*abs/)([a-z\\-]+(?:\\.[a-z]{2})?/\\d{7})(?:v\\d+)?', re.IGNORECASE),
+        ]
+
+def cleanDoi(doi):
+    doi = doi.rstrip('.,;:')
+    # unbalanced closing brackets are usually part of the surrounding text
+    while doi.endswith(')') and doi.count(')') > doi.count('('):
+        doi = doi[:-1].rstrip('.,;:')
+    while doi.endswith(']') and doi.count(']') > doi.count('['):
+        doi = doi[:-1].rstrip('.,;:')
+    if doi.lower().endswith('.pdf'):
+        doi = doi[:-4]
+    return doi
+
+def findDois(text):
+    dois = []
+    for m in P_DOI.finditer(text):
+        doi = cleanDoi(m.group(1))
+        if doi not in dois:
+            dois.append(doi)
+    return dois
+
+def findArxivIds(text):
+    ids = []
+    for p in P_ARXIV:
+        for m in p.finditer(text):
+            if m.group(1) not in ids:
+                ids.append(m.group(1))
+    return ids
+
+def findIdentifiers(text):
+    """
+    extract identifiers which can be resolved with a direct lookup
+    returns list of (kind, id) with kind in doi, arxiv; dois first
+    """
+    if not text:
+        return []
+    ids = [('doi', doi) for doi in findDois(text)]
+    ids.extend([('arxiv', aid) for aid in findArxivIds(text)])
+    return ids
+
+def findIdentifiersAny(anyref):
+    """
+    same as findIdentifiers for a reference parsed by anystyle
+    """
+    text = []
+    for key, values in anyref.items():
+        if not isinstance(values, list):
+            continue
+        for v in values:
+            if isinstance(v, str):
+                text.append(v)
+    return findIdentifiers(" ".join(text))
+
+def semanticScholarId(kind, id):
+    """
+    id as accepted by the semantic scholar paper endpoint
+    """
+    if kind == 'arxiv':
+        return "arXiv:%s" % id
+    return id
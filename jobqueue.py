@@ -0,0 +1,169 @@
+import logging
+import sqlite3
+import threading
+import json
+import time
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+
+class Deferred(Exception):
+    """
+    the job failed before and is not eligible again yet
+    """
+
+
+class JobQueue:
+    """
+    durable journal of remote lookups in a local sqlite db
+    every lookup of a run is recorded as a job (pending, running, done,
+    failed) before it is executed, results of finished jobs are served
+    from the db when the run is resumed
+    """
+    MAX_ATTEMPTS = 3
+    BACKOFF = 60
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                argv TEXT NOT NULL,
+                status TEXT NOT NULL,
+                started REAL NOT NULL,
+                finished REAL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                run INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                payload TEXT,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_eligible REAL NOT NULL DEFAULT 0,
+                result TEXT,
+                updated REAL NOT NULL,
+                PRIMARY KEY (run, kind, key))""")
+        # jobs of an interrupted run
+        self.db.execute("UPDATE jobs SET status='pending' WHERE status='running'")
+        self.run = None
+
+    def startRun(self, argv):
+        with self.lock:
+            cur = self.db.execute("INSERT INTO runs (argv, status, started) VALUES (?, 'running', ?)", (json.dumps(argv), time.time()))
+            self.run = cur.lastrowid
+        log.info("Started run %d", self.run)
+        return self.run
+
+    def resumeRun(self, run=None):
+        """
+        continue the given or the last unfinished run
+        returns its argv or None
+        """
+        with self.lock:
+            if run is None:
+                row = self.db.execute("SELECT id, argv FROM runs WHERE status != 'done' ORDER BY id DESC LIMIT 1").fetchone()
+            else:
+                row = self.db.execute("SELECT id, argv FROM runs WHERE id=?", (run,)).fetchone()
+        if row is None:
+            return None
+        self.run = row[0]
+        log.info("Resuming run %d: %d jobs done, %d pending", self.run, self.count('done'), self.count('pending'))
+        return json.loads(row[1])
+
+    def finishRun(self):
+        with self.lock:
+            self.db.execute("UPDATE runs SET status='done', finished=? WHERE id=?", (time.time(), self.run))
+
+    def count(self, status):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE run=? AND status=?", (self.run, status)).fetchone()[0]
+
+    def pending(self, kind=None):
+        """
+        (kind, key, payload) of all jobs that did not finish yet
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT kind, key, payload FROM jobs WHERE run=? AND status IN ('pending', 'running') ORDER BY updated", (self.run,)).fetchall()
+        return [(k, key, json.loads(p)) for k, key, p in rows if kind is None or k == kind]
+
+    def __get(self, kind, key):
+        with self.lock:
+            return self.db.execute("SELECT status, attempts, next_eligible, result FROM jobs WHERE run=? AND kind=? AND key=?", (self.run, kind, key)).fetchone()
+
+    def __set(self, kind, key, payload, status, attempts, next_eligible=0, result=None):
+        with self.lock:
+            self.db.execute("""INSERT OR REPLACE INTO jobs (run, kind, key, payload, status, attempts, next_eligible, result, updated)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""", (self.run, kind, key, payload, status, attempts, next_eligible, result, time.time()))
+
+    def isDone(self, kind, key):
+        row = self.__get(kind, key)
+        return row is not None and row[0] == 'done'
+
+    def result(self, kind, key):
+        """
+        stored result of a finished job, None if it did not finish
+        """
+        row = self.__get(kind, key)
+        if row is None or row[0] != 'done':
+            return None
+        return json.loads(row[3])
+
+    def execute(self, kind, key, fn, *args, backoff=False):
+        """
+        run fn(*args) as job (kind, key) of the current run
+        returns the stored result if the job already finished,
+        None if it failed MAX_ATTEMPTS times
+        raises Deferred if it failed before and is not eligible again yet,
+        only with backoff (resume, drain) it waits until it is eligible:
+        a run does not stall on a transient error
+        """
+        row = self.__get(kind, key)
+        attempts = 0
+        if row is not None:
+            status, attempts, next_eligible, result = row
+            if status == 'done':
+                metrics.cache('jobqueue', True)
+                log.debug("Job %s done: %s", kind, key)
+                return json.loads(result)
+            if status == 'failed':
+                log.warning("Job %s failed %d times, skipping: %s", kind, attempts, key)
+                return None
+            wait = next_eligible - time.time()
+            if wait > 0 and not backoff:
+                raise Deferred("Job %s not eligible for %ds: %s" % (kind, wait, key))
+            if wait > 0:
+                log.info("Job %s not eligible for %ds: %s", kind, wait, key)
+                metrics.wait(wait, 'backoff', kind)
+        metrics.cache('jobqueue', False)
+        payload = json.dumps(args)
+        self.__set(kind, key, payload, 'running', attempts + 1)
+        try:
+            res = fn(*args)
+        except (KeyboardInterrupt, SystemExit, metrics.Interrupted):
+            # interrupted, not the job's fault
+            self.__set(kind, key, payload, 'pending', attempts)
+            raise
+        except Exception as e:
+            status = 'failed' if attempts + 1 >= JobQueue.MAX_ATTEMPTS else 'pending'
+            self.__set(kind, key, payload, status, attempts + 1, time.time() + JobQueue.BACKOFF * 2 ** attempts)
+            log.warning("Job %s %s (attempt %d): %s", kind, status, attempts + 1, key)
+            raise
+        self.__set(kind, key, payload, 'done', attempts + 1, result=json.dumps(res))
+        return res
+
+    def drain(self, fns):
+        """
+        execute the unfinished jobs of the current run
+        fns: dict [kind] -> function, called with the stored arguments
+        """
+        for kind, key, payload in self.pending():
+            if kind not in fns.keys():
+                continue
+            try:
+                self.execute(kind, key, fns[kind], *payload, backoff=True)
+            except Exception as e:
+                log.error("Job %s failed: %s", kind, e)
@@ -0,0 +1,93 @@
+"""
+logging set up of the command line tools: one logger per module, the
+level is chosen on the command line (per module if needed), records can
+additionally be written as json lines for batch runs
+"""
+import logging
+import json
+
+FORMAT = "%(message)s"
+DEFAULT_LEVEL = "info"
+# chatty third party loggers, only shown if asked for by name
+QUIET = ['pdfminer', 'urllib3', 'requests', 'chardet', 'charset_normalizer']
+
+
+class LazyJson:
+    """
+    log argument which is only serialized if the record is emitted:
+    log.debug("refs: %s", LazyJson(refs))
+    """
+    def __init__(self, data, indent=2):
+        self.data = data
+        self.indent = indent
+
+    def __str__(self):
+        return json.dumps(self.data, indent=self.indent, default=str)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+                'time': record.created,
+                'level': record.levelname,
+                'logger': record.name,
+                'thread': record.threadName,
+                'message': record.getMessage(),
+                }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def parseLevels(spec):
+    """
+    "info" or "info,refextract=debug,zotapi=warning"
+    returns (root level, {logger: level})
+    """
+    root = logging.INFO
+    loggers = {}
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, level = part.rpartition('=')
+        value = logging.getLevelName(level.upper())
+        if not isinstance(value, int):
+            raise ValueError("Unknown log level '%s'" % level)
+        if name:
+            loggers[name] = value
+        else:
+            root = value
+    return root, loggers
+
+def setup(level=DEFAULT_LEVEL, json_path=None):
+    """
+    (re)configure the root logger, can be called again once the command
+    line is parsed
+    """
+    root_level, loggers = parseLevels(level)
+    root = logging.getLogger()
+    for h in [h for h in root.handlers if getattr(h, 'logconf', False)]:
+        root.removeHandler(h)
+        h.close()
+    handlers = [logging.StreamHandler()]
+    handlers[0].setFormatter(logging.Formatter(FORMAT))
+    if json_path:
+        handlers.append(logging.FileHandler(json_path))
+        handlers[1].setFormatter(JsonLinesFormatter())
+    for h in handlers:
+        h.logconf = True
+        root.addHandler(h)
+    root.setLevel(root_level)
+    for name in QUIET:
+        logging.getLogger(name).setLevel(max(root_level, logging.WARNING))
+    for name, value in loggers.items():
+        logging.getLogger(name).setLevel(value)
+
+def addLogArgs(parser):
+    parser.add_argument('--log-level', help='Log level, optionally per module: info,refextract=debug (default: %s)' % DEFAULT_LEVEL, default=DEFAULT_LEVEL, metavar='LEVELS')
+    parser.add_argument('--log-json', help='Also write the log records as json lines to FILE', metavar='FILE')
+    return parser
+
+def configure(args):
+    setup(args.log_level, args.log_json)
@@ -0,0 +1,362 @@
+"""
+run metrics: stage timers, cache hit rates, remote calls and sleeps
+collected in one process wide registry, written at the end of a run as
+json report and / or prometheus textfile.
+optionally stages are profiled (cProfile) and all stages, lookups, remote
+calls and waits are recorded as chrome trace (chrome://tracing, perfetto)
+"""
+import logging
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+from ratelimit import RateLimitException
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf')]
+# remote services by host
+SERVICES = {
+        'api.crossref.org': 'crossref',
+        'api.semanticscholar.org': 'semanticscholar',
+        'partner.semanticscholar.org': 'semanticscholar',
+        'api.zotero.org': 'zotero',
+        'localhost:23119': 'bbt',
+        '127.0.0.1:23119': 'bbt',
+        }
+
+
+class Interrupted(Exception):
+    """
+    a rate limit, retry or backoff wait was not slept: the thread must not
+    wait (hedged lookups) or its owner stopped it
+    """
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.json_path = None
+        self.prom_path = None
+        self.started = time.time()
+        self.stages = {}
+        self.caches = {}
+        self.http = {}
+        self.sleeps = {}
+
+    def stageTime(self, stage, seconds):
+        with self.lock:
+            s = self.stages.setdefault(stage, {'calls': 0, 'seconds': 0.0})
+            s['calls'] += 1
+            s['seconds'] += seconds
+
+    def cache(self, namespace, hit):
+        with self.lock:
+            c = self.caches.setdefault(namespace, {'hit': 0, 'miss': 0})
+            c['hit' if hit else 'miss'] += 1
+
+    def request(self, service, status, nbytes, seconds):
+        with self.lock:
+            h = self.http.setdefault(service, {'calls': 0, 'bytes': 0, 'status': {}, 'latency_sum': 0.0, 'latency_buckets': [0] * len(LATENCY_BUCKETS)})
+            h['calls'] += 1
+            h['bytes'] += nbytes
+            h['status'][str(status)] = h['status'].get(str(status), 0) + 1
+            h['latency_sum'] += seconds
+            for i, le in enumerate(LATENCY_BUCKETS):
+                if seconds <= le:
+                    h['latency_buckets'][i] += 1
+                    break
+
+    def sleep(self, kind, fn, seconds):
+        with self.lock:
+            s = self.sleeps.setdefault("%s:%s" % (kind, fn), {'kind': kind, 'fn': fn, 'count': 0, 'seconds': 0.0})
+            s['count'] += 1
+            s['seconds'] += seconds
+
+    def report(self):
+        with self.lock:
+            caches = {}
+            for ns, c in self.caches.items():
+                total = c['hit'] + c['miss']
+                caches[ns] = dict(c, hit_rate=c['hit'] / total if total else 0.0)
+            http = {}
+            for service, h in self.http.items():
+                buckets = dict(("%g" % le, n) for le, n in zip(LATENCY_BUCKETS, h['latency_buckets']))
+                http[service] = {'calls': h['calls'], 'bytes': h['bytes'], 'status': dict(h['status']),
+                        'latency_sum': h['latency_sum'], 'latency_buckets': buckets}
+            return {
+                    'wall_seconds': time.time() - self.started,
+                    'stages': json.loads(json.dumps(self.stages)),
+                    'cache': caches,
+                    'http': http,
+                    'sleep': list(json.loads(json.dumps(self.sleeps)).values()),
+                    }
+
+    def prometheus(self):
+        """
+        report in the prometheus text exposition format
+        """
+        r = self.report()
+        out = []
+        def metric(name, mtype, help, samples):
+            out.append("# HELP zotgraph_%s %s" % (name, help))
+            out.append("# TYPE zotgraph_%s %s" % (name, mtype))
+            for labels, value in samples:
+                lbl = ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+                out.append("zotgraph_%s{%s} %s" % (name, lbl, repr(float(value))))
+        metric('stage_seconds_total', 'counter', 'Time spent per stage', [((('stage', s),), v['seconds']) for s, v in r['stages'].items()])
+        metric('stage_calls_total', 'counter', 'Executions per stage', [((('stage', s),), v['calls']) for s, v in r['stages'].items()])
+        metric('cache_requests_total', 'counter', 'Cache lookups per namespace', [((('namespace', ns), ('result', res)), c[res]) for ns, c in r['cache'].items() for res in ['hit', 'miss']])
+        metric('http_requests_total', 'counter', 'Remote calls per service and status', [((('service', s), ('status', code)), n) for s, h in r['http'].items() for code, n in h['status'].items()])
+        metric('http_response_bytes_total', 'counter', 'Bytes received per service', [((('service', s),), h['bytes']) for s, h in r['http'].items()])
+        out.append("# HELP zotgraph_http_latency_seconds Latency of remote calls")
+        out.append("# TYPE zotgraph_http_latency_seconds histogram")
+        for s, h in r['http'].items():
+            cum = 0
+            for le, n in h['latency_buckets'].items():
+                cum += n
+                out.append('zotgraph_http_latency_seconds_bucket{service="%s",le="%s"} %d' % (s, "+Inf" if le == "inf" else le, cum))
+            out.append('zotgraph_http_latency_seconds_sum{service="%s"} %r' % (s, h['latency_sum']))
+            out.append('zotgraph_http_latency_seconds_count{service="%s"} %d' % (s, h['calls']))
+        metric('sleep_seconds_total', 'counter', 'Time blocked in rate limit and retry sleeps', [((('kind', s['kind']), ('fn', s['fn'])), s['seconds']) for s in r['sleep']])
+        return "\n".join(out) + "\n"
+
+    def setOutput(self, json_path=None, prom_path=None):
+        self.json_path = json_path
+        self.prom_path = prom_path
+
+    def write(self):
+        for path, text in [(self.json_path, lambda: json.dumps(self.report(), indent=2)), (self.prom_path, self.prometheus)]:
+            if not path:
+                continue
+            tmp = path + ".tmp"
+            with open(tmp, "w") as fd:
+                fd.write(text())
+            os.replace(tmp, path)
+            log.info("Wrote metrics to %s", path)
+
+
+class Profiler:
+    """
+    one cProfile per stage, accumulated over all executions of the stage
+    only one profile can be active at a time, nested stages are part of
+    the profile of the outer stage
+    """
+    STAGES = ['zotero_load', 'annot_parse', 'pdf_extract', 'anystyle', 'resolve', 'output']
+
+    def __init__(self, stages, outdir, clock='cpu'):
+        # only loaded when profiling
+        import cProfile
+        self.profile = cProfile.Profile
+        self.stages = set(stages)
+        self.outdir = outdir
+        # cpu time leaves out the time spent sleeping and waiting
+        self.timer = time.process_time if clock == 'cpu' else time.perf_counter
+        self.profiles = {}
+        self.active = None
+        self.lock = threading.Lock()
+
+    def start(self, name):
+        with self.lock:
+            if self.active is not None or not ('all' in self.stages or name in self.stages):
+                return None
+            if name not in self.profiles.keys():
+                self.profiles[name] = self.profile(self.timer)
+            self.active = name
+        prof = self.profiles[name]
+        prof.enable()
+        return prof
+
+    def stop(self, prof):
+        prof.disable()
+        with self.lock:
+            self.active = None
+
+    def write(self):
+        import pstats
+        os.makedirs(self.outdir, exist_ok=True)
+        for name, prof in self.profiles.items():
+            path = os.path.join(self.outdir, name)
+            prof.dump_stats(path + '.pstats')
+            with open(path + '.txt', 'w') as fd:
+                pstats.Stats(prof, stream=fd).sort_stats('cumulative').print_stats(50)
+            log.info("Wrote profile of %s to %s.pstats", name, path)
+
+
+class Trace:
+    """
+    chrome trace event format, complete events only
+    """
+    def __init__(self, path):
+        self.path = path
+        self.t0 = time.perf_counter()
+        self.events = []
+
+    def add(self, name, cat, start, end, args=None):
+        self.events.append({
+            'name': name, 'cat': cat, 'ph': 'X', 'pid': os.getpid(),
+            'tid': threading.get_ident(), 'ts': (start - self.t0) * 1e6,
+            'dur': (end - start) * 1e6, 'args': args or {},
+            })
+
+    def write(self):
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        meta = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': names.get(tid, str(tid))}}
+                for tid in set(e['tid'] for e in self.events)]
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fd:
+            json.dump({'traceEvents': meta + self.events, 'displayTimeUnit': 'ms'}, fd)
+        os.replace(tmp, self.path)
+        log.info("Wrote trace of %d events to %s", len(self.events), self.path)
+
+
+METRICS = Metrics()
+PROFILER = None
+TRACE = None
+# wait policy of the current thread, see waitPolicy
+LOCAL = threading.local()
+
+def configure(profile=None, profile_dir='./profile', profile_clock='cpu', trace=None):
+    """
+    profile: list of stage names (or 'all') to profile
+    trace: path of the chrome trace
+    """
+    global PROFILER, TRACE
+    if profile:
+        PROFILER = Profiler(profile, profile_dir, profile_clock)
+    if trace:
+        TRACE = Trace(trace)
+
+def finish():
+    METRICS.write()
+    if PROFILER is not None:
+        PROFILER.write()
+    if TRACE is not None:
+        TRACE.write()
+
+@contextlib.contextmanager
+def span(name, cat, **args):
+    if TRACE is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        TRACE.add(name, cat, t0, time.perf_counter(), args)
+
+def traceItems(items, name, cat='ref'):
+    """
+    yields the (key, value) items, the loop body of each item is one span
+    """
+    for item in items:
+        if TRACE is None:
+            yield item
+            continue
+        t0 = time.perf_counter()
+        try:
+            yield item
+        finally:
+            TRACE.add("%s %s" % (name, item[0]), cat, t0, time.perf_counter())
+
+@contextlib.contextmanager
+def stage(name):
+    prof = PROFILER.start(name) if PROFILER is not None else None
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        t1 = time.perf_counter()
+        if prof is not None:
+            PROFILER.stop(prof)
+        METRICS.stageTime(name, t1 - t0)
+        if TRACE is not None:
+            TRACE.add(name, 'stage', t0, t1)
+
+@contextlib.contextmanager
+def waitPolicy(nowait=False, stop=None):
+    """
+    waits of the current thread raise Interrupted instead of sleeping
+    (nowait) or as soon as stop (threading.Event) is set
+    """
+    old = getattr(LOCAL, 'policy', None)
+    LOCAL.policy = (nowait, stop)
+    try:
+        yield
+    finally:
+        LOCAL.policy = old
+
+def wait(seconds, kind, fn):
+    """
+    time.sleep, recorded as sleep metric and trace span
+    """
+    nowait, stop = getattr(LOCAL, 'policy', None) or (False, None)
+    if nowait:
+        raise Interrupted("%s %s: not waiting %.1fs" % (kind, fn, seconds))
+    METRICS.sleep(kind, fn, seconds)
+    with span("%s %s" % (kind, fn), 'wait', seconds=seconds):
+        if stop is None:
+            time.sleep(seconds)
+        elif stop.wait(seconds):
+            raise Interrupted("%s %s: stopped" % (kind, fn))
+
+def cache(namespace, hit):
+    METRICS.cache(namespace, hit)
+
+def sleep_and_retry(func):
+    """
+    ratelimit.sleep_and_retry which records the time slept
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kargs):
+        while True:
+            try:
+                return func(*args, **kargs)
+            except RateLimitException as exception:
+                wait(exception.period_remaining, 'ratelimit', func.__name__)
+    return wrapper
+
+def retrySleep(fn):
+    """
+    sleep= hook for tenacity.retry
+    """
+    def sleep(seconds):
+        wait(seconds, 'retry', fn)
+    return sleep
+
+def serviceOf(url):
+    host = urllib.parse.urlsplit(url).netloc.lower()
+    return SERVICES.get(host, host)
+
+def install():
+    """
+    count every request made through requests per remote service
+    wraps the current Session.request, so install it after httpreplay
+    """
+    import requests
+    orig = requests.Session.request
+    if getattr(orig, 'metrics', False):
+        return
+    def request(self, method, url, *args, **kwargs):
+        t0 = time.perf_counter()
+        status = 'error'
+        nbytes = 0
+        try:
+            r = orig(self, method, url, *args, **kwargs)
+            status = r.status_code
+            nbytes = len(r.content)
+            return r
+        finally:
+            t1 = time.perf_counter()
+            METRICS.request(serviceOf(url), status, nbytes, t1 - t0)
+            if TRACE is not None:
+                TRACE.add(serviceOf(url), 'http', t0, t1, {'url': url, 'status': status, 'bytes': nbytes})
+    request.metrics = True
+    requests.Session.request = request
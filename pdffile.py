@@ -0,0 +1,101 @@
+import logging
+import contextlib
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+
+log = logging.getLogger(__name__)
+
+# file systems which can change or vanish under a running extraction
+REMOTE_FS = set([
+    'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'afs', '9p', 'davfs',
+    'fuse.sshfs', 'fuse.rclone', 'fuse.gvfsd-fuse', 'fuse.s3fs',
+    'fuse.onedriver', 'fuse.google-drive-ocamlfuse',
+    ])
+# sync clients which replace files while they are read
+SYNC_DIRS = ['Dropbox', 'OneDrive', 'Google Drive', 'Nextcloud', 'ownCloud', 'Seafile', 'iCloud Drive']
+
+CHUNK = 1 << 20
+# (path, size, mtime_ns) -> sha1
+hashes = {}
+
+def mountType(path):
+    """
+    file system type of the mount holding path, None if unknown
+    """
+    path = os.path.realpath(path)
+    best = ('', None)
+    try:
+        with open('/proc/self/mounts', 'r') as fd:
+            for line in fd:
+                parts = line.split()
+                if len(parts) < 3:
+                    continue
+                mnt = parts[1].replace('\\040', ' ')
+                if (path == mnt or path.startswith(mnt.rstrip('/') + '/')) and len(mnt) > len(best[0]):
+                    best = (mnt, parts[2])
+    except OSError:
+        pass
+    return best[1]
+
+def isRemote(path):
+    if mountType(path) in REMOTE_FS:
+        return True
+    parts = os.path.realpath(path).split(os.sep)
+    return any(d in parts for d in SYNC_DIRS)
+
+def stampKey(path, st):
+    return (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+
+def contentHash(path):
+    """
+    sha1 of the file, read through mmap. this is a pass over the file of
+    its own, pdfminer and anystyle read it again. cached per (path, size,
+    mtime) so the manifest and the extraction hash it only once
+    """
+    st = os.stat(path)
+    key = stampKey(path, st)
+    if key in hashes:
+        return hashes[key]
+    h = hashlib.sha1()
+    if st.st_size > 0:
+        with open(path, 'rb') as fd, mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # hashed straight from the page cache, no copy
+            h.update(mm)
+    hashes[key] = h.hexdigest()
+    return hashes[key]
+
+def snapshot(path):
+    """
+    copy path to a unique temporary file, hashing while copying
+    """
+    st = os.stat(path)
+    fd, tmp = tempfile.mkstemp(prefix='zotgraph_', suffix='.pdf')
+    h = hashlib.sha1()
+    with open(path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+        for chunk in iter(lambda: src.read(CHUNK), b''):
+            h.update(chunk)
+            dst.write(chunk)
+    shutil.copystat(path, tmp)
+    hashes[stampKey(path, st)] = h.hexdigest()
+    return tmp, h.hexdigest()
+
+@contextlib.contextmanager
+def openPdf(path):
+    """
+    yields (path, sha1) of a pdf to process. local files are used in place
+    and hashed by contentHash, files on network or sync mounts are hashed
+    while they are snapshotted to a per-run temporary file which is removed
+    afterwards. pdfminer and anystyle open the yielded path themselves
+    """
+    if not isRemote(path):
+        yield path, contentHash(path)
+        return
+    tmp, digest = snapshot(path)
+    log.debug("Snapshot of %s (remote mount): %s", path, tmp)
+    try:
+        yield tmp, digest
+    finally:
+        os.remove(tmp)
@@ -0,0 +1,126 @@
+import logging
+import argparse
+import os
+
+from getDoi import addLibArgs, makeResolver, makeEstimate
+import logconf
+import metrics
+
+log = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    """
+    resolves all references of every pdf in the library into the caches,
+    so later runs on these papers are cache hits
+    every paper is a job of the prefetch queue: an interrupted prefetch
+    continues with the papers it did not finish, the lookups of the paper
+    it was working on are served from the queue
+    """
+    KIND = 'prefetch'
+
+    def __init__(self, args, jobs):
+        self.args = args
+        self.jobs = jobs
+        self.za, self.sm, self.refex = makeResolver(args, jobs)
+
+    def __annotTitles(self):
+        """
+        titles of the annotation files (as used by watch)
+        """
+        if not self.args.annotdir:
+            return set()
+        return set(os.path.splitext(name)[0].lower() for name in os.listdir(self.args.annotdir) if not name.startswith('.'))
+
+    def items(self):
+        """
+        (key, title, pdf path) of the library pdfs in prefetch order:
+        papers with annotation files first, then papers with notes in
+        zotero, newest first within each group
+        """
+        annotated = self.__annotTitles()
+        ranked = []
+        for key, title, added, pdfpath, has_notes in self.za.getPdfItems():
+            in_annot = isinstance(title, str) and title.lower() in annotated
+            ranked.append(((in_annot, has_notes, added), key, title, pdfpath))
+        ranked.sort(key=lambda t: t[0], reverse=True)
+        return [(key, title, pdfpath) for prio, key, title, pdfpath in ranked]
+
+    def __prefetch(self, key, title, pdfpath):
+        with metrics.stage('resolve'):
+            refs = self.refex.extractRefs(pdfpath, key, title, None)
+        resolved = len([r for r in refs.values() if r['ckey'] or r['url'] or r['doi']])
+        log.info("Prefetched %s: %d of %d references resolved", title, resolved, len(refs))
+        return {'refs': len(refs), 'resolved': resolved}
+
+    def __todo(self):
+        for key, title, pdfpath in self.items():
+            if self.jobs.isDone(Prefetcher.KIND, key):
+                continue
+            if not os.path.exists(pdfpath):
+                log.debug("Missing pdf of %s: %s", key, pdfpath)
+                continue
+            yield key, title, pdfpath
+
+    def run(self, limit=None):
+        """
+        returns True if all papers were prefetched, False if limit stopped it
+        """
+        # lookups which were pending when the last prefetch stopped
+        self.jobs.drain(self.refex.jobFns())
+        n = 0
+        complete = True
+        try:
+            for key, title, pdfpath in self.__todo():
+                if limit is not None and n >= limit:
+                    complete = False
+                    break
+                n += 1
+                try:
+                    self.jobs.execute(Prefetcher.KIND, key, self.__prefetch, key, title, pdfpath)
+                except Exception as e:
+                    log.error("Prefetch of %s failed: %s", pdfpath, e)
+        finally:
+            self.refex.close()
+        log.info("Prefetched %d papers", n)
+        return complete
+
+    def estimate(self, limit=None):
+        est = makeEstimate(self.args)
+        try:
+            for i, (key, title, pdfpath) in enumerate(self.__todo()):
+                if limit is not None and i >= limit:
+                    break
+                est.note()
+                try:
+                    self.refex.estimateRefs(pdfpath, key, title, None, est)
+                except Exception as e:
+                    log.error("Could not parse %s: %s", pdfpath, e)
+        finally:
+            self.refex.close()
+        est.log()
+        return est
+
+
+def prefetch(argv):
+    parser = argparse.ArgumentParser(description='Resolve the references of all pdfs in the library into the caches')
+    parser.add_argument('--queue', help='Job queue of the prefetch (sqlite), an unfinished prefetch is continued', default="./prefetch.sqlite")
+    parser.add_argument('--restart', help='Start over instead of continuing the last unfinished prefetch', action='store_true')
+    parser.add_argument('--annotdir', help='Directory of annotation files (as used by watch), their papers go first')
+    parser.add_argument('--limit', help='Stop after N papers', type=int, metavar='N')
+    parser.add_argument('--nice', help='Niceness of the prefetch process', type=int, default=10)
+    parser.add_argument('--dry-run', help='Only report the remote calls the prefetch would make (no network)', action='store_true')
+    args = addLibArgs(parser).parse_args(argv)
+    logconf.configure(args)
+    if args.nice and hasattr(os, 'nice'):
+        os.nice(args.nice)
+    from jobqueue import JobQueue
+    jobs = JobQueue(args.queue)
+    resumed = not args.restart and jobs.resumeRun() is not None
+    if args.dry_run:
+        Prefetcher(args, jobs).estimate(args.limit)
+        return
+    if not resumed:
+        jobs.startRun(['prefetch'] + argv)
+    if Prefetcher(args, jobs).run(args.limit):
+        jobs.finishRun()
@@ -2,41 +2,106 @@ import logging
 import subprocess
 import json
 import re
-import os
-import sys
-import urllib
-import tempfile
-import shutil
-import hashlib
-from bs4 import BeautifulSoup
+import shlex
+import time
+import threading
+import concurrent.futures
+import requests
 from datetime import timedelta
-from ratelimit import limits, sleep_and_retry
-from fuzzywuzzy import fuzz
-from fuzzywuzzy import process
-from crossref.restful import Works, Etiquette
-from pdfminer.high_level import extract_text
+from ratelimit import limits
+from authoryear import AuthorYearIndex, P_YEAR, normName
+from identifiers import findIdentifiers, findIdentifiersAny, semanticScholarId
+from citeindex import CiteIndex
+from pdffile import openPdf
+from filecache import ShardedCache
+from jobqueue import Deferred
+from dryrun import DryLookups
+import metrics
 import tenacity
+from logconf import LazyJson
+import textnorm
+
+log = logging.getLogger(__name__)
+
+# a remote lookup which did not answer, counted as miss and not cached
+REMOTE_ERRORS = (tenacity.RetryError, ConnectionRefusedError, requests.RequestException, Deferred)
+
+class Lookups:
+    """
+    remote lookups of a run, through the job queue (if any) so an
+    interrupted run can be resumed without repeating them.
+    estimateRefs walks the same lookups with dryrun.DryLookups
+    """
+    dry = False
+
+    def __init__(self, jobs=None):
+        self.jobs = jobs
+
+    def ref(self, refid):
+        pass
+
+    def remote(self, kind, key, default, fn, *args):
+        with metrics.span(kind, 'lookup', key=key):
+            if self.jobs is None:
+                return fn(*args)
+            res = self.jobs.execute(kind, key, fn, *args)
+        if res is None:
+            return default
+        return res
+
+def pdfText(pdfpath):
+    # pdfminer is only loaded once a pdf has to be parsed
+    from pdfminer.high_level import extract_text
+    return extract_text(pdfpath)
 
 class RefExtract:
     MIN_TITLE_LEN = 16
     MIN_TKS_RATIO = 80
     MIN_RATIO = 80
-
-    def __init__(self, sm, za, anystyle, cache_by_title="./cache_by_title", cache_by_cite="./cache_by_cite", refstart="References", refstop="Appendix"):
+    CR_API_URL = 'https://api.crossref.org/works'
+    # all we read from a crossref work, and the number of candidates we score
+    CR_SELECT = 'DOI,title,URL,link,author,issued'
+    CR_ROWS = 5
+    CR_TIMEOUT = 60
+    # polite pool: one request every 10 seconds
+    CR_RATE_CALLS = 1
+    CR_RATE_PERIOD = timedelta(seconds=10).total_seconds()
+    # title candidates of one anystyle reference which may go remote
+    MAX_REMOTE_CANDIDATES = 2
+    # seconds the first source has before the others are asked along
+    HEDGE_DELAY = 2.0
+
+    def __init__(self, sm, za, anystyle, cache_by_title="./cache_by_title", cache_by_cite="./cache_by_cite", refstart="References", refstop="Appendix", crossref_slim=True, hedge=True, jobs=None):
         self.sm = sm
         self.za = za
         self.anystyle = anystyle
         self.refstart = refstart
         self.refstop = refstop
         self.refstop2 = "additional results"
+        from crossref.restful import Works, Etiquette
         etq = Etiquette('Replace citations with zotero betterbibtex keys', 'v0.1', 'no url just testing', 'felicitashetzelt@gmail.com')
         self.cache_by_title = cache_by_title
-        if not os.path.isdir(self.cache_by_title):
-            os.mkdir(self.cache_by_title)
+        self.title_cache = ShardedCache(cache_by_title, ['zaitem', 'smitem', 'critem', 'ckey'], name='title')
         self.cache_by_cite = cache_by_cite
-        if not os.path.isdir(self.cache_by_cite):
-            os.mkdir(self.cache_by_cite)
+        self.cite_cache = ShardedCache(cache_by_cite, ['crossref', 'smitem'], flat_hashed=True, name='cite')
+        self.etq = etq
         self.works = Works(etq)
+        self.crossref_slim = crossref_slim
+        # one worker per source, queued lookups can still be cancelled,
+        # waits of running ones end on close
+        self.hedge = hedge
+        self.stopped = threading.Event()
+        self.pools = {}
+        if self.hedge:
+            for source in ['zotero', 'semanticscholar', 'crossref']:
+                self.pools[source] = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=source)
+        self.jobs = jobs
+        self.lookups = Lookups(jobs)
+        self.partial_text = {}
+        self.partial_any = {}
+        self.ayindex = {}
+        self.pdfhash = None
+        self.citeindex = CiteIndex(self.cache_by_cite)
 
     def __emptyRef(self):
         return {
@@ -48,82 +113,34 @@ class RefExtract:
                     }
 
 
-    def __makeCiteFn(self, cite):
-        cite = cite.lower()
-        cite = re.sub('[\W_]+', '', cite)
-        return os.path.join(self.cache_by_cite, hashlib.md5(cite.encode()).hexdigest())
-
     def __updateCachedCite(self, cite, key, data):
         '''
         keys are: crossref, smitem
         '''
-        if not data:
+        # a dry run only knows the defaults of the lookups it did not make
+        if not data or self.lookups.dry:
             return
-        fn = self.__makeCiteFn(cite)
-        logging.debug("Updating cite cache: %s" % fn)
-        old_data = {
-                'crossref': {},
-                'smitem': {},
-                }
-        if os.path.exists(fn):
-            try:
-                old_data = json.loads(open(fn, "r").read())
-            except:
-                pass
-        old_data[key] = data
-        open(fn, "w").write(json.dumps(old_data, indent=2))
+        self.cite_cache.update(cite, key, data)
 
     def __readCachedCite(self, cite, key):
         '''
         keys are: crossref
         '''
-        fn = self.__makeCiteFn(cite)
-        try:
-            logging.debug("Reading cached data for %s from %s" % (key, fn))
-            return json.loads(open(fn, "r").read())[key]
-        except:
-            pass
-        return {}
-
-    def __makeTitleFn(self, title):
-        title = title.lower()
-        title = re.sub('[\W_]+', '', title)
-        return os.path.join(self.cache_by_title, title)
+        return self.cite_cache.read(cite, key)
 
     def __updateCachedTitle(self, title, key, data):
         '''
         keys are: zaitem, smitem, critem, ckey
         '''
-        if not data:
+        if not data or self.lookups.dry:
             return
-        fn = self.__makeTitleFn(title)
-        logging.debug("Updating title cache: %s" % fn)
-        old_data = {
-                'zaitem': {},
-                'smitem': {},
-                'critem': {},
-                'ckey': {},
-                }
-        if os.path.exists(fn):
-            try:
-                old_data = json.loads(open(fn, "r").read())
-            except:
-                pass
-        old_data[key] = data
-        open(fn, "w").write(json.dumps(old_data, indent=2))
-
+        self.title_cache.update(title, key, data)
 
     def __readCachedTitle(self, title, key):
         '''
         keys are: zaitem, smitem, critem, ckey
         '''
-        fn = self.__makeTitleFn(title)
-        try:
-            logging.debug("Reading cached data for %s from %s" % (key, fn))
-            return json.loads(open(fn, "r").read())[key]
-        except:
-            pass
-        return {}
+        return self.title_cache.read(title, key)
 
     def __brokenCite(self, title):
         title = title.lower()
@@ -135,54 +152,39 @@ class RefExtract:
 
     def __matchCite(self, title='', cite=''):
         if len(title) < RefExtract.MIN_TITLE_LEN:
-            logging.info("Title too short for cite matching: %s" % title)
+            log.info("Title too short for cite matching: %s", title)
             return False
         if self.__brokenCite(title):
-            logging.info("Title probably broken: %s" % title)
+            log.info("Title probably broken: %s", title)
             return False
 
         # Efficient software-based fault isolation
         # Efﬁcient Software-based Fault Iso-lation
-        # match ratio: 67 :(
-        title = title.replace('-', '')
-        # NOT THE SAME CHAR!
-        title = title.replace('-', '')
-        cite = cite.replace('-', '')
-        cite = cite.replace('-', '')
-        r = fuzz.token_set_ratio(title.lower(), cite.lower())
-        logging.debug("Matched cite ratio %d:\n---\n%s\n---\n%s\n---\n" % (r, title, cite))
+        # ligatures and hyphens are folded by textnorm
+        r = textnorm.citeRatio(title, cite)
+        log.debug("Matched cite ratio %d:\n---\n%s\n---\n%s\n---\n", r, title, cite)
         if r > RefExtract.MIN_TKS_RATIO:
             return True
         return False
 
     def __matchTitle(self, t0, t1):
-        t0 = t0.lower()
-        t0 = re.sub('[\W_]+', '', t0)
-        t1 = t1.lower()
-        t1 = re.sub('[\W_]+', '', t1)
-        # Efficient software-based fault isolation
-        # Efﬁcient Software-based Fault Iso-lation
-        # match ratio: 67 :(
-        t0 = t0.replace('-', '')
-        # NOT THE SAME CHAR!
-        t0 = t0.replace('-', '')
-        t1 = t1.replace('-', '')
-        t1 = t1.replace('-', '')
-        r = fuzz.ratio(t0.lower(), t1.lower())
-        logging.debug("Matched title ratio %d:\n---\n%s\n---\n%s\n---\n" % (r, t0, t1))
+        r = textnorm.titleRatio(t0, t1)
+        log.debug("Matched title ratio %d:\n---\n%s\n---\n%s\n---\n", r, t0, t1)
         if r > RefExtract.MIN_RATIO:
             return True
         return False
 
-    @sleep_and_retry
-    @limits(calls=1, period=timedelta(seconds=10).total_seconds())
+    @metrics.sleep_and_retry
+    @limits(calls=CR_RATE_CALLS, period=CR_RATE_PERIOD)
     def __queryCrossRef(self, cite):
-        logging.info("Searching Crossref:\n%s\n" % cite)
+        log.info("Searching Crossref:\n%s\n", cite)
+        if self.crossref_slim:
+            return self.__queryCrossRefSlim(cite)
         data = {"NODATA": "NOCROSSREF"}
         crossrefs = self.works.query(bibliographic=cite)
         for cr_i, cr in enumerate(crossrefs):
             if cr_i > 4:
-                logging.info("Max CrossRef tries reached")
+                log.info("Max CrossRef tries reached")
                 break
             if 'title' in cr.keys():
                 title = cr['title'][0]
@@ -192,13 +194,77 @@ class RefExtract:
                 break
         return data
 
+    def __remote(self, kind, key, default, fn, *args):
+        """
+        every remote lookup goes through self.lookups
+        """
+        return self.lookups.remote(kind, key, default, fn, *args)
+
+    def jobFns(self):
+        """
+        functions executing the jobs of the job queue, by kind
+        """
+        return {
+                'crossref': self.__queryCrossRef,
+                'smsearch': self.sm.searchTitle,
+                'smpaper': self.sm.paper,
+                'zaitem': self.za.findItem,
+                'zakey': self.za.getItemByKey,
+                'ckey': self.za.getCiteKey,
+                }
+
+    def __queryCrossRefSlim(self, cite):
+        """
+        only request the fields we read and the candidates we score,
+        score all candidates with one rapidfuzz call
+        """
+        params = {
+                'query.bibliographic': cite,
+                'select': RefExtract.CR_SELECT,
+                'rows': RefExtract.CR_ROWS,
+                'mailto': self.etq.contact_email,
+                }
+        r = requests.get(RefExtract.CR_API_URL, params=params, headers={'User-Agent': str(self.etq)}, timeout=RefExtract.CR_TIMEOUT)
+        r.raise_for_status()
+        items = r.json()['message']['items']
+        best = self.__bestCite(cite, [cr['title'][0] if cr.get('title') else '' for cr in items])
+        if best is None:
+            return {"NODATA": "NOCROSSREF"}
+        return items[best]
+
+    def __bestCite(self, cite, titles):
+        """
+        vectorized __matchCite: index of the best title matching cite or None
+        """
+        choices = {}
+        for i, title in enumerate(titles):
+            if len(title) < RefExtract.MIN_TITLE_LEN or self.__brokenCite(title):
+                continue
+            choices[i] = title
+        match = textnorm.bestMatch(cite, choices, 'cite', RefExtract.MIN_TKS_RATIO)
+        if match is None or match[1] <= RefExtract.MIN_TKS_RATIO:
+            return None
+        log.debug("Matched cite ratio %d:\n---\n%s\n---\n%s\n---\n", match[1], titles[match[2]], cite)
+        return match[2]
+
     def __findCrossRef(self, cite):
         cr_data = self.__readCachedCite(cite, 'crossref')
         if cr_data:
-            logging.debug("Using cached crossref data")
+            log.debug("Using cached crossref data")
             return cr_data
-        data = self.__queryCrossRef(cite)
+        cr_data = self.citeindex.find(cite, 'crossref')
+        if cr_data.get('title') and self.__matchCite(title=cr_data['title'][0], cite=cite):
+            log.debug("Using crossref data of near-duplicate cite")
+            self.__updateCachedCite(cite, 'crossref', cr_data)
+            return cr_data
+        try:
+            data = self.__remote('crossref', cite, {"NODATA": "NOCROSSREF"}, self.__queryCrossRef, cite)
+        except REMOTE_ERRORS as e:
+            log.warning("Crossref issues on cite %s: %s", cite, e)
+            return {"NODATA": "NOCROSSREF"}
         self.__updateCachedCite(cite, 'crossref', data)
+        if 'DOI' in data.keys():
+            self.citeindex.add(cite, data['DOI'], 'crossref', data)
         return data
 
     def __makeRefSemanticScholar(self, smitem):
@@ -215,21 +281,28 @@ class RefExtract:
         ref = self.__emptyRef()
         smitem = self.__readCachedCite(cite, 'smitem')
         if smitem:
-            logging.debug("Using cached semantic scholar data")
+            log.debug("Using cached semantic scholar data")
+            return self.__makeRefSemanticScholar(smitem)
+        smitem = self.citeindex.find(cite, 'smitem')
+        if smitem.get('title') and self.__matchCite(title=smitem['title'], cite=cite):
+            log.debug("Using semantic scholar data of near-duplicate cite")
+            self.__updateCachedCite(cite, 'smitem', smitem)
             return self.__makeRefSemanticScholar(smitem)
         try:
-            sm_data = self.sm.searchTitle(cite)
+            sm_data = self.__remote('smsearch', cite, {}, self.sm.searchTitle, cite)
             smitem = {"NODATA": "NOSEMANTICSCHOLAR"}
             if "data" in sm_data.keys():
                 for sm_entry in sm_data["data"]:
                     if self.__matchCite(cite=cite, title=sm_entry["title"]):
-                        smitem = self.sm.paper(sm_entry['paperId'])
+                        smitem = self.__remote('smpaper', sm_entry['paperId'], {}, self.sm.paper, sm_entry['paperId'])
                         break
             #logging.warn("Failed to find Zotero entry for %s" % title)
             self.__updateCachedCite(cite, 'smitem', smitem)
+            if 'paperId' in smitem.keys():
+                self.citeindex.add(cite, smitem.get('doi') or smitem['paperId'], 'smitem', smitem)
             return self.__makeRefSemanticScholar(smitem)
-        except tenacity.RetryError or ConnectionRefusedError:
-            logging.warn("Semantic Scholar issues on cite %s" % cite)
+        except REMOTE_ERRORS as e:
+            log.warning("Semantic Scholar issues on cite %s: %s", cite, e)
         smitem = {"NODATA": "NOSEMANTICSCHOLAR"}
         return self.__makeRefSemanticScholar(smitem)
 
@@ -238,36 +311,39 @@ class RefExtract:
         ref = self.__emptyRef()
         smitem = self.__readCachedTitle(title, 'smitem')
         if smitem:
-            logging.debug("Using cached semantic scholar data")
+            log.debug("Using cached semantic scholar data")
             return self.__makeRefSemanticScholar(smitem)
         try:
-            sm_data = self.sm.searchTitle(title)
+            sm_data = self.__remote('smsearch', title, {}, self.sm.searchTitle, title)
             smitem = {"NODATA": "NOSEMANTICSCHOLAR"}
             try:
                 for sm_entry in sm_data["data"]:
                     if self.__matchTitle(title, sm_entry["title"]):
-                        smitem = self.sm.paper(sm_entry['paperId'])
+                        smitem = self.__remote('smpaper', sm_entry['paperId'], {}, self.sm.paper, sm_entry['paperId'])
                         break
+            except (metrics.Interrupted,) + REMOTE_ERRORS:
+                raise
             except Exception as e:
-                logging.warn("Error sm searchTitle")
-                logging.warn(e)
+                log.warning("Error sm searchTitle")
+                log.warning(e)
             #logging.warn("Failed to find Zotero entry for %s" % title)
             self.__updateCachedTitle(title, 'smitem', smitem)
             return self.__makeRefSemanticScholar(smitem)
-        except tenacity.RetryError or ConnectionRefusedError:
-            logging.warn("Semantic Scholar issues on title %s" % title)
+        except REMOTE_ERRORS as e:
+            log.warning("Semantic Scholar issues on title %s: %s", title, e)
         smitem = {"NODATA": "NOSEMANTICSCHOLAR"}
         return self.__makeRefSemanticScholar(smitem)
 
     def __makeRefZotero(self, zaitem):
         ref = self.__emptyRef()
         try:
-            ref['ckey'] = self.za.getCiteKey(zaitem['key'])
+            ref['ckey'] = self.__remote('ckey', zaitem['key'], None, self.za.getCiteKey, zaitem['key'])
             ref['title'] = zaitem['data']['title']
         except Exception as e:
-            logging.error("Failed to get info for existing zotero item: %s" % str(e))
-            logging.error(json.dumps(zaitem, indent=2))
-            sys.exit(1)
+            # used to exit, which made interrupted runs impossible to resume
+            log.error("Failed to get info for existing zotero item: %s", str(e))
+            log.error("%s", LazyJson(zaitem))
+            return self.__emptyRef()
         try:
             ref['doi'] = "https://doi.org/%s" % zaitem['data']['doi']
         except:
@@ -283,26 +359,113 @@ class RefExtract:
     def __findZotero(self, title):
         zaitem = self.__readCachedTitle(title, 'zaitem')
         if zaitem:
-            logging.debug("Using cached semantic scholar data")
+            log.debug("Using cached semantic scholar data")
             return self.__makeRefZotero(zaitem)
         try:
-            zaitem = self.za.findItem(title=title)[0]
+            zaitem = self.__remote('zaitem', title, [], self.za.findItem, None, None, title)[0]
         except:
-            logging.warn("Failed to find Zotero entry for %s" % title)
+            log.warning("Failed to find Zotero entry for %s", title)
             return self.__emptyRef()
         self.__updateCachedTitle(title, 'zaitem', zaitem)
         return self.__makeRefZotero(zaitem)
 
+    def __hedge(self, calls, accept):
+        """
+        calls: list of (source, fn, args) in priority order
+        take the first result (in priority order) that passes accept.
+        the other calls are only sent along if the first one takes longer
+        than HEDGE_DELAY, these hedges never wait for a rate limit (they are
+        asked again if needed) and are cancelled if they did not start yet.
+        without a hedge (and in a dry run) the calls are made one after the other
+        returns (results, best, late): results is aligned with calls (None if
+        not available), best the index of the accepted result or None,
+        late the futures still running
+        """
+        results = [None] * len(calls)
+        if not self.hedge or self.lookups.dry:
+            for i, (source, fn, args) in enumerate(calls):
+                try:
+                    results[i] = fn(*args)
+                except Exception as e:
+                    log.warning("Lookup on %s failed: %s", source, e)
+                    continue
+                if accept(results[i]):
+                    return results, i, []
+            return results, None, []
+        futures = [self.__submit(calls[0], False)]
+        done, _ = concurrent.futures.wait(futures, timeout=RefExtract.HEDGE_DELAY)
+        if not done:
+            futures += [self.__submit(call, True) for call in calls[1:]]
+        for i, (source, fn, args) in enumerate(calls):
+            try:
+                results[i] = self.__result(futures[i] if i < len(futures) else None, source, fn, args)
+            except Exception as e:
+                log.warning("Lookup on %s failed: %s", source, e)
+                continue
+            if accept(results[i]):
+                late = [f for f in futures[i + 1:] if not f.cancel()]
+                return results, i, late
+        return results, None, []
+
+    def __submit(self, call, nowait):
+        source, fn, args = call
+        return self.pools[source].submit(self.__pooled, nowait, fn, *args)
+
+    def __pooled(self, nowait, fn, *args):
+        with metrics.waitPolicy(nowait, self.stopped):
+            return fn(*args)
+
+    def __result(self, fut, source, fn, args):
+        """
+        result of a submitted call, calls which were not sent or would have
+        waited for a rate limit are made now
+        """
+        if fut is not None:
+            try:
+                with metrics.span("wait %s" % source, 'wait'):
+                    return fut.result()
+            except metrics.Interrupted as e:
+                log.debug("Hedged lookup on %s skipped (%s), asking now", source, e)
+        return fn(*args)
+
+    def __fillLate(self, ref, futures):
+        """
+        fill missing doi / url of ref once lower priority lookups finish
+        """
+        def fill(fut):
+            if fut.cancelled() or fut.exception() is not None:
+                return
+            late = fut.result()
+            for key in ['doi', 'url']:
+                if late[key] and not ref[key]:
+                    log.debug("Late %s: %s", key, late[key])
+                    ref[key] = late[key]
+        for fut in futures:
+            fut.add_done_callback(fill)
+
+    def close(self):
+        """
+        cancels queued lookups, running ones stop at their next wait
+        """
+        self.stopped.set()
+        for pool in self.pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+
     def __searchTitleSmZa(self, title):
         if len(title) < RefExtract.MIN_TITLE_LEN:
-            logging.warn("Skipping potentially broken title: \"%s\"" % title)
+            log.warning("Skipping potentially broken title: \"%s\"", title)
             return self.__emptyRef()
-        ref_za = self.__findZotero(title)
-        # just don't even try sm if za is already found
-        if ref_za['title']:
-            logging.warn("Found ZA: %s" % ref_za['title'])
+        calls = [('zotero', self.__findZotero, (title,))]
+        # don't even try sm if za is already known
+        if not self.__readCachedTitle(title, 'zaitem'):
+            calls.append(('semanticscholar', self.__findSemanticScholar, (title,)))
+        results, best, late = self.__hedge(calls, lambda ref: ref['title'])
+        ref_za = results[0] or self.__emptyRef()
+        if best == 0:
+            log.warning("Found ZA: %s", ref_za['title'])
+            self.__fillLate(ref_za, late)
             return ref_za
-        ref_sm = self.__findSemanticScholar(title)
+        ref_sm = results[-1] or self.__emptyRef()
 
         if ref_sm['title'] and not ref_za['title']:
             ref_za['title'] = ref_sm['title']
@@ -318,23 +481,61 @@ class RefExtract:
 
         return ref_za
 
-    def create_temporary_copy(self, path):
-        temp_dir = tempfile.gettempdir()
-        temp_path = os.path.join(temp_dir, 'zotgraph_tmp.pdf')
-        shutil.copy2(path, temp_path)
-        return temp_path
+    def __findZoteroDOI(self, doi):
+        keys = self.za.getItemIdByDOI(doi)
+        if len(keys) != 1:
+            return self.__emptyRef()
+        try:
+            zaitem = self.__remote('zakey', keys[0], [], self.za.getItemByKey, keys[0])[0]
+        except Exception as e:
+            log.warning("Failed to get Zotero item %s: %s", keys[0], e)
+            return self.__emptyRef()
+        return self.__makeRefZotero(zaitem)
+
+    def __findIdentifier(self, ids):
+        """
+        resolve identifiers found in a cite with direct lookups
+        (zotero by doi, semantic scholar by doi / arxiv id)
+        instead of a (throttled) bibliographic search
+        """
+        for kind, id in ids:
+            log.info("Found identifier %s: %s", kind, id)
+            if kind == 'doi':
+                ref = self.__findZoteroDOI(id)
+                if ref['title']:
+                    log.info("Found ZA by doi: %s", ref['title'])
+                    return ref
+            try:
+                smitem = self.__remote('smpaper', semanticScholarId(kind, id), {}, self.sm.paper, semanticScholarId(kind, id))
+            except REMOTE_ERRORS as e:
+                log.warning("Semantic Scholar issues on %s %s: %s", kind, id, e)
+                continue
+            ref = self.__makeRefSemanticScholar(smitem)
+            if not ref['title']:
+                continue
+            log.info("Found SM by %s: %s", kind, ref['title'])
+            # the paper might still be in zotero under its title
+            ref_za = self.__findZotero(ref['title'])
+            if ref_za['title']:
+                ref = ref_za
+            if kind == 'doi' and not ref['doi']:
+                ref['doi'] = "https://doi.org/%s" % id
+            return ref
+        return self.__emptyRef()
 
     def __getRefsAnystlye(self, pdfpath):
-        cmd = '%s -f json find --no-layout %s -' % (self.anystyle, pdfpath)
-        logging.debug("Executing: %s" % cmd)
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        out = p.communicate()[0]
+        cmd = '%s -f json find --no-layout %s -' % (self.anystyle, shlex.quote(pdfpath))
+        log.debug("Executing: %s", cmd)
+        with metrics.stage('anystyle'):
+            p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+            out = p.communicate()[0]
         refs = json.loads(out.decode('utf-8'))
         return refs
 
     def __getRefsCrossRef(self, zakey):
         # TODO
-        logging.debug("Searching Crossref for target")
+        log.debug("Searching Crossref for target")
+        from bs4 import BeautifulSoup
         apa_html = self.za.getApa(zaKey)[0]
         apa = BeautifulSoup(apa_html, features="lxml").get_text()
         cr = self.__findCrossRef(apa)
@@ -355,9 +556,9 @@ class RefExtract:
             except:
                 continue
         if year > 0:
-            logging.debug("Found year: %d" % year)
+            log.debug("Found year: %d", year)
         else:
-            logging.error("Failed to parse year: %s" % ref)
+            log.error("Failed to parse year: %s", ref)
         return year
 
     def __parseRefAuthor(self, ref):
@@ -377,9 +578,9 @@ class RefExtract:
                 auth = m_auth[0][0]
                 break
         if auth:
-            logging.debug("Found Authors: %s" % auth)
+            log.debug("Found Authors: %s", auth)
         else:
-            logging.error("Failed to parse authors: %s" % ref)
+            log.error("Failed to parse authors: %s", ref)
         return auth
 
     def __refTextToKey(self, ref):
@@ -389,11 +590,11 @@ class RefExtract:
         extract authors and year
         returns citekey: Johnson 2016 (or et. al ... if there are more authors)
         """
-        logging.debug("Parse ref: %s" % ref)
+        log.debug("Parse ref: %s", ref)
         auth = self.__parseRefAuthor(ref)
         year = self.__parseRefYear(ref)
         if not auth or year == 0:
-            logging.error("Failed to parse ref: %s" % ref)
+            log.error("Failed to parse ref: %s", ref)
         try:
             parts_auth = auth.split(",")
             if len(parts_auth) == 1:
@@ -402,8 +603,8 @@ class RefExtract:
                 return " and ".join(map(lambda t: t.lstrip().rstrip().split(' ')[-1], parts_auth)) + " " + year
             return parts_auth[0].lstrip().rstrip().split(' ')[-1] + " et al. " + str(year)
         except Exception as e:
-            logging.error(e)
-            logging.error("Failed to extract authors from: %s" % auth)
+            log.error(e)
+            log.error("Failed to extract authors from: %s", auth)
             return "BrokenRef"
 
     def __getReferences(self, pdfpath):
@@ -413,9 +614,12 @@ class RefExtract:
         split extracted text at '[\d+]'
         returns dict [refid] -> citation line
         """
+        with metrics.stage('pdf_extract'):
+            text = pdfText(pdfpath)
+        return self.__parseReferences(text)
+
+    def __parseReferences(self, text):
         P_MATCH_REFIDX = re.compile('\[(\d+)\]')
-        logging.getLogger("pdfminer").setLevel(logging.WARNING)
-        text = extract_text(pdfpath)
         lines = text.split('\n')
         started = False
         reftext = ""
@@ -428,10 +632,15 @@ class RefExtract:
                 started = True
             if started:
                 #logging.debug(line)
-                reftext += line
+                # only hyphenation joins lines, a doi at the end of a line
+                # must not run into the next word
+                if reftext.endswith('-'):
+                    reftext = reftext[:-1] + line
+                else:
+                    reftext += " " + line
             if started and (self.refstop.lower() in line.lower() or self.refstop2.lower() in line.lower()):
                 break
-        logging.debug("REFTEXT: %s" % reftext)
+        log.debug("REFTEXT: %s", reftext)
         reflines = re.split('(\[\d+\])', reftext)
         i=0
         refs = {}
@@ -442,28 +651,105 @@ class RefExtract:
             #logging.debug(m)
             #if line.startswith('['):
             if m:
-                refs[int(m.groups()[0])] = reflines[i+1]
+                refs[int(m.groups()[0])] = reflines[i+1].strip()
                 i+=1
             i+=1
-        logging.debug(json.dumps(refs, indent=2))
+        log.debug("%s", LazyJson(refs))
+        return refs
+
+    def __isAuthorYear(self, refkeys):
+        return any(isinstance(k, str) for k in refkeys)
+
+    def __getReferencesAuthorYear(self, pdfpath):
+        """
+        scan pdf text for the reference section (starting at 'References')
+        split at blank lines, or at lines starting with a capital letter
+        once the current entry has a year and ends with '.'
+        returns dict [refid] -> citation line, refids are list positions
+        """
+        with metrics.stage('pdf_extract'):
+            text = pdfText(pdfpath)
+        return self.__parseReferencesAuthorYear(text)
+
+    def __parseReferencesAuthorYear(self, text):
+        lines = text.split('\n')
+        started = False
+        refs = {}
+        ref = ""
+        for line in lines:
+            line = line.strip()
+            if not started:
+                if line.lower() == self.refstart.lower():
+                    started = True
+                continue
+            if self.refstop.lower() in line.lower() or self.refstop2.lower() in line.lower():
+                break
+            if not line or (ref and P_YEAR.search(ref) and ref.endswith('.') and line[0].isupper()):
+                if ref:
+                    refs[len(refs)] = ref
+                ref = ""
+            if not line:
+                continue
+            if ref.endswith('-'):
+                ref = ref[:-1] + line
+            else:
+                ref = (ref + " " + line).lstrip()
+        if ref:
+            refs[len(refs)] = ref
+        log.debug("%s", LazyJson(refs))
+        return refs
+
+    def __getAuthorYearIndex(self, pdfpath):
+        # keyed by content, the same pdf may be processed from different paths
+        if self.pdfhash not in self.ayindex:
+            pdf_refs = self.__getReferencesAuthorYear(pdfpath)
+            self.ayindex[self.pdfhash] = (AuthorYearIndex.fromRefs(pdf_refs), pdf_refs)
+        return self.ayindex[self.pdfhash]
+
+    def __getRefsAuthorYear(self, pdfpath, refkeys):
+        index, pdf_refs = self.__getAuthorYearIndex(pdfpath)
+        refs = {}
+        for rkey in refkeys:
+            rid = index.lookup(rkey)
+            if rid is None:
+                log.error("Could not resolve author-year ref: %s", rkey)
+                continue
+            refs[rkey] = pdf_refs[rid]
+            log.debug("Text Reference: %s -> %s", rkey, pdf_refs[rid])
+        return refs
+
+    def __textRefs(self, pdfpath, refkeys):
+        """
+        returns dict [refkey] -> citation line of the cited references,
+        of all references if refkeys is None
+        """
+        if refkeys is None:
+            with metrics.stage('pdf_extract'):
+                text = pdfText(pdfpath)
+            refs = self.__parseReferences(text)
+            if not refs:
+                # no numbered references, author-year refs are keyed by position
+                refs = self.__parseReferencesAuthorYear(text)
+            return refs
+        refs = {}
+        log.debug("Refkeys: %s", ", ".join(map(lambda t: "%s" % t, refkeys)))
+        if self.__isAuthorYear(refkeys):
+            refs = self.__getRefsAuthorYear(pdfpath, refkeys)
+        else:
+            pdf_refs = self.__getReferences(pdfpath)
+            for rid, rtext in pdf_refs.items():
+                if int(rid) not in refkeys:
+                    log.debug("Skip rid %s", rid)
+                    continue
+                rkey = rid
+                refs[rkey] = rtext
+                log.debug("Text Reference: %s -> %s", rkey, rtext)
         return refs
 
     def __getRefsText2(self, pdfpath, zakey, title, refkeys):
         # year + author
         MIN_RKEY_LEN = 8
-        pdf_refs = self.__getReferences(pdfpath)
-        refs = {}
-        logging.debug("Refkeys: %s" % ", ".join(map(lambda t: "%d" % t, refkeys)))
-        for rid, rtext in pdf_refs.items():
-            if int(rid) not in refkeys:
-                logging.debug("Skip rid %s" % rid)
-                continue
-            #rkey = self.__refTextToKey(rtext)
-            #if len(rkey) < MIN_RKEY_LEN:
-            #    continue
-            rkey = rid
-            refs[rkey] = rtext
-            logging.debug("Text Reference: %s -> %s" % (rkey, rtext))
+        refs = self.__textRefs(pdfpath, refkeys)
         #P_MATCH_CITE2 = re.compile("(^(\w+\.?[\s|,|and|, and]?[\s|\.])+\s\d{4}\.)")
         #logging.getLogger("pdfminer").setLevel(logging.WARNING)
         #text = extract_text(pdfpath)
@@ -501,29 +787,48 @@ class RefExtract:
 
         P_URL = re.compile('((https?):\/\/(www\.)?[a-z0-9\.:].*(\s|$))')
         parsed_refs = {}
-        for rid, cite in refs.items():
-            logging.debug("Text ref %s:\n\t%s\n" % (rid, cite))
+        self.partial_text = parsed_refs
+        for rid, cite in metrics.traceItems(refs.items(), 'text ref'):
+            log.debug("Text ref %s:\n\t%s\n", rid, cite)
+            self.lookups.ref(rid)
             parsed_refs[rid] = self.__emptyRef()
             parsed_refs[rid]['cite'] = cite
             m = P_URL.findall(cite)
             if m:
-                logging.info("Detected online ref: %s" % m[0][0])
+                log.info("Detected online ref: %s", m[0][0])
                 parsed_refs[rid]['url'] = m[0][0]
 
-            cr = self.__findCrossRef(cite)
+            ids = findIdentifiers(cite)
+            if ids:
+                ref_id = self.__findIdentifier(ids)
+                if ref_id['title']:
+                    ref_id['cite'] = cite
+                    if not ref_id['url']:
+                        ref_id['url'] = parsed_refs[rid]['url']
+                    parsed_refs[rid] = ref_id
+                    continue
+
+            calls = [('crossref', self.__findCrossRef, (cite,))]
+            # only ask semantic scholar in parallel if crossref is not cached
+            if not self.__readCachedCite(cite, 'crossref'):
+                calls.append(('semanticscholar', self.__findSemanticScholarCite, (cite,)))
+            results, best, late = self.__hedge(calls, lambda cr: 'title' in cr.keys())
+            cr = results[0] or {}
+            # a failed semantic scholar call is not repeated
+            ref_sm = (results[1] or self.__emptyRef()) if len(calls) > 1 else None
             title = None
             try:
                 title = cr['title'][0]
-                logging.debug("Found title (crossref): %s" % title)
+                log.debug("Found title (crossref): %s", title)
                 if self.__matchCite(title=title, cite=cite):
-                    logging.info("Matched title (crossref): %s" % (title))
+                    log.info("Matched title (crossref): %s", title)
                     parsed_refs[rid] = self.__searchTitleSmZa(title)
             except:
                 pass
 
             try:
                 parsed_refs[rid]['doi'] = "https://doi.org/%s" % cr['DOI']
-                logging.info("Found doi (crossref): %s" % parsed_refs[rid]['doi'])
+                log.info("Found doi (crossref): %s", parsed_refs[rid]['doi'])
             except:
                 pass
 
@@ -534,19 +839,22 @@ class RefExtract:
                 pass
 
             if not title:
-                logging.info("Could not find crossref entry, try scholar:\n%s\n" % cite)
-                ref_sm = self.__findSemanticScholarCite(cite)
+                log.info("Could not find crossref entry, try scholar:\n%s\n", cite)
+                if ref_sm is None:
+                    ref_sm = self.__findSemanticScholarCite(cite)
                 parsed_refs[rid]['title'] = ref_sm['title']
                 parsed_refs[rid]['doi'] = ref_sm['doi']
+            else:
+                self.__fillLate(parsed_refs[rid], late)
 
-        logging.debug(json.dumps(parsed_refs, indent=2))
+        log.debug("%s", LazyJson(parsed_refs))
         return parsed_refs
 
 
     def __getRefsText(self, pdfpath, zakey, title, refkeys):
         P_MATCH_CITE = re.compile("(^\W*\[(\d+)\])")
-        logging.getLogger("pdfminer").setLevel(logging.WARNING)
-        text = extract_text(pdfpath)
+        with metrics.stage('pdf_extract'):
+            text = pdfText(pdfpath)
         lines = text.split('\n')
         started = False
         rid = None
@@ -561,13 +869,13 @@ class RefExtract:
             if started:
                 m = P_MATCH_CITE.findall(line)
                 if m:
-                    logging.debug(m)
+                    log.debug(m)
                     if len(ref) > 0:
                         if rid in refkeys:
                             refs[rid] = " ".join(ref).replace("[%s]" % str(rid), "").replace("  ", " ").lstrip().rstrip().rstrip('.')
                         ref = []
                     rid = int(m[0][1])
-                    logging.debug("Found refid: %s", rid)
+                    log.debug("Found refid: %s", rid)
                 if rid is not None:
                     ref.append(line.rstrip('-'))
             if line.lower().startswith(self.refstart.lower()):
@@ -578,22 +886,22 @@ class RefExtract:
         P_URL = re.compile('((https?):\/\/(www\.)?[a-z0-9\.:].*(\s|$))')
         parsed_refs = {}
         for rid, cite in refs.items():
-            logging.debug("Text ref %s:\n%s\n" % (rid, cite))
+            log.debug("Text ref %s:\n%s\n", rid, cite)
             parsed_refs[rid] = self.__emptyRef()
             m = P_URL.findall(cite)
             if m:
-                logging.info("Detected online ref: %s" % m[0][0])
+                log.info("Detected online ref: %s", m[0][0])
                 parsed_refs[rid]['url'] = m[0][0]
 
 
-            logging.info("Found title: %s" % title)
+            log.info("Found title: %s", title)
             cr = self.__findCrossRef(cite)
             title = None
             try:
                 title = cr['title'][0]
-                logging.debug("Found title (crossref): %s" % title)
+                log.debug("Found title (crossref): %s", title)
                 if self.__matchCite(title=title, cite=cite):
-                    logging.info("Matched cite title: %s" % (title))
+                    log.info("Matched cite title: %s", title)
                     parsed_refs[rid] = self.__searchTitleSmZa(title)
             except:
                 pass
@@ -610,56 +918,133 @@ class RefExtract:
                 pass
 
             if not title:
-                logging.info("Could not find crossref entry, try scholar:\n%s\n" % cite)
+                log.info("Could not find crossref entry, try scholar:\n%s\n", cite)
                 ref_sm = self.__findSemanticScholarCite(cite)
                 parsed_refs[rid]['title'] = ref_sm['title']
                 parsed_refs[rid]['doi'] = ref_sm['doi']
 
         return parsed_refs
 
+    def __anyRefIds(self, refs, refkeys):
+        """
+        yields (refkey, anystyle ref) for all refs cited in refkeys,
+        for all refs if refkeys is None
+        """
+        if refkeys is None:
+            for i, r in enumerate(refs):
+                try:
+                    yield int(r['citation-number'][0]), r
+                except (KeyError, IndexError, ValueError):
+                    # positions differ from the text refs, keep them apart
+                    yield "any:%d" % i, r
+            return
+        if not self.__isAuthorYear(refkeys):
+            for r in refs:
+                try:
+                    rid = int(r['citation-number'][0])
+                except Exception as e:
+                    log.error("Anyref is broken")
+                    log.error("%s", LazyJson(r))
+                    continue
+                if rid in refkeys:
+                    yield rid, r
+            return
+        index = AuthorYearIndex()
+        for i, r in enumerate(refs):
+            try:
+                surnames = [normName(a['family']) for a in r['author'] if 'family' in a.keys()]
+                m = P_YEAR.search(" ".join(r['date']))
+                index.add(i, surnames, int(m.group(1)), m.group(2) or '')
+            except Exception as e:
+                log.debug("Anyref without author/year: %s", LazyJson(r, None))
+        index.build()
+        for rkey in refkeys:
+            rid = index.lookup(rkey)
+            if rid is not None:
+                yield rkey, refs[rid]
+
     def __getRefsAnytype(self, pdfpath, zakey, title, refkeys):
-        cmd = '%s -f json find --no-layout %s -' % (self.anystyle, pdfpath)
-        logging.debug("Executing: %s" % cmd)
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-        out = p.communicate()[0]
-        refs = json.loads(out.decode('utf-8'))
+        refs = self.__getRefsAnystlye(pdfpath)
 
         parsed_refs = {}
-        for r in refs:
-            try:
-                rid = int(r['citation-number'][0])
-            except Exception as e:
-                logging.error("Anyref is broken")
-                logging.error(json.dumps(r, indent=2))
-                continue
-            if rid not in refkeys:
-                continue
-            logging.debug("Any ref %s:\n%s\n" % (rid, title))
+        self.partial_any = parsed_refs
+        for rid, r in metrics.traceItems(self.__anyRefIds(refs, refkeys), 'any ref'):
+            log.debug("Any ref %s:\n%s\n", rid, title)
+            self.lookups.ref(rid)
             parsed_refs[rid] = self.__emptyRef()
             if 'url' in r.keys():
                 parsed_refs[rid]['url'] = r['url'][0]
+            ids = findIdentifiersAny(r)
+            if ids:
+                ref_id = self.__findIdentifier(ids)
+                if ref_id['title']:
+                    parsed_refs[rid] = ref_id
+                    continue
             if 'title' in r.keys():
-                titles = sorted(r['title'], key=len, reverse=True)
+                titles = self.__rankTitles(r['title'], self.__anyCite(r))
+                budget = RefExtract.MAX_REMOTE_CANDIDATES
                 for title in titles:
-                    isok = False
-                    parsed_refs[rid] = self.__searchTitleSmZa(title)
-                if len(titles) == 1:
+                    if len(title) < RefExtract.MIN_TITLE_LEN:
+                        continue
+                    cached = self.__isCachedTitle(title)
+                    if not cached and budget <= 0:
+                        log.info("Remote lookup budget exhausted for ref %s", rid)
+                        break
+                    if not cached:
+                        budget -= 1
+                    ref = self.__searchTitleSmZa(title)
+                    if ref['title']:
+                        parsed_refs[rid] = ref
+                        break
+                if len(titles) == 1 and not parsed_refs[rid]['title']:
                     parsed_refs[rid]['title'] = titles[0]
 
         return parsed_refs
 
+    def __anyCite(self, r):
+        """
+        the other fields of the reference, with the titles every candidate
+        would match itself
+        """
+        text = []
+        for key, values in r.items():
+            if key != 'title' and isinstance(values, list):
+                text.extend([v for v in values if isinstance(v, str)])
+        return " ".join(text)
+
+    def __isCachedTitle(self, title):
+        return bool(self.__readCachedTitle(title, 'zaitem') or self.__readCachedTitle(title, 'smitem'))
+
+    def __rankTitles(self, titles, cite):
+        """
+        order title candidates by local evidence only:
+        titles found in the zotero library first, then by how well they
+        match the reference text, longest first on ties
+        """
+        ranked = []
+        for title in titles:
+            za_ratio = self.za.getFuzzyTitleRatio(title) if len(title) >= RefExtract.MIN_TITLE_LEN else 0
+            in_za = za_ratio > RefExtract.MIN_RATIO
+            ranked.append((in_za, textnorm.citeRatio(title, cite), len(title), title))
+        ranked.sort(reverse=True)
+        log.debug("Ranked title candidates: %s", ranked)
+        return [t[-1] for t in ranked]
+
     def __getRefs(self, pdfpath, zakey, title, refkeys):
         #refs_text = self.__getRefsText(pdfpath, zakey, title, refkeys)
         refs_text = self.__getRefsText2(pdfpath, zakey, title, refkeys)
         refs_any = self.__getRefsAnytype(pdfpath, zakey, title, refkeys)
 
+        return self.__mergeRefs(refs_text, refs_any)
+
+    def __mergeRefs(self, refs_text, refs_any):
         parsed_refs = {}
         rids = set(refs_text.keys()).union(set(refs_any.keys()))
         for rid in rids:
-            logging.debug("Merge Refs for id: %s" % rid)
+            log.debug("Merge Refs for id: %s", rid)
             parsed_refs[rid] = self.__emptyRef()
             if rid in refs_text.keys():
-                logging.debug("Merge Refs from Text for id: %s" % rid)
+                log.debug("Merge Refs from Text for id: %s", rid)
                 if refs_text[rid]['title']:
                     parsed_refs[rid]['title'] = refs_text[rid]['title']
                 if refs_text[rid]['doi']:
@@ -672,7 +1057,7 @@ class RefExtract:
                     parsed_refs[rid]['cite'] = refs_text[rid]['cite']
 
             if rid in refs_any.keys():
-                logging.debug("Merge Refs from Any for id: %s" % rid)
+                log.debug("Merge Refs from Any for id: %s", rid)
                 if refs_any[rid]['title'] and not parsed_refs[rid]['title']:
                     parsed_refs[rid]['title'] = refs_any[rid]['title']
                 if refs_any[rid]['doi'] and not parsed_refs[rid]['doi']:
@@ -684,6 +1069,12 @@ class RefExtract:
 
         return parsed_refs
 
+    def partialRefs(self):
+        """
+        references resolved so far by a running extractRefs
+        """
+        return self.__mergeRefs(dict(self.partial_text), dict(self.partial_any))
+
 
         #refs_text = self.__getRefsCrossRef(pdfpath)
         #sys.exit(1)
@@ -706,16 +1097,76 @@ class RefExtract:
         #        sys.exit(1)
         #return pout
 
+    def __inZotero(self, title):
+        """
+        key of the title in the local library (as getItemByTitle finds it) or None
+        """
+        keys = self.za.getItemIdByTitle(title)
+        if len(keys) == 0:
+            keys = self.za.getItemIdByFuzzyTitle(title)
+        return keys[0] if len(keys) == 1 else None
+
+    def __dryLookups(self, est):
+        """
+        lookups of a dry run, what it knows without going remote:
+        the caches of semantic scholar and the items of the local library
+        """
+        def cached(fn):
+            def local(*args):
+                res = fn(*args)
+                return res, res is None
+            return local
+        def zaitem(key, doi, title):
+            key = self.__inZotero(title)
+            if key is None:
+                return [], False
+            return [self.za.cachedItem(key)], True
+        local = {
+                'smsearch': cached(self.sm.cachedSearch),
+                'smpaper': cached(self.sm.cachedPaper),
+                'zaitem': zaitem,
+                'zakey': lambda key: ([self.za.cachedItem(key)], True),
+                }
+        return DryLookups(est, local, self.jobs)
+
+    def estimateRefs(self, pdfpath, zakey, title, refkeys, est):
+        """
+        dry run of extractRefs: the references take the same lookups, but
+        these are only answered from the caches. the remote calls the run
+        would make are counted in est (dryrun.Estimate)
+        """
+        lookups = self.lookups
+        self.lookups = self.__dryLookups(est)
+        t0 = time.perf_counter()
+        try:
+            with openPdf(pdfpath) as (path, pdfhash):
+                self.pdfhash = pdfhash
+                refs = self.__getRefs(path, zakey, title, refkeys)
+        finally:
+            self.lookups = lookups
+        est.local_seconds += time.perf_counter() - t0
+        est.ref(None)
+        if refkeys is not None:
+            est.unparsed += len(set(refkeys) - set(refs.keys()))
+
     def extractRefs(self, pdfpath, zakey, title, refkeys):
-        pdfpath_tmp = self.create_temporary_copy(pdfpath)
+        """
+        refkeys: refids cited in the annotation, None resolves all
+        references of the pdf (cache warming)
+        """
+        self.partial_text = {}
+        self.partial_any = {}
         #refpath = os.path.join(self.rcache, hashlib.md5(title.lower().encode()).hexdigest())
         #logging.debug("refpath: " + refpath)
         #if os.path.exists(refpath):
         #    logging.debug("Loading ref data from %s" % refpath)
         #    refs = json.loads(open(refpath, "r").read().replace("\\u201d", "\\\""))
         #else:
-        refs = self.__getRefs(pdfpath_tmp, zakey, title, refkeys)
+        with openPdf(pdfpath) as (path, pdfhash):
+            self.pdfhash = pdfhash
+            refs = self.__getRefs(path, zakey, title, refkeys)
+        self.citeindex.save()
         #logging.debug("Storing ref data to %s" % refpath)
         #open(refpath, "w").write(json.dumps(refs, sort_keys=True, indent=2))
-        logging.debug("Parse references for '%s'" % pdfpath)
+        log.debug("Parse references for '%s'", pdfpath)
         return refs
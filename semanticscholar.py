@@ -4,14 +4,21 @@ import urllib.parse
 import logging
 import os
 import json
+import gzip
 import hashlib
+import re
+import tempfile
+import time
 from datetime import timedelta
-from ratelimit import limits, sleep_and_retry
+from ratelimit import limits
 from tenacity import (retry,
                       wait_fixed,
                       retry_if_exception_type,
                       stop_after_attempt,
                       RetryError)
+import metrics
+
+log = logging.getLogger(__name__)
 
 
 class SemanticScholar:
@@ -19,6 +26,12 @@ class SemanticScholar:
     DEFAULT_API_URL = 'https://api.semanticscholar.org/v1'
     DEFAULT_SEARCH_API_URL = 'https://api.semanticscholar.org/graph/v1/paper'
     DEFAULT_PARTNER_API_URL = 'https://partner.semanticscholar.org/v1'
+    DEFAULT_GRAPH_API_URL = 'https://api.semanticscholar.org/graph/v1'
+    # all we read from a paper, the v1 api also returns all references and citations
+    DEFAULT_PAPER_FIELDS = 'title,externalIds,url'
+    # The API allows up to 100 requests per 5 minutes
+    RATE_CALLS = 1
+    RATE_PERIOD = timedelta(seconds=72).total_seconds()
 
     auth_header = {}
 
@@ -28,12 +41,22 @@ class SemanticScholar:
                 api_key: str=None,
                 api_url: str=None,
                 smcache: str="./smcache",
+                graph_api: bool=False,
+                fields: str=DEFAULT_PAPER_FIELDS,
+                search_ttl: float=timedelta(days=30).total_seconds(),
+                search_neg_ttl: float=timedelta(days=1).total_seconds(),
             ) -> None:
         '''
         :param float timeout: an exception is raised
             if the server has not issued a response for timeout seconds.
         :param str api_key: (optional) private API key.
         :param str api_url: (optional) custom API url.
+        :param bool graph_api: (optional) use the graph api for paper
+            lookups and only request `fields`.
+        :param str fields: (optional) paper fields requested in graph mode.
+        :param float search_ttl: (optional) seconds a cached search is valid.
+        :param float search_neg_ttl: (optional) seconds a cached search
+            without results is valid.
         '''
 
         if api_url:
@@ -47,11 +70,19 @@ class SemanticScholar:
                 self.api_url = self.DEFAULT_PARTNER_API_URL
 
         self.api_search_url = self.DEFAULT_SEARCH_API_URL
+        self.api_graph_url = self.DEFAULT_GRAPH_API_URL
+        self.graph_api = graph_api
+        self.fields = fields
         self.timeout = timeout
         self.smcache = smcache
         if not os.path.isdir(self.smcache):
-            logging.info("Creating %s" % self.smcache)
+            log.info("Creating %s", self.smcache)
             os.mkdir(self.smcache)
+        self.search_ttl = search_ttl
+        self.search_neg_ttl = search_neg_ttl
+        self.search_cache = os.path.join(self.smcache, 'search')
+        if not os.path.isdir(self.search_cache):
+            os.mkdir(self.search_cache)
 
     def findItem(self, doi, title) -> dict:
         smdata = None
@@ -72,35 +103,139 @@ class SemanticScholar:
         :rtype: :class:`dict`
         '''
 
-        paper_path = os.path.join(self.smcache, id)
-        if os.path.exists(paper_path):
-            return json.loads(open(paper_path, "r").read())
-        data = self.__get_data('paper', id, include_unknown_refs)
+        data = self.cachedPaper(id)
+        metrics.cache('smpaper', data is not None)
+        if data is not None:
+            return data
+        if self.graph_api:
+            data = self.__fromGraph(self.__get_data('paper', self.__graphId(id), include_unknown_refs))
+        else:
+            data = self.__get_data('paper', id, include_unknown_refs)
+
+        self.__writeCache(self.__paperPath(id), data)
+        return data
+
+    def __paperPath(self, id):
+        # dois contain '/'
+        return os.path.join(self.smcache, urllib.parse.quote(id, safe=''))
+
+    def cachedPaper(self, id: str) -> dict:
+        '''
+        :returns: cached paper data or None, never goes remote
+        '''
+        return self.__readCache(self.__paperPath(id))
+
+    def __readCache(self, path):
+        '''
+        compressed entries, falls back to the old plain json files
+        :returns: cached data or None
+        '''
+        try:
+            with gzip.open(path + '.json.gz', 'rt') as fd:
+                return json.load(fd)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.warning("Broken cache entry %s.json.gz: %s", path, e)
+        if os.path.exists(path):
+            return json.loads(open(path, "r").read())
+        return None
+
+    def __writeCache(self, path, data):
+        '''
+        atomic: readers (other threads, the daemon, prefetch) never see a
+        partly written entry
+        '''
+        fn = path + '.json.gz'
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fn) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(tmp, fn)
+        except:
+            os.remove(tmp)
+            raise
+
+    def __graphId(self, id):
+        '''
+        graph api ids are prefixed with their type
+        '''
+        if id.startswith('10.'):
+            return 'DOI:%s' % id
+        if id.lower().startswith('arxiv:'):
+            return 'ARXIV:%s' % id[len('arxiv:'):]
+        return id
 
-        open(paper_path, "w").write(json.dumps(data, sort_keys=True, indent=2))
+    def __fromGraph(self, data):
+        '''
+        map graph api fields to the names used by the v1 api
+        '''
+        if 'externalIds' in data.keys():
+            ext = data['externalIds'] or {}
+            if 'DOI' in ext.keys():
+                data['doi'] = ext['DOI']
+            if 'ArXiv' in ext.keys():
+                data['arxivId'] = ext['ArXiv']
         return data
 
     def search(self, id: str, include_unknown_refs: bool=False) -> dict:
         '''
         http://api.semanticscholar.org/graph/v1/paper/search?query=literature+graph
         '''
-        id = urllib.parse.quote_plus(id)
-        data = self.__get_data('search', id, include_unknown_refs)
+        data = self.__cached_search(id)
 
         try:
             return self.paper(id=data['data'][0]['paperId'])
         except:
             return None
 
-    def searchTitle(self, id: str, include_unknown_refs: bool=False) -> dict:
+    def searchTitle(self, id: str, include_unknown_refs: bool=False, limit: int=2, fields: str='title') -> dict:
         '''
         http://api.semanticscholar.org/graph/v1/paper/search?query=literature+graph
         '''
-        id = urllib.parse.quote_plus(id)
-        data = self.__get_data('search', id, include_unknown_refs)
+        data = self.__cached_search(id, limit, fields)
+
+        return data
+
+    def __cached_search(self, query: str, limit: int=2, fields: str='title') -> dict:
+        '''
+        search results are cached by normalized query, limit and fields
+        empty results are cached as well, but expire after search_neg_ttl
+        '''
+        data = self.cachedSearch(query, limit, fields)
+        metrics.cache('smsearch', data is not None)
+        if data is not None:
+            return data
 
+        data = self.__get_data('search', urllib.parse.quote_plus(query), False, limit=limit, fields=fields)
+        # {} means the request failed
+        if data:
+            self.__writeCache(self.__searchPath(query, limit, fields), {'query': self.__normQuery(query), 'time': time.time(), 'data': data})
         return data
 
+    def __normQuery(self, query):
+        return re.sub('\\s+', ' ', query.lower()).strip()
+
+    def __searchPath(self, query, limit, fields):
+        key = hashlib.md5(('%s|%d|%s' % (self.__normQuery(query), limit, fields)).encode()).hexdigest()
+        return os.path.join(self.search_cache, key)
+
+    def cachedSearch(self, query: str, limit: int=2, fields: str='title') -> dict:
+        '''
+        :returns: cached search results which did not expire or None,
+            never goes remote
+        '''
+        cached = self.__readCache(self.__searchPath(query, limit, fields))
+        if cached is None:
+            return None
+        ttl = self.search_ttl if self.__hasResults(cached['data']) else self.search_neg_ttl
+        if time.time() - cached['time'] >= ttl:
+            return None
+        log.debug("Using cached search for '%s'", cached['query'])
+        return cached['data']
+
+    def __hasResults(self, data: dict) -> bool:
+        return 'data' in data.keys() and len(data['data']) > 0
 
     def author(self, id: str) -> dict:
         '''Author lookup
@@ -113,11 +248,11 @@ class SemanticScholar:
 
         return data
 
-    # The API allows up to 100 requests per 5 minutes
-    @sleep_and_retry
-    @limits(calls=1, period=timedelta(seconds=72).total_seconds())
+    @metrics.sleep_and_retry
+    @limits(calls=RATE_CALLS, period=RATE_PERIOD)
     @retry(
         wait=wait_fixed(310),
+        sleep=metrics.retrySleep('semanticscholar'),
         #retry=(retry_if_exception_type(ConnectionRefusedError) | retry_if_exception_type(PermissionError) | retry_if_exception_type(TimeoutError)),
         retry=( retry_if_exception_type(PermissionError) | retry_if_exception_type(TimeoutError)),
         stop=stop_after_attempt(2)
@@ -126,11 +261,15 @@ class SemanticScholar:
                 self,
                 method: Literal['paper', 'author', 'search'],
                 id: str,
-                include_unknown_refs: bool
+                include_unknown_refs: bool,
+                limit: int=2,
+                fields: str='title'
             ) -> dict:
         '''Get data from Semantic Scholar API
         :param str method: 'paper' or 'author'.
         :param str id: id of the corresponding method.
+        :param int limit: number of search results.
+        :param str fields: fields of search results.
         :returns: data or empty :class:`dict` if not found.
         :rtype: :class:`dict`
         '''
@@ -142,17 +281,19 @@ class SemanticScholar:
                 'Invalid method type. Expected one of: {}'.format(method_types)
             )
 
-        if method != 'search':
+        if method == 'paper' and self.graph_api:
+            url = '{}/{}/{}?fields={}'.format(self.api_graph_url, method, urllib.parse.quote(id, safe=':/'), self.fields)
+        elif method != 'search':
             url = '{}/{}/{}'.format(self.api_url, method, id)
             if include_unknown_refs:
                 url += '?include_unknown_references=true'
         else:
-            url = '{}/{}?query={}&limit=2&fields=title'.format(self.api_search_url, method, id)
+            url = '{}/{}?query={}&limit={}&fields={}'.format(self.api_search_url, method, id, limit, fields)
 
 
-        logging.warn(url)
+        log.warning(url)
         r = requests.get(url, timeout=self.timeout, headers=self.auth_header)
-        logging.warn("Semantic status code %d" % r.status_code)
+        log.warning("Semantic status code %d", r.status_code)
 
         if r.status_code == 200:
             data = r.json()
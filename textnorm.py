@@ -0,0 +1,87 @@
+"""
+normalization and fuzzy scoring of titles and cite strings, shared by all
+matching code so the same rules apply everywhere:
+the patterns are compiled once, ligatures (ﬁ -> fi) and hyphen variants
+are folded once per string, normalized forms and pairwise scores are
+memoized in bounded caches. scores are rounded to ints as fuzzywuzzy
+did, so `ratio > 80` checks keep rejecting 80.4
+the cache file names (filecache.normKey, citeindex.fingerprint) keep their
+own normalization, changing it would orphan the existing caches
+"""
+import functools
+import re
+import unicodedata
+
+import rapidfuzz
+
+CACHE_SIZE = 1 << 16
+P_NONWORD = re.compile('[\\W_]+')
+# pdf text breaks words with all of these: Iso-lation
+HYPHENS = dict((ord(c), None) for c in '-\xad\u2010\u2011')
+
+
+def _fold(text):
+    return unicodedata.normalize('NFKC', text).lower().translate(HYPHENS)
+
+def _citeKey(text):
+    """
+    like the default processing of fuzzywuzzy: words separated by a space
+    """
+    return P_NONWORD.sub(' ', _fold(text)).strip()
+
+def _titleKey(text):
+    """
+    letters and digits only
+    """
+    return P_NONWORD.sub('', _fold(text))
+
+fold = functools.lru_cache(maxsize=CACHE_SIZE)(_fold)
+citeKey = functools.lru_cache(maxsize=CACHE_SIZE)(_citeKey)
+titleKey = functools.lru_cache(maxsize=CACHE_SIZE)(_titleKey)
+
+# normalization and scorer by kind of match
+KINDS = {
+        # reference text against a title (word order and extra words do not matter)
+        'cite': (citeKey, _citeKey, rapidfuzz.fuzz.token_set_ratio),
+        # title against title
+        'title': (titleKey, _titleKey, rapidfuzz.fuzz.ratio),
+        # title against the titles of the library (word order does not matter)
+        'sort': (citeKey, _citeKey, rapidfuzz.fuzz.token_sort_ratio),
+        }
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def score(a, b, kind='cite'):
+    norm, _, scorer = KINDS[kind]
+    return int(round(scorer(norm(a), norm(b))))
+
+def citeRatio(title, cite):
+    return score(title, cite, 'cite')
+
+def titleRatio(t0, t1):
+    return score(t0, t1, 'title')
+
+def normalizeAll(texts, kind='cite'):
+    """
+    normalized forms of many strings (e.g. the library titles) for
+    bestMatch, bypasses the caches so they are not flushed
+    """
+    norm = KINDS[kind][1]
+    return [norm(t) if isinstance(t, str) else '' for t in texts]
+
+def bestMatch(query, choices, kind='cite', cutoff=0, normalized=None):
+    """
+    scores query against all choices (list or dict of strings) with one
+    rapidfuzz call, normalized: normalizeAll of a choices list
+    returns (choice, score, index or key) of the best match or None
+    """
+    norm, _, scorer = KINDS[kind]
+    if normalized is None:
+        items = choices.items() if isinstance(choices, dict) else enumerate(choices)
+        normalized = dict((k, norm(c)) for k, c in items)
+    if not normalized:
+        return None
+    match = rapidfuzz.process.extractOne(norm(query), normalized, scorer=scorer, score_cutoff=cutoff)
+    if match is None:
+        return None
+    return choices[match[2]], int(round(match[1])), match[2]
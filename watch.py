@@ -0,0 +1,200 @@
+import logging
+import argparse
+import json
+import os
+import time
+
+from getDoi import addLibArgs, makeResolver, resolveAnnot, refLinks, writeAtomic, fileHash
+import logconf
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+log = logging.getLogger(__name__)
+
+
+class Watcher:
+    """
+    keeps the notes of an annotation directory up to date
+    the manifest holds per annotation file its content hash, the refkeys it
+    uses and the links they were resolved to. only changed annotations are
+    reprocessed, a new library export only touches notes with references
+    which are not linked to a zotero item yet
+    """
+    MANIFEST = ".getdoi-watch.json"
+
+    def __init__(self, args):
+        self.args = args
+        self.annotdir = os.path.abspath(args.annotdir)
+        self.outdir = os.path.abspath(args.outdir)
+        self.za, self.sm, self.refex = makeResolver(args)
+        self.csv_loaded = self.__csvStamp()
+        self.manifest_path = os.path.join(self.outdir, Watcher.MANIFEST)
+        self.manifest = {'csv': None, 'notes': {}}
+        if os.path.exists(self.manifest_path):
+            try:
+                self.manifest = json.loads(open(self.manifest_path, "r").read())
+            except Exception as e:
+                log.warning("Broken manifest %s, rebuilding: %s", self.manifest_path, e)
+
+    def __save(self):
+        writeAtomic(self.manifest_path, json.dumps(self.manifest, indent=2))
+
+    def __annotFiles(self):
+        for name in sorted(os.listdir(self.annotdir)):
+            path = os.path.join(self.annotdir, name)
+            if name.startswith('.') or name.endswith('.tmp') or not os.path.isfile(path):
+                continue
+            yield name, path
+
+    def __process(self, name, path, entry, force=True):
+        """
+        resolve one annotation file, returns the new manifest entry
+        the note is only rewritten if force is set or its links changed
+        """
+        title = os.path.splitext(name)[0]
+        output = os.path.join(self.outdir, name)
+        log.info("Processing %s", path)
+        try:
+            annot = open(path, "r").read()
+            text, refkeys, refs = resolveAnnot(self.za, self.refex, title, annot, self.args.format)
+        except LookupError as e:
+            # retried once the library export changes
+            log.error("%s: %s", name, e)
+            entry.update({'refkeys': [], 'links': {}, 'error': str(e)})
+            return entry
+        except Exception as e:
+            # missing pdf, remote or parse errors: retried on the next change
+            # of the annotation or the library export, the watch goes on
+            log.exception("Processing %s failed: %s", name, e)
+            entry.update({'refkeys': [], 'links': {}, 'error': "%s: %s" % (type(e).__name__, e)})
+            return entry
+        links = refLinks(refkeys, refs)
+        links = dict((str(refid), link) for refid, link in links.items())
+        if force or links != entry.get('links') or not os.path.exists(output):
+            writeAtomic(output, text)
+        entry.update({'refkeys': sorted(map(str, refkeys)), 'links': links, 'error': None})
+        return entry
+
+    def scan(self):
+        """
+        reprocess annotation files whose content changed
+        """
+        notes = self.manifest['notes']
+        seen = set()
+        changed = 0
+        for name, path in self.__annotFiles():
+            seen.add(name)
+            st = os.stat(path)
+            entry = notes.get(name, {})
+            # hash only if size or mtime changed
+            if entry.get('mtime') == st.st_mtime and entry.get('size') == st.st_size:
+                continue
+            h = fileHash(path)
+            entry.update({'mtime': st.st_mtime, 'size': st.st_size})
+            if entry.get('hash') == h:
+                notes[name] = entry
+                continue
+            entry['hash'] = h
+            notes[name] = self.__process(name, path, entry)
+            changed += 1
+            self.__save()
+        for name in [n for n in notes.keys() if n not in seen]:
+            log.info("Annotation removed: %s", name)
+            del notes[name]
+            changed += 1
+        if changed:
+            self.__save()
+        return changed
+
+    def __csvStamp(self):
+        try:
+            st = os.stat(self.args.libcsv)
+        except OSError:
+            return None
+        return [st.st_mtime, st.st_size]
+
+    def checkCsv(self):
+        """
+        on a new library export, reprocess notes which failed or still have
+        references that are not linked to a zotero item
+        """
+        stamp = self.__csvStamp()
+        if stamp is None or stamp == self.manifest['csv']:
+            return 0
+        if stamp != self.csv_loaded:
+            log.info("Library csv changed, reloading %s", self.args.libcsv)
+            self.za.reloadCsv()
+            self.csv_loaded = stamp
+        self.manifest['csv'] = stamp
+        updated = 0
+        for name, entry in self.manifest['notes'].items():
+            open_refs = [refid for refid, link in entry.get('links', {}).items() if link is None or not link.startswith('[[')]
+            if not entry.get('error') and not open_refs:
+                continue
+            path = os.path.join(self.annotdir, name)
+            if not os.path.exists(path):
+                continue
+            links = entry.get('links')
+            self.__process(name, path, entry, force=False)
+            if entry['links'] != links:
+                updated += 1
+        self.__save()
+        log.info("Library csv changed, %d notes updated", updated)
+        return updated
+
+    def __wait(self, inotify):
+        if inotify is None:
+            time.sleep(self.args.interval)
+            return
+        events = inotify.read(timeout=int(self.args.interval * 1000))
+        if events:
+            # editors and exporters write in several steps
+            time.sleep(self.args.settle)
+            inotify.read(timeout=0)
+
+    def run(self):
+        inotify = None
+        if INotify is not None and not self.args.poll:
+            inotify = INotify()
+            mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.DELETE | flags.CREATE
+            inotify.add_watch(self.annotdir, mask)
+            # the export is usually replaced, not written in place
+            inotify.add_watch(os.path.dirname(os.path.abspath(self.args.libcsv)), mask)
+            log.info("Watching %s (inotify)", self.annotdir)
+        else:
+            log.info("Watching %s (polling every %ds%s)", self.annotdir, self.args.interval, "" if INotify is not None else ", inotify_simple is not installed")
+        try:
+            while True:
+                self.checkCsv()
+                self.scan()
+                self.__wait(inotify)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.refex.close()
+
+
+def watch(argv):
+    parser = argparse.ArgumentParser(description='Keep the notes of an annotation directory up to date')
+    parser.add_argument('annotdir', help='Directory of annotation files, the file name (without extension) is the paper title')
+    parser.add_argument('outdir', help='Directory the notes are written to')
+    parser.add_argument('-f','--format', help='Citation Format (1: normal, 2: text)', choices=["1", "2"])
+    parser.add_argument('--interval', help='Seconds between polls (or inotify timeouts)', type=float, default=10)
+    parser.add_argument('--settle', help='Seconds to wait for further changes after an event', type=float, default=1)
+    parser.add_argument('--poll', help='Poll even if inotify is available', action='store_true')
+    parser.add_argument('--once', help='Process changes once and exit', action='store_true')
+    args = addLibArgs(parser).parse_args(argv)
+    logconf.configure(args)
+    if os.path.abspath(args.annotdir) == os.path.abspath(args.outdir):
+        parser.error("annotdir and outdir must differ")
+    os.makedirs(args.outdir, exist_ok=True)
+    watcher = Watcher(args)
+    if args.once:
+        watcher.checkCsv()
+        watcher.scan()
+        watcher.refex.close()
+        return
+    watcher.run()
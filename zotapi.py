@@ -1,29 +1,173 @@
 from pyzotero import zotero
-import pandas as pd
-import subprocess
-import numpy as np
-from fuzzywuzzy import process, fuzz
-import json
+import requests
+import codecs
+import csv
+import io
 import logging
+import os
+import sys
+import textnorm
+
+log = logging.getLogger(__name__)
 
 #from refextract import RefExtract
 
 FUZZ_THRESH = 80
 
+def pdfAttachment(files):
+    """
+    first pdf of a 'File Attachments' cell or None
+    """
+    if not isinstance(files, str):
+        return None
+    for fn in files.split("; "):
+        if fn.endswith(".pdf"):
+            return fn
+    return None
+
+def csvRecords(fd, offset=0):
+    """
+    yields (byte offset, fields) of the records of a csv file opened in
+    binary mode at offset, a record spans several lines if a quoted field
+    contains newlines (notes)
+    """
+    start = offset
+    lines = []
+    quotes = 0
+    for line in fd:
+        lines.append(line)
+        quotes += line.count(b'"')
+        offset += len(line)
+        # escaped quotes come in pairs, an odd count is an open field
+        if quotes % 2:
+            continue
+        text = b"".join(lines).decode('utf-8')
+        if text.strip():
+            yield start, next(csv.reader(io.StringIO(text, newline='')))
+        start = offset
+        lines = []
+        quotes = 0
+
+
+class ZotRecord:
+    """
+    the fields of a library item used by the lookups, the notes stay in
+    the csv at offset
+    """
+    __slots__ = ('key', 'title', 'doi', 'url', 'added', 'files', 'link', 'offset', 'has_notes')
+
+    def __init__(self, key, title, doi, url, added, files, link, offset, has_notes):
+        self.key = key
+        self.title = title
+        self.doi = doi
+        self.url = url
+        self.added = added
+        self.files = files
+        self.link = link
+        self.offset = offset
+        self.has_notes = has_notes
+
+
+class ZotLibrary:
+    """
+    compact index of the zotero csv export: one ZotRecord per item and
+    dicts from title, url and (lowercase) doi to the item keys
+    """
+    FIELDS = {'key': 'Key', 'title': 'Title', 'doi': 'DOI', 'url': 'Url', 'added': 'Date Added',
+              'files': 'File Attachments', 'link': 'Link Attachments'}
+
+    def __init__(self, libcsv):
+        self.libcsv = libcsv
+        self.records = {}
+        self.by_title = {}
+        self.by_doi = {}
+        self.by_url = {}
+        self.stamp = self.__stamp()
+        with open(libcsv, 'rb') as fd:
+            offset = 0
+            if fd.read(len(codecs.BOM_UTF8)) == codecs.BOM_UTF8:
+                offset = len(codecs.BOM_UTF8)
+            else:
+                fd.seek(0)
+            rows = csvRecords(fd, offset)
+            header = next(rows, (0, []))[1]
+            self.columns = dict((name, i) for i, name in enumerate(header))
+            for offset, fields in rows:
+                self.__add(offset, fields)
+        log.debug("Loaded %d library items from %s", len(self.records), libcsv)
+
+    def __stamp(self):
+        st = os.stat(self.libcsv)
+        return (st.st_mtime_ns, st.st_size)
+
+    def isStale(self):
+        try:
+            return self.__stamp() != self.stamp
+        except OSError:
+            return True
+
+    def __field(self, fields, name):
+        i = self.columns.get(name)
+        if i is None or i >= len(fields) or not fields[i]:
+            return None
+        return fields[i]
+
+    def __add(self, offset, fields):
+        values = dict((attr, self.__field(fields, name)) for attr, name in ZotLibrary.FIELDS.items())
+        if values['key'] is None:
+            return
+        for attr in ['key', 'title', 'doi', 'url']:
+            if values[attr] is not None:
+                values[attr] = sys.intern(values[attr])
+        values['files'] = pdfAttachment(values['files'])
+        notes = self.__field(fields, 'Notes')
+        rec = ZotRecord(offset=offset, has_notes=bool(notes and notes.strip()), **values)
+        self.records[rec.key] = rec
+        if rec.title is not None:
+            self.by_title.setdefault(rec.title, []).append(rec.key)
+        if rec.doi is not None:
+            self.by_doi.setdefault(rec.doi.lower(), []).append(rec.key)
+        if rec.url is not None:
+            self.by_url.setdefault(rec.url, []).append(rec.key)
+
+    def notes(self, key):
+        """
+        notes of the item, read from the csv
+        """
+        rec = self.records.get(key)
+        if rec is None or not rec.has_notes:
+            return None
+        with open(self.libcsv, 'rb') as fd:
+            fd.seek(rec.offset)
+            offset, fields = next(csvRecords(fd, rec.offset))
+        return self.__field(fields, 'Notes')
+
+
 class ZotApi:
+    # better bibtex json-rpc endpoint of the running zotero
+    BBT_URL = 'http://localhost:23119/better-bibtex/json-rpc'
+    BBT_TIMEOUT = 30
+
     def __init__(self, libcsv, library_id, library_type, api_key):
         self.zot = zotero.Zotero(library_id, library_type, api_key)
-        self.df = pd.read_csv(libcsv)
-        self.titles = self.df['Title'].unique().tolist()
-        self.urls = self.df['Url'].unique().tolist()
         self.libcsv = libcsv
+        self.reloadCsv()
         self.colkeys = {}
         self.colkeys2 = {}
         self.keytocol = {}
-        logging.info("Initialized Zotero API csv: %s, libid: %s, libtype: %s, akey: %s" % (libcsv, library_id, library_type, api_key))
+        log.info("Initialized Zotero API csv: %s, libid: %s, libtype: %s, akey: %s", libcsv, library_id, library_type, api_key)
 
     def reloadCsv(self):
-        self.df = pd.read_csv(self.libcsv)
+        self.lib = ZotLibrary(self.libcsv)
+        # same string objects as the dict keys
+        self.titles = list(self.lib.by_title.keys())
+        self.urls = list(self.lib.by_url.keys())
+        # normalized once per load for the fuzzy lookups
+        self.title_keys = textnorm.normalizeAll(self.titles, 'sort')
+        self.url_keys = textnorm.normalizeAll(self.urls, 'sort')
+
+    def __record(self, key):
+        return self.lib.records.get(key)
 
     def isValidDOI(doi):
         if doi and doi.startswith("10."):
@@ -32,39 +176,50 @@ class ZotApi:
 
     def getItemIdByTitle(self, title):
         #logging.info("Searching Zotero for title '%s'" % title)
-        return self.df[self.df['Title'] == title]['Key'].values
+        return self.lib.by_title.get(title, [])
+
+    # ratio of the best matching title in the (local) library
+    def getFuzzyTitleRatio(self, title):
+        fuzz_ratio = textnorm.bestMatch(title, self.titles, 'sort', normalized=self.title_keys)
+        if fuzz_ratio is None:
+            return 0
+        return fuzz_ratio[1]
 
     def getItemIdByFuzzyTitle(self, title):
-        logging.info("Searching Zotero for fuzzy title '%s'" % title)
-        fuzz_ratio = process.extract(title, self.titles, scorer=fuzz.token_sort_ratio)[0]
-        logging.info("Best ratio %d '%s'" % (fuzz_ratio[1], fuzz_ratio[0]))
+        log.info("Searching Zotero for fuzzy title '%s'", title)
+        fuzz_ratio = textnorm.bestMatch(title, self.titles, 'sort', normalized=self.title_keys)
+        if fuzz_ratio is None:
+            return []
+        log.info("Best ratio %d '%s'", fuzz_ratio[1], fuzz_ratio[0])
         if fuzz_ratio[1] > FUZZ_THRESH:
             return self.getItemIdByTitle(fuzz_ratio[0])
         return []
 
     def getItemByTitle(self, title):
-        logging.info("Search Zotero for title '%s'" % title)
+        log.info("Search Zotero for title '%s'", title)
         if title is None:
             return []
         keys = self.getItemIdByTitle(title)
         if len(keys) == 0:
             keys = self.getItemIdByFuzzyTitle(title)
             if len(keys) == 0:
-                logging.warn("Invalid Zotero title (not found) '%s'" % title)
+                log.warning("Invalid Zotero title (not found) '%s'", title)
                 return []
         if len(keys) > 1:
-            logging.warn("Invalid Zotero title (mutliple entries %s) '%s'" % (title, len(keys)))
+            log.warning("Invalid Zotero title (mutliple entries %s) '%s'", title, len(keys))
             return []
         #logging.info("Got Zotero keys '%s' for title '%s'" % (", ".join(keys), title))
         return self.zot.top(itemKey=keys[0])
 
     def getItemIdByUrl(self, url):
-        return self.df[self.df['Url'] == url]['Key'].values
+        return self.lib.by_url.get(url, [])
 
     def getItemIdByFuzzyUrl(self, url):
-        logging.info("Searching Zotero for fuzzy url '%s'" % url)
-        fuzz_ratio = process.extract(url, self.urls, scorer=fuzz.token_sort_ratio)[0]
-        logging.info("Best ratio %d '%s'" % (fuzz_ratio[1], fuzz_ratio[0]))
+        log.info("Searching Zotero for fuzzy url '%s'", url)
+        fuzz_ratio = textnorm.bestMatch(url, self.urls, 'sort', normalized=self.url_keys)
+        if fuzz_ratio is None:
+            return []
+        log.info("Best ratio %d '%s'", fuzz_ratio[1], fuzz_ratio[0])
         if fuzz_ratio[1] > FUZZ_THRESH:
             return self.getItemIdByUrl(fuzz_ratio[0])
         return []
@@ -78,15 +233,16 @@ class ZotApi:
             if len(keys) == 0 or len(keys) > 1:
                 return []
         try:
-            logging.debug("Got Zotero keys '%s' for url '%s'" % (", ".join(keys), url))
+            log.debug("Got Zotero keys '%s' for url '%s'", ", ".join(keys), url)
             return self.zot.top(itemKey=keys[0])
         except Exception as e:
-            logging.err("Could not get Zotero item by url '%s': %s'" % (url,e ))
+            log.error("Could not get Zotero item by url '%s': %s'", url, e)
         return []
 
 
     def getItemIdByDOI(self, doi):
-        return self.df[self.df['DOI'] == doi]['Key'].values
+        # dois are case insensitive
+        return self.lib.by_doi.get(doi.lower(), [])
 
 
     def getItemByDOI(self, doi):
@@ -98,15 +254,26 @@ class ZotApi:
             #logging.info("Invalid doi %s" % doi)
             return []
         try:
-            logging.debug("Got Zotero keys '%s' for doi '%s'" % (", ".join(keys), doi))
+            log.debug("Got Zotero keys '%s' for doi '%s'", ", ".join(keys), doi)
             return self.zot.top(itemKey=keys[0])
         except Exception as e:
-            logging.err("Could not get Zotero item by doi '%s': %s'" % (doi,e ))
+            log.error("Could not get Zotero item by doi '%s': %s'", doi, e)
         return []
 
     def getItemByKey(self, key):
         return self.zot.top(itemKey=key)
 
+    def cachedItem(self, key):
+        """
+        item of the csv in the shape getItemByKey returns, with the fields
+        the lookups read, never goes remote. None if the key is unknown
+        """
+        rec = self.__record(key)
+        if rec is None:
+            return None
+        data = dict((attr, getattr(rec, attr)) for attr in ['key', 'title', 'doi', 'url'] if getattr(rec, attr) is not None)
+        return {'key': key, 'data': data}
+
     #TODO
     #def getItemByCKey(self, key):
     #    return self.zot.top(q=key)
@@ -124,8 +291,12 @@ class ZotApi:
         return ret
 
     def getAnnotations(self, key):
-        logging.debug("get annotations for key %s" % key)
-        annots = self.df[self.df['Key'] == key]['Notes'].values
+        log.debug("get annotations for key %s", key)
+        # the csv was replaced since it was loaded, the offsets are off
+        if self.lib.isStale():
+            self.reloadCsv()
+        notes = self.lib.notes(key)
+        annots = [notes] if notes is not None else []
         #if len(annots) < 1 or not isinstance(annots[0], str):
         #    logging.warn("No annotations for %s" % key)
         #logging.info("Got annots for %s: %s" % (key, annots))
@@ -148,15 +319,16 @@ class ZotApi:
 
 
     def getPdfPath(self, key):
-        logging.debug("get pdf path for key %s" % key)
-        item = self.df[self.df['Key'] == key]
-        files = item['File Attachments'].values
-        print(files)
-        if len(files) == 1:
-            for fn in files[0].split("; "):
-                if fn.endswith(".pdf"):
-                    return fn
-        return None
+        log.debug("get pdf path for key %s", key)
+        rec = self.__record(key)
+        return rec.files if rec is not None else None
+
+    def getPdfItems(self):
+        """
+        (key, title, date added, pdf path, has notes) of all items with a pdf
+        """
+        return [(rec.key, rec.title, rec.added or "", rec.files, rec.has_notes)
+                for rec in self.lib.records.values() if rec.files is not None]
 
 
     def __getParentCollectionNames(self, ckey):
@@ -199,7 +371,7 @@ class ZotApi:
         for col in collections:
             if col['data']['name'] == colname:
                 if this_col is not None:
-                    logging.error("duplicate collectio name %s" % colname)
+                    log.error("duplicate collectio name %s", colname)
                     return []
                 this_col = col
         if this_col is not None:
@@ -207,13 +379,14 @@ class ZotApi:
             citems = self.zot.collection_items(this_col['data']['key'])
             for item in citems:
                 try:
-                    link = self.df[self.df['Key'] == item['key']]['Link Attachments'].values
-                    title = self.df[self.df['Key'] == item['key']]['Title'].values
-                    if len(link) > 0 and "semantic" in link[0]:
-                        skey = link[0].split("/")[-1]
+                    rec = self.__record(item['key'])
+                    if rec is None:
+                        continue
+                    if rec.link is not None and "semantic" in rec.link:
+                        skey = rec.link.split("/")[-1]
                         skeys.append(skey)
-                    elif len(title) > 0:
-                        logging.warn("No semantic link for %s" % title[0])
+                    elif rec.title is not None:
+                        log.warning("No semantic link for %s", rec.title)
                     #logging.info("CItem %s, links: %s" % (str(title), str(link)))
                 except:
                     pass
@@ -234,13 +407,11 @@ class ZotApi:
         return apa
 
     def getCiteKey(self, zotkey):
-        this_curl_cmd = 'curl http://localhost:23119/better-bibtex/json-rpc -X POST -H "Content-Type: application/json" -H "Accept: application/json" --data-binary \'{"jsonrpc": "2.0", "method": "item.citationkey", "params": [["%s"]] }\'' % zotkey
-        logging.debug("Executing %s" % this_curl_cmd)
-        p = subprocess.Popen(this_curl_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        pout, _ = p.communicate()
+        req = {"jsonrpc": "2.0", "method": "item.citationkey", "params": [[zotkey]]}
+        log.debug("Requesting citation key for %s", zotkey)
         try:
-            res = json.loads(pout.decode('utf-8'))
-            ckey = res['result'][zotkey]
+            r = requests.post(ZotApi.BBT_URL, json=req, headers={"Accept": "application/json"}, timeout=ZotApi.BBT_TIMEOUT)
+            ckey = r.json()['result'][zotkey]
             return ckey
         except:
             pass